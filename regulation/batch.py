@@ -0,0 +1,623 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Batch evaluation engine: the same decisions as power_regulation.evaluate(), for many sites at once.
+#
+# The equipment state of all sites is stored in NumPy arrays of shape (sites, slots), slot j being the equipment of
+# priority j of a site (sites with fewer equipments are padded with EMPTY slots). A tick evaluates every site in one
+# pass: the loops over equipments of evaluate() become loops over slots, each step processing all sites at once with
+# masks. Only the equipments which power or state changed are reported.
+#
+# Sites can be added to and removed from an engine with their whole state (see export_sites()), which is how the fleet
+# (see fleet.py) moves them between workers.
+#
+# What is covered: the evaluation period, the daily energy reset, the low energy fallback, forced states and their
+# expiration, the minimum on/off times and hysteresis band of switched equipments, and a constant power equipment with
+# a minimum off time or band taking the power of lower priority equipments (see power_regulation.claim_power()). The
+# production forecast and the adaptive evaluation period are not covered.
+#
+# Usage:
+#   batch.py verify [--sites 200]     compare the decisions with the scalar path on a random corpus
+#   batch.py bench [--sites 10000]    measure the number of sites evaluated per second
+
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+
+from debug import logger
+import equipment
+from equipment import ConstantPowerEquipment, UnknownPowerEquipment, VariablePowerEquipment
+import power_regulation
+from power_regulation import EVALUATION_PERIOD
+
+EMPTY = 0
+VARIABLE = 1
+CONSTANT = 2
+UNKNOWN = 3
+
+ON = 1
+OFF = -1
+PENDING_DIRECTIONS = {None: 0, 'on': ON, 'off': OFF}
+
+
+# Per equipment arrays of the engine with their type and value for EMPTY slots
+SLOT_FIELDS = (
+    ('kind', np.int8, EMPTY),
+    ('nominal', float, 0),
+    ('power', float, 0),
+    ('is_on', bool, False),
+    ('forced', bool, False),
+    ('force_end', float, np.inf),
+    ('energy', float, 0),
+    ('last_change', float, np.nan),
+    ('min_on', float, 0),
+    ('min_off', float, 0),
+    ('last_switch', float, np.nan),
+    ('hysteresis', float, 0),
+    ('pending_direction', np.int8, 0),
+    ('pending_energy', float, 0),
+    ('pending_date', float, np.nan),
+)
+
+# Per site arrays of the engine with their type and initial value
+SITE_FIELDS = (
+    ('last_evaluation', float, np.nan),
+    ('energy_yesterday', float, 0),
+    ('fallback', int, -1),
+)
+
+
+def _none_to_nan(value):
+    return np.nan if value is None else value
+
+
+def site_state(site, fallback=None):
+    """ Capture the state of the equipments of a site (by priority order) in the format of BatchEngine.export_sites().
+    fallback is the equipment receiving the low energy fallback, if any """
+    state = dict((name, []) for name, _, _ in SLOT_FIELDS)
+    state['names'] = [e.name for e in site]
+    state['topics'] = [getattr(e, 'topic', None) for e in site]
+    for e in site:
+        if isinstance(e, VariablePowerEquipment):
+            state['kind'].append(VARIABLE)
+            state['nominal'].append(e.max_power)
+        elif isinstance(e, ConstantPowerEquipment):
+            state['kind'].append(CONSTANT)
+            state['nominal'].append(e.nominal_power)
+        elif isinstance(e, UnknownPowerEquipment):
+            state['kind'].append(UNKNOWN)
+            state['nominal'].append(0)
+        else:
+            raise ValueError('unsupported equipment type: ' + type(e).__name__)
+        state['power'].append(e.current_power or 0)
+        state['is_on'].append(getattr(e, 'is_on', False))
+        state['forced'].append(e.is_forced_)
+        state['force_end'].append(np.inf if e.force_end_date is None else e.force_end_date)
+        state['energy'].append(e.energy)
+        state['last_change'].append(_none_to_nan(e.last_power_change_date))
+        state['min_on'].append(e.min_on_time)
+        state['min_off'].append(e.min_off_time)
+        state['last_switch'].append(_none_to_nan(e.last_switch_date))
+        state['hysteresis'].append(e.hysteresis_energy)
+        state['pending_direction'].append(PENDING_DIRECTIONS[e.pending_direction])
+        state['pending_energy'].append(e.pending_energy)
+        state['pending_date'].append(_none_to_nan(e.pending_date))
+    state['last_evaluation'] = np.nan
+    state['energy_yesterday'] = 0
+    state['fallback'] = -1 if fallback is None else site.index(fallback)
+    return state
+
+
+class BatchEngine(object):
+    def __init__(self, sites=(), fallbacks=None):
+        """ sites is a list of equipment lists (by priority order), their current state is captured. fallbacks gives
+        the equipment receiving the low energy fallback for each site (default: the first variable power equipment) """
+        for name, dtype, _ in SLOT_FIELDS:
+            setattr(self, name, np.zeros((0, 0), dtype))
+        for name, dtype, _ in SITE_FIELDS:
+            setattr(self, name, np.zeros(0, dtype))
+        self.names = []
+        self.topics = []
+        self.exists = np.zeros((0, 0), bool)
+
+        if fallbacks is None:
+            fallbacks = [next((e for e in s if isinstance(e, VariablePowerEquipment)), None) for s in sites]
+        self.add_sites([site_state(site, fallback) for site, fallback in zip(sites, fallbacks)])
+
+    def add_sites(self, states):
+        """ Append sites given by their state (see export_sites()), without sending any command. Return the indexes of
+        the new sites """
+        if not states:
+            return range(len(self.names), len(self.names))
+        n = len(self.names)
+        slots = max([self.kind.shape[1]] + [len(state['names']) for state in states])
+        for name, dtype, empty in SLOT_FIELDS:
+            rows = np.full((n + len(states), slots), empty, dtype)
+            current = getattr(self, name)
+            rows[:n, :current.shape[1]] = current
+            for i, state in enumerate(states):
+                rows[n + i, :len(state['names'])] = state[name]
+            setattr(self, name, rows)
+        for name, dtype, _ in SITE_FIELDS:
+            setattr(self, name, np.concatenate((getattr(self, name), np.array([s[name] for s in states], dtype))))
+        self.names += [list(state['names']) for state in states]
+        self.topics += [list(state['topics']) for state in states]
+        self.exists = self.kind != EMPTY
+        return range(n, len(self.names))
+
+    def export_sites(self, indexes):
+        """ Return the state of the given sites, including forced states, energy counters and dwell times """
+        states = []
+        for i in indexes:
+            slots = len(self.names[i])
+            state = dict((name, getattr(self, name)[i, :slots].tolist()) for name, _, _ in SLOT_FIELDS)
+            state.update((name, getattr(self, name)[i].item()) for name, _, _ in SITE_FIELDS)
+            state['names'] = list(self.names[i])
+            state['topics'] = list(self.topics[i])
+            states.append(state)
+        return states
+
+    def remove_sites(self, indexes):
+        """ Remove the given sites and return their state, the following sites are moved down """
+        states = self.export_sites(indexes)
+        for name, _, _ in SLOT_FIELDS + SITE_FIELDS:
+            setattr(self, name, np.delete(getattr(self, name), indexes, axis=0))
+        removed = set(indexes)
+        self.names = [names for i, names in enumerate(self.names) if i not in removed]
+        self.topics = [topics for i, topics in enumerate(self.topics) if i not in removed]
+        self.exists = self.kind != EMPTY
+        return states
+
+    def command_payload(self, site, slot):
+        """ The MQTT payload the scalar equipment would send for its current power """
+        if self.kind[site, slot] == VARIABLE:
+            return str(VariablePowerEquipment.power_to_percent(self.power[site, slot], self.nominal[site, slot]))
+        return '1' if self.is_on[site, slot] else '0'
+
+    # Equipment methods, applied to column j for the sites selected by mask
+
+    def _set_power(self, j, mask, power, now):
+        lc = self.last_change[:, j]
+        m = mask & ~np.isnan(lc)
+        self.energy[m, j] += self.power[m, j] * (now - lc[m]) / 3600.0
+        self.power[mask, j] = power if np.isscalar(power) else power[mask]
+        self.last_change[mask, j] = now
+
+        constant = mask & (self.kind[:, j] == CONSTANT)
+        on = self.power[:, j] != 0
+        self._switched(j, constant & (self.is_on[:, j] != on), now)
+        self.is_on[constant, j] = on[constant]
+
+    def _switched(self, j, mask, now):
+        self.last_switch[mask, j] = now
+        self.pending_direction[mask, j] = 0
+
+    def _can_switch_on(self, j, now):
+        ls = self.last_switch[:, j]
+        return np.isnan(ls) | (now - ls >= self.min_off[:, j])
+
+    def _can_switch_off(self, j, now):
+        ls = self.last_switch[:, j]
+        return np.isnan(ls) | (now - ls >= self.min_on[:, j])
+
+    def _hysteresis_reached(self, j, mask, direction, watt, now):
+        without = self.hysteresis[:, j] <= 0
+        m = mask & ~without
+        restart = m & (self.pending_direction[:, j] != direction)
+        resume = m & ~restart
+        self.pending_direction[restart, j] = direction
+        self.pending_energy[restart, j] = 0
+        self.pending_energy[resume, j] += watt[resume] * (now - self.pending_date[resume, j]) / 3600.0
+        self.pending_date[m, j] = now
+        return without | (self.pending_energy[:, j] >= self.hysteresis[:, j])
+
+    def _freeable(self, j, now):
+        """ get_freeable_power() of the equipments which are not forced, 0 for unknown power equipments """
+        kind = self.kind[:, j]
+        power = np.where((kind == CONSTANT) & self.is_on[:, j] & ~self._can_switch_off(j, now), 0, self.power[:, j])
+        return np.where(self.exists[:, j] & ~self.forced[:, j] & (kind != UNKNOWN), power, 0)
+
+    def _decrease(self, j, watt, mask, now, use_hysteresis=True):
+        """ decrease_power_by(), return the canceled power and the mask of unknown results (None) """
+        result = np.zeros(len(watt))
+        kind = self.kind[:, j]
+
+        variable = mask & (kind == VARIABLE)
+        if variable.any():
+            current = self.power[:, j].copy()
+            decrease = np.where(watt >= current, current, watt)
+            decrease = np.where(current - decrease < VariablePowerEquipment.MINIMUM_POWER, current, decrease)
+            self._set_power(j, variable & (decrease > 0), current - decrease, now)
+            result[variable] = decrease[variable]
+
+        switched = mask & ((kind == CONSTANT) | (kind == UNKNOWN)) & self.is_on[:, j]
+        unknown = np.zeros(len(watt), bool)
+        if switched.any():
+            allowed = switched & self._can_switch_off(j, now)
+            if use_hysteresis:
+                allowed &= self._hysteresis_reached(j, allowed, OFF, watt, now)
+            constant = allowed & (kind == CONSTANT)
+            self._set_power(j, constant, 0, now)
+            result[constant] = self.nominal[constant, j]
+            unknown = allowed & (kind == UNKNOWN)
+            self.is_on[unknown, j] = False
+            self._switched(j, unknown, now)
+
+        return result, unknown
+
+    def _increase(self, j, watt, mask, now):
+        """ increase_power_by(), return the remaining power and the mask of unknown results (None) """
+        remaining = watt.copy()
+        kind = self.kind[:, j]
+
+        variable = mask & (kind == VARIABLE)
+        if variable.any():
+            current = self.power[:, j].copy()
+            full = current + watt >= self.nominal[:, j]
+            increase = np.where(full, self.nominal[:, j] - current, watt)
+            rest = np.where(full, watt - increase, 0)
+            low = current + increase < VariablePowerEquipment.MINIMUM_POWER
+            increase = np.where(low, 0, increase)
+            rest = np.where(low, watt, rest)
+            self._set_power(j, variable & (increase > 0), current + increase, now)
+            remaining[variable] = rest[variable]
+
+        switched = mask & ((kind == CONSTANT) | (kind == UNKNOWN)) & ~self.is_on[:, j]
+        unknown = np.zeros(len(watt), bool)
+        if switched.any():
+            allowed = switched & ((kind == UNKNOWN) | (watt >= self.nominal[:, j]))
+            allowed &= self._can_switch_on(j, now)
+            allowed &= self._hysteresis_reached(j, allowed, ON, watt, now)
+            constant = allowed & (kind == CONSTANT)
+            self._set_power(j, constant, self.nominal[:, j], now)
+            remaining[constant] = watt[constant] - self.nominal[constant, j]
+            unknown = allowed & (kind == UNKNOWN)
+            self.is_on[unknown, j] = True
+            self._switched(j, unknown, now)
+
+        return remaining, unknown
+
+    def force(self, site, slot, watt, duration, now):
+        """ Equipment.force() for a single equipment """
+        mask = np.zeros(len(self.kind), bool)
+        mask[site] = True
+        self.forced[site, slot] = watt is not None
+        self.force_end[site, slot] = np.inf if duration is None else now + duration
+        kind = self.kind[site, slot]
+        if kind == VARIABLE:
+            self._set_power(slot, mask, 0 if watt is None else watt, now)
+        elif kind == CONSTANT:
+            self._set_power(slot, mask, self.nominal[site, slot] if watt is not None and
+                            watt >= self.nominal[site, slot] else 0, now)
+        elif kind == UNKNOWN:
+            if self.is_on[site, slot] != (watt is not None):
+                self._switched(slot, mask, now)
+            self.is_on[site, slot] = watt is not None
+            self._set_power(slot, mask, 0 if watt is None else watt, now)
+
+    def _local_time(self, dates, now):
+        """ Return the local hour and day of month of each date (NaN dates give -1), and of now """
+        hours = np.full(len(dates), -1)
+        days = np.full(len(dates), -1)
+        known = ~np.isnan(dates)
+        for d in np.unique(dates[known]):
+            lt = time.localtime(d)
+            same = dates == d
+            hours[same] = lt.tm_hour
+            days[same] = lt.tm_mday
+        lt = time.localtime(now)
+        return hours, days, lt.tm_hour, lt.tm_mday
+
+    def tick(self, consumption, production, now):
+        """ Evaluate all sites with the given measurements (arrays, NaN when unknown) and return the (sites, slots)
+        indexes of the equipments which power or state changed """
+        before_power = self.power.copy()
+        before_on = self.is_on.copy()
+        last = self.last_evaluation
+        known = ~np.isnan(last)
+        hours, days, now_hour, now_day = self._local_time(last, now)
+
+        # reset energy counters every day
+        reset = known & (days != now_day)
+        if reset.any():
+            rows = reset[:, None] & self.exists
+            m = rows & ~np.isnan(self.last_change)
+            self.energy[m] += self.power[m] * (now - self.last_change[m]) / 3600.0
+            self.energy[rows] = 0
+            self.last_change[rows] = now
+
+        # ensure there's a minimum duration between two evaluations
+        run = ~(known & (now - last < EVALUATION_PERIOD))
+
+        # low energy fallback
+        fallback = run & known & (self.fallback >= 0)
+        if fallback.any():
+            sites = np.nonzero(fallback)[0]
+            slots = self.fallback[sites]
+            energy_today = self.energy[sites, slots]
+            save = (hours[sites] == 22) & (now_hour == 23)
+            self.energy_yesterday[sites[save]] = energy_today[save]
+            check = (hours[sites] == power_regulation.LOW_ENERGY_CHECK_AT - 1) & \
+                    (now_hour == power_regulation.LOW_ENERGY_CHECK_AT)
+            check &= (self.energy_yesterday[sites] + energy_today) < power_regulation.LOW_ENERGY_TWO_DAYS
+            check &= energy_today < power_regulation.LOW_ENERGY_TODAY
+            for site, slot, energy in zip(sites[check], slots[check], energy_today[check]):
+                max_power = self.nominal[site, slot]
+                self.force(site, slot, max_power, 3600 * (power_regulation.LOW_ENERGY_TODAY - energy) / max_power,
+                           now)
+
+        self.last_evaluation[run] = now
+
+        valid = run & ~np.isnan(consumption) & ~np.isnan(production)
+        if valid.any():
+            self._allocate(valid, consumption, production, now)
+
+        changed = (self.power != before_power) | (self.is_on != before_on)
+        return np.nonzero(changed)
+
+    def _allocate(self, valid, consumption, production, now):
+        slots = self.kind.shape[1]
+
+        expired = valid[:, None] & self.forced & (now > self.force_end)
+        self.forced[expired] = False
+        self.force_end[expired] = np.inf
+
+        # read at each tick, like the regulation loop, so that a configuration reload is taken into account
+        margin = power_regulation.MARGIN
+        deficit = valid & (consumption > production - margin)
+        excess = consumption - (production - margin)
+        available = production - margin - consumption
+        surplus = valid & ~deficit & ~(available < power_regulation.BALANCE_THRESHOLD)
+        # when balanced, only a switched equipment waiting for the power of lower priority equipments may change
+        available = np.where(surplus, available, 0)
+
+        # Too much power consumption, decrease the load starting from the lowest priority
+        active = deficit.copy()
+        for j in reversed(range(slots)):
+            mask = active & self.exists[:, j] & ~self.forced[:, j]
+            if not mask.any():
+                continue
+            result, unknown = self._decrease(j, excess, mask, now)
+            active &= ~unknown
+            done = mask & ~unknown
+            excess = np.where(done, excess - result, excess)
+            active &= ~(done & (excess <= 0))
+
+        # There's power in excess, increase the load starting from the highest priority
+        active = valid & ~deficit
+        for j in range(slots):
+            candidates = active & self.exists[:, j] & ~self.forced[:, j]
+            if not candidates.any():
+                continue
+
+            # claim_power(): a switched equipment which is off takes the power of lower priority equipments
+            claim = candidates & (self.kind[:, j] == CONSTANT) & ~self.is_on[:, j]
+            claim &= (self.min_off[:, j] > 0) | (self.hysteresis[:, j] > 0)
+            if claim.any():
+                reclaimable = sum((self._freeable(k, now) for k in range(j + 1, slots)), np.zeros(len(available)))
+                offer = available + reclaimable
+                claim &= offer >= self.nominal[:, j]
+            if claim.any():
+                go = claim & self._can_switch_on(j, now)
+                go &= self._hysteresis_reached(j, go, ON, offer, now)
+                held = claim & ~go
+                available = np.where(held, np.maximum(0, available - self.nominal[:, j]), available)
+                needed = np.where(go, self.nominal[:, j] - available, 0)
+                for k in reversed(range(j + 1, slots)):
+                    m = go & (needed > 0) & (self._freeable(k, now) > 0)
+                    if m.any():
+                        freed, _ = self._decrease(k, needed, m, now, use_hysteresis=False)
+                        available = np.where(m, available + freed, available)
+                        needed = np.where(m, needed - freed, needed)
+                if go.any():
+                    result, _ = self._increase(j, available, go, now)
+                    available = np.where(go, result, available)
+
+            active &= ~(candidates & ~claim & (available <= 0))
+            mask = active & candidates & ~claim
+            if not mask.any():
+                continue
+            result, unknown = self._increase(j, available, mask, now)
+            active &= ~unknown
+            done = mask & ~unknown
+            active &= ~(done & (result == 0))
+            available = np.where(done, result, available)
+
+        # an imbalance only accumulates towards the hysteresis band while it is continuously observed
+        stale = valid[:, None] & (self.pending_direction != 0) & (self.pending_date < now)
+        self.pending_direction[stale] = 0
+
+
+def random_site(rnd, index):
+    es = []
+    for j in range(rnd.randint(1, 5)):
+        kind = rnd.choice((VARIABLE, CONSTANT, CONSTANT, UNKNOWN)) if j > 0 else VARIABLE
+        name = 'e{}_{}'.format(index, j)
+        if kind == VARIABLE:
+            es.append(VariablePowerEquipment(name, rnd.choice((1000, 1500, 2400, 3000))))
+        elif kind == CONSTANT:
+            dwell = rnd.random() < 0.5
+            es.append(ConstantPowerEquipment(name, rnd.choice((100, 120, 500, 1800)),
+                                             min_on_time=rnd.choice((60, 180)) if dwell else 0,
+                                             min_off_time=rnd.choice((60, 180)) if dwell else 0,
+                                             hysteresis_energy=rnd.choice((0, 0.2, 0.5))))
+        else:
+            es.append(UnknownPowerEquipment(name, hysteresis_energy=rnd.choice((0, 0.2))))
+    rnd.shuffle(es)
+    return es
+
+
+def corpus_dates(rnd, start):
+    """ Ticks crossing the fallback check, the energy save and the day change """
+    dates = []
+    for offset in (15 * 3600 + 50 * 60, 22 * 3600 + 55 * 60, 23 * 3600 + 55 * 60):
+        t = start + offset
+        for _ in range(150):
+            t += rnd.choice((1, 2, 4, 4, 4, 6, 10))
+            dates.append(t)
+    return dates
+
+
+class ScalarSites(object):
+    """ Run power_regulation.evaluate() for each site in turn, swapping the module globals """
+
+    def __init__(self, sites, clock, client):
+        self.sites = sites
+        self.contexts = [{'last_evaluation_date': None, 'energy_yesterday': 0} for _ in sites]
+        equipment.now_ts = clock
+        power_regulation.now_ts = clock
+        equipment.setup(client, True)
+        power_regulation.mqtt_client = client
+        power_regulation.FORECAST = False
+        power_regulation.ADAPTIVE_EVALUATION_PERIOD = False
+
+    def evaluate(self, i, consumption, production):
+        context = self.contexts[i]
+        power_regulation.equipments = self.sites[i]
+        power_regulation.equipment_water_heater = \
+            [e for e in self.sites[i] if isinstance(e, VariablePowerEquipment)][0]
+        power_regulation.last_evaluation_date = context['last_evaluation_date']
+        power_regulation.energy_yesterday = context['energy_yesterday']
+        power_regulation.power_consumption = consumption
+        power_regulation.power_production = production
+        power_regulation.evaluate()
+        context['last_evaluation_date'] = power_regulation.last_evaluation_date
+        context['energy_yesterday'] = power_regulation.energy_yesterday
+
+
+def verify(n_sites, seed):
+    from replay import FakeMqttClient, VirtualClock
+
+    rnd = random.Random(seed)
+    start = time.mktime((2019, 5, 1, 0, 0, 0, 0, 0, -1))
+    clock = VirtualClock(start)
+    client = FakeMqttClient(clock)
+    sites = [random_site(rnd, i) for i in range(n_sites)]
+    scalar = ScalarSites(sites, clock, client)
+    for site in sites:
+        for e in site:
+            e.set_current_power(0)
+    engine = BatchEngine(sites)
+
+    mismatches = 0
+    decisions = 0
+    for t in corpus_dates(rnd, start):
+        clock.t = t
+        consumption = np.array([rnd.randint(100, 4000) for _ in sites], float)
+        production = np.array([rnd.randint(0, 5000) for _ in sites], float)
+
+        if rnd.random() < 0.1:
+            i = rnd.randrange(n_sites)
+            j = rnd.randrange(len(sites[i]))
+            watt = rnd.choice((None, 0, 100, 2000))
+            duration = rnd.choice((None, 5, 30))
+            sites[i][j].force(watt, duration)
+            engine.force(i, j, watt, duration, t)
+
+        before = [[(e.get_current_power(), getattr(e, 'is_on', None)) for e in site] for site in sites]
+        for i in range(n_sites):
+            scalar.evaluate(i, consumption[i], production[i])
+        expected = set((i, j) for i, site in enumerate(sites) for j, e in enumerate(site)
+                       if (e.get_current_power(), getattr(e, 'is_on', None)) != before[i][j])
+        changed = set(zip(*[x.tolist() for x in engine.tick(consumption, production, t)]))
+        decisions += len(expected)
+
+        for i, site in enumerate(sites):
+            for j, e in enumerate(site):
+                same = ((i, j) in expected) == ((i, j) in changed) and \
+                    e.get_current_power() == engine.power[i, j] and \
+                    getattr(e, 'is_on', False) == engine.is_on[i, j] and \
+                    e.is_forced_ == engine.forced[i, j] and \
+                    abs(e.get_energy() - engine.energy[i, j]) < 1e-6
+                if not same:
+                    mismatches += 1
+                    if mismatches <= 10:
+                        print('mismatch at {} on site {} equipment {}: scalar {}W on={} forced={} energy={}, '
+                              'batch {}W on={} forced={} energy={}'.format(
+                                  t, i, e.name, e.get_current_power(), getattr(e, 'is_on', False), e.is_forced_,
+                                  e.get_energy(), engine.power[i, j], engine.is_on[i, j], engine.forced[i, j],
+                                  engine.energy[i, j]))
+    print('{} sites, {} decisions compared, {} mismatches'.format(n_sites, decisions, mismatches))
+    return mismatches
+
+
+def bench(n_sites, ticks, seed):
+    from replay import FakeMqttClient, VirtualClock
+
+    rnd = random.Random(seed)
+    start = time.mktime((2019, 5, 1, 12, 0, 0, 0, 0, -1))
+    clock = VirtualClock(start)
+    equipment.now_ts = clock
+    equipment.setup(FakeMqttClient(clock), False)
+    sites = [random_site(rnd, i) for i in range(n_sites)]
+    for site in sites:
+        for e in site:
+            e.set_current_power(0)
+    engine = BatchEngine(sites)
+    np_rnd = np.random.RandomState(seed)
+
+    elapsed = 0
+    for k in range(ticks):
+        consumption = np_rnd.randint(100, 4000, n_sites).astype(float)
+        production = np_rnd.randint(0, 5000, n_sites).astype(float)
+        t0 = time.perf_counter()
+        engine.tick(consumption, production, start + k * EVALUATION_PERIOD)
+        elapsed += time.perf_counter() - t0
+    print('batch: {} sites x {} ticks, {:.0f} sites/s'.format(n_sites, ticks, n_sites * ticks / elapsed))
+
+    n_scalar = min(n_sites, 500)
+    scalar = ScalarSites(sites[:n_scalar], clock, FakeMqttClient(clock))
+    elapsed = 0
+    for k in range(ticks):
+        clock.t = start + (ticks + k) * EVALUATION_PERIOD
+        consumption = np_rnd.randint(100, 4000, n_scalar)
+        production = np_rnd.randint(0, 5000, n_scalar)
+        t0 = time.perf_counter()
+        for i in range(n_scalar):
+            scalar.evaluate(i, int(consumption[i]), int(production[i]))
+        elapsed += time.perf_counter() - t0
+    print('scalar: {} sites x {} ticks, {:.0f} sites/s'.format(n_scalar, ticks, n_scalar * ticks / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch evaluation engine')
+    sub = parser.add_subparsers(dest='command')
+    p_verify = sub.add_parser('verify')
+    p_verify.add_argument('--sites', type=int, default=200)
+    p_verify.add_argument('--seed', type=int, default=1)
+    p_bench = sub.add_parser('bench')
+    p_bench.add_argument('--sites', type=int, default=10000)
+    p_bench.add_argument('--ticks', type=int, default=20)
+    p_bench.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+
+    if args.command == 'verify':
+        if verify(args.sites, args.seed):
+            raise SystemExit(1)
+    elif args.command == 'bench':
+        bench(args.sites, args.ticks, args.seed)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Micro-benchmarks of the regulation hot paths, using a fake MQTT client and a virtual clock.
+# For each benchmark, the per-call latency (min, median and 90th percentile) and memory allocations (peak and retained
+# bytes per call, measured with tracemalloc) are reported. Logging is disabled while measuring.
+#
+# The calls last a few microseconds, which is about the jitter of a single timing. A latency sample is therefore the
+# mean of CALLS_PER_SAMPLE calls, each one after its setup, from which the duration of the same number of setups alone
+# is subtracted. compare checks the fastest sample (min), the least disturbed by the rest of the system, with an
+# absolute slack of LATENCY_SLACK_US. The speed of a machine may also vary from a run to the next (shared or throttled
+# CPU): a fixed pure Python workload is timed next to each benchmark, and compare scales the baseline latencies by the
+# ratio of these reference timings. When compare runs the benchmarks itself, a benchmark found slower is measured again
+# up to CONFIRMATIONS times and only reported if it stays slower, so that a burst of load does not fail the comparison.
+#
+# Usage:
+#   benchmark.py run [--save results.json] [--filter name]
+#   benchmark.py compare baseline.json [results.json] [--tolerance 0.25]
+# compare runs the benchmarks when no results file is given, and exits with status 1 when a regression is found.
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+
+from debug import logger
+from decision_cache import DecisionCache
+import equipment
+from equipment import ConstantPowerEquipment, UnknownPowerEquipment, VariablePowerEquipment
+import instant_power
+import power_regulation
+from replay import FakeMqttClient, VirtualClock
+
+SAMPLES = 100
+CALLS_PER_SAMPLE = 20
+ALLOCATION_ITERATIONS = 200
+
+# Allocation differences below this amount of bytes, and latency differences below this amount of microseconds, are
+# never considered as regressions
+ALLOCATION_SLACK = 256
+LATENCY_SLACK_US = 1
+
+# Number of additional measures of a benchmark found slower than its baseline before reporting a regression
+CONFIRMATIONS = 3
+
+clock = VirtualClock(1556700000)
+client = FakeMqttClient(clock)
+
+
+class Message(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class ManualTimer(object):
+    """ A timer that never fires by itself, used to keep threads out of the measurements """
+
+    def __init__(self, delay, callback):
+        self.delay = delay
+        self.callback = callback
+
+    def start(self):
+        pass
+
+    def cancel(self):
+        pass
+
+
+def install_fakes():
+    equipment.now_ts = clock
+    power_regulation.now_ts = clock
+    equipment.setup(client, True)
+    power_regulation.mqtt_client = client
+
+
+def setup_regulation(equipments, consumption, production):
+    power_regulation.equipments = equipments
+    power_regulation.equipment_water_heater = [e for e in equipments if isinstance(e, VariablePowerEquipment)][0]
+    power_regulation.last_evaluation_date = None
+    power_regulation.power_consumption = consumption
+    power_regulation.power_production = production
+    power_regulation.decision_cache = None
+    del client.messages[:]
+
+
+def evaluate_scenario(make_equipments, consumption, production):
+    def setup():
+        setup_regulation(make_equipments(), consumption, production)
+
+    return setup, power_regulation.evaluate
+
+
+def cached_evaluate_scenario(make_equipments, consumption, production):
+    """ The same situation evaluated over and over with the decision cache, all calls but the first one are hits """
+    cache = DecisionCache(16)
+
+    def setup():
+        setup_regulation(make_equipments(), consumption, production)
+        power_regulation.decision_cache = cache
+
+    return setup, power_regulation.evaluate
+
+
+def balanced_equipments():
+    water_heater = VariablePowerEquipment('water_heater', 2400)
+    charger = ConstantPowerEquipment('e_bike_charger', 120)
+    for e in (charger, water_heater):
+        e.set_current_power(0)
+    charger.set_current_power(120)
+    water_heater.set_current_power(1000)
+    return charger, water_heater
+
+
+def idle_equipments():
+    es = (ConstantPowerEquipment('e_bike_charger', 120), VariablePowerEquipment('water_heater', 2400),
+          ConstantPowerEquipment('heater', 1800))
+    for e in es:
+        e.set_current_power(0)
+    return es
+
+
+def many_loads_equipments():
+    # the minimum off time makes the heat pump take the power of the lower priority equipments
+    es = [ConstantPowerEquipment('heat_pump', 2000, min_off_time=60), VariablePowerEquipment('water_heater', 2400)]
+    es += [ConstantPowerEquipment('plug_{}'.format(i), 100) for i in range(20)]
+    for e in es:
+        e.set_current_power(0)
+    for e in es[2:]:
+        e.set_current_power(100)
+    return es
+
+
+def forced_equipments():
+    es = idle_equipments() + (UnknownPowerEquipment('plug_1'),)
+    es[1].set_current_power(0)
+    es[3].set_current_power(0)
+    for e in es:
+        e.force(e.get_current_power() or 100, 3600)
+    return es
+
+
+def equipment_benchmark(make, method, watt):
+    state = {}
+
+    def setup():
+        e = make()
+        state['call'] = lambda: getattr(e, method)(watt)
+        del client.messages[:]
+
+    return setup, lambda: state['call']()
+
+
+def constant_on():
+    e = ConstantPowerEquipment('e_bike_charger', 120)
+    e.set_current_power(120)
+    return e
+
+
+def constant_off():
+    e = ConstantPowerEquipment('e_bike_charger', 120)
+    e.set_current_power(0)
+    return e
+
+
+def variable_at(power):
+    def make():
+        e = VariablePowerEquipment('water_heater', 2400)
+        e.set_current_power(power)
+        return e
+    return make
+
+
+def unknown_on():
+    e = UnknownPowerEquipment('plug_1')
+    e.increase_power_by(100)
+    return e
+
+
+def regression_benchmark():
+    powers = [0, 150, 600, 1200, 1800, 2400]
+    state = {'i': 0}
+
+    def setup():
+        e = VariablePowerEquipment('water_heater', 2400)
+        e.set_current_power(0)
+        state['e'] = e
+        state['i'] += 1
+        del client.messages[:]
+
+    return setup, lambda: state['e'].set_current_power(powers[state['i'] % len(powers)])
+
+
+def on_message_benchmark(topic, payload):
+    msg = Message(topic, payload)
+
+    def setup():
+        setup_regulation(balanced_equipments(), 1500, 1600)
+        # evaluate() returns early, only the message processing is measured
+        power_regulation.last_evaluation_date = clock()
+        power_regulation.next_evaluation_date = clock() + power_regulation.EVALUATION_PERIOD
+
+    return setup, lambda: power_regulation.on_message(None, None, msg)
+
+
+def instant_power_benchmark(ticks):
+    state = {}
+    published = []
+
+    def setup():
+        estimator = instant_power.InstantPowerEstimator(published.append, clock, ManualTimer)
+        clock.t = 1556700000
+        estimator.on_indexes(10000, 20000)
+        clock.t += 10
+        state['msg'] = Message('tic/data', json.dumps({'hchc': 10000 + ticks, 'hchp': 20000}).encode())
+        state['estimator'] = estimator
+        del published[:]
+
+    return setup, lambda: instant_power.on_message(None, state['estimator'], state['msg'])
+
+
+BENCHMARKS = [
+    ('evaluate/balanced', lambda: evaluate_scenario(balanced_equipments, 1500, 1550)),
+    ('evaluate/heavy_surplus', lambda: evaluate_scenario(idle_equipments, 300, 4500)),
+    ('evaluate/deficit', lambda: evaluate_scenario(balanced_equipments, 2500, 800)),
+    ('evaluate/recovery_many_loads', lambda: evaluate_scenario(many_loads_equipments, 2300, 2700)),
+    ('evaluate/forced', lambda: evaluate_scenario(forced_equipments, 300, 4500)),
+    ('evaluate/cached_heavy_surplus', lambda: cached_evaluate_scenario(idle_equipments, 300, 4500)),
+    ('evaluate/cached_recovery', lambda: cached_evaluate_scenario(many_loads_equipments, 2300, 2700)),
+    ('constant/increase_off', lambda: equipment_benchmark(constant_off, 'increase_power_by', 500)),
+    ('constant/increase_on', lambda: equipment_benchmark(constant_on, 'increase_power_by', 500)),
+    ('constant/decrease_on', lambda: equipment_benchmark(constant_on, 'decrease_power_by', 50)),
+    ('variable/increase', lambda: equipment_benchmark(variable_at(600), 'increase_power_by', 500)),
+    ('variable/decrease', lambda: equipment_benchmark(variable_at(1200), 'decrease_power_by', 500)),
+    ('variable/decrease_to_off', lambda: equipment_benchmark(variable_at(200), 'decrease_power_by', 100)),
+    ('unknown/decrease_on', lambda: equipment_benchmark(unknown_on, 'decrease_power_by', 100)),
+    ('variable/set_current_power', regression_benchmark),
+    ('on_message/consumption', lambda: on_message_benchmark(
+        power_regulation.TOPIC_SENSOR_CONSUMPTION, b'{"v": 230.1, "i": 6.52, "p": 1500, "e": 1234567}')),
+    ('on_message/production', lambda: on_message_benchmark(
+        power_regulation.TOPIC_SENSOR_PRODUCTION, b'{"v": 230.4, "i": 6.95, "p": 1600, "e": 7654321}')),
+    ('instant_power/on_message', lambda: instant_power_benchmark(3)),
+]
+
+
+def reference_workload():
+    d = {}
+    for k in range(50):
+        d[k] = str(k)
+
+
+def measure_reference():
+    """ Duration of the reference workload in seconds, fastest of SAMPLES loops """
+    times = []
+    gc.disable()
+    for _ in range(SAMPLES):
+        t0 = time.perf_counter()
+        for _ in range(CALLS_PER_SAMPLE):
+            reference_workload()
+        times.append(time.perf_counter() - t0)
+    gc.enable()
+    return min(times) / CALLS_PER_SAMPLE
+
+
+def measure(setup, call):
+    reference = measure_reference()
+    setup_times = []
+    loop_times = []
+    # like timeit, keep the garbage collector out of the timings
+    gc.disable()
+    for _ in range(SAMPLES):
+        t0 = time.perf_counter()
+        for _ in range(CALLS_PER_SAMPLE):
+            setup()
+        t1 = time.perf_counter()
+        for _ in range(CALLS_PER_SAMPLE):
+            setup()
+            call()
+        t2 = time.perf_counter()
+        setup_times.append(t1 - t0)
+        loop_times.append(t2 - t1)
+        gc.collect()
+    gc.enable()
+    timings = sorted(max(0, t - s) / CALLS_PER_SAMPLE for t, s in zip(loop_times, setup_times))
+    # the fastest loops and setups are the least disturbed by the rest of the system
+    fastest = max(0, min(loop_times) - min(setup_times)) / CALLS_PER_SAMPLE
+    reference = (reference + measure_reference()) / 2
+
+    tracemalloc.start()
+    peak = 0
+    retained = 0
+    for _ in range(ALLOCATION_ITERATIONS):
+        setup()
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        call()
+        after, call_peak = tracemalloc.get_traced_memory()
+        peak = max(peak, call_peak - before)
+        retained += after - before
+    tracemalloc.stop()
+
+    return {
+        'min_us': fastest * 1e6,
+        'median_us': timings[len(timings) // 2] * 1e6,
+        'p90_us': timings[int(len(timings) * 0.9)] * 1e6,
+        'reference_us': reference * 1e6,
+        'peak_bytes': peak,
+        'retained_bytes': retained / float(ALLOCATION_ITERATIONS),
+    }
+
+
+def run(name_filter=None):
+    logger.setLevel(logging.WARNING)
+    install_fakes()
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        setup, call = benchmark()
+        results[name] = measure(setup, call)
+        r = results[name]
+        print('{:32} min {:8.2f}us  median {:8.2f}us  p90 {:8.2f}us  peak {:7d}B  retained {:8.1f}B'.format(
+            name, r['min_us'], r['median_us'], r['p90_us'], r['peak_bytes'], r['retained_bytes']))
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'date': time.time(),
+        'results': results,
+    }
+
+
+def regression_flags(b, c, tolerance):
+    """ Return the expected latency of c according to the baseline b and the list of detected regressions """
+    flags = []
+    latency = 'min_us' if 'min_us' in b and 'min_us' in c else 'median_us'
+    expected = b[latency]
+    if 'reference_us' in b and 'reference_us' in c:
+        expected *= c['reference_us'] / b['reference_us']
+    if c[latency] > expected * (1 + tolerance) + LATENCY_SLACK_US:
+        flags.append('latency {:+.0%}'.format(c[latency] / expected - 1))
+    for key in ('peak_bytes', 'retained_bytes'):
+        if c[key] > b[key] * (1 + tolerance) + ALLOCATION_SLACK:
+            flags.append('{} {:.0f} -> {:.0f}'.format(key, b[key], c[key]))
+    return expected, latency, flags
+
+
+def compare(baseline, current, tolerance, remeasure=False):
+    """ Print the comparison of the current results with the baseline ones and return the number of regressions. If
+    remeasure is set, the benchmarks found slower are measured again before being reported. """
+    regressions = 0
+    benchmarks = dict(BENCHMARKS)
+    for name, b in sorted(baseline['results'].items()):
+        c = current['results'].get(name)
+        if c is None:
+            print('{:32} missing'.format(name))
+            continue
+        expected, latency, flags = regression_flags(b, c, tolerance)
+        if remeasure and name in benchmarks:
+            for _ in range(CONFIRMATIONS):
+                if not flags:
+                    break
+                setup, call = benchmarks[name]()
+                c = measure(setup, call)
+                expected, latency, flags = regression_flags(b, c, tolerance)
+            current['results'][name] = c
+        if flags:
+            regressions += 1
+        print('{:32} {:8.2f}us -> {:8.2f}us  {}'.format(name, expected, c[latency],
+                                                      'REGRESSION: ' + ', '.join(flags) if flags else 'ok'))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Regulation hot paths micro-benchmarks')
+    sub = parser.add_subparsers(dest='command')
+    p_run = sub.add_parser('run')
+    p_run.add_argument('--save', help='store the results in this JSON file')
+    p_run.add_argument('--filter', help='only run benchmarks which name contains this string')
+    p_compare = sub.add_parser('compare')
+    p_compare.add_argument('baseline')
+    p_compare.add_argument('current', nargs='?', help='results to compare, run the benchmarks if not given')
+    p_compare.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run(args.filter)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    elif args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if args.current:
+            with open(args.current) as f:
+                current = json.load(f)
+            remeasure = False
+        else:
+            current = run()
+            remeasure = True
+        if compare(baseline, current, args.tolerance, remeasure):
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# The regulation configuration file: MQTT broker and topics, thresholds and the list of equipments by priority order
+# (first one has the higher priority), see config.json. Each equipment is given by its name, its type (variable,
+# constant or unknown) and the parameters of the matching class in equipment.py. The equipment used by the daily low
+# energy fallback is marked with "fallback": true. An optional "decision_cache" object gives the size and quantum of the
+# decision cache (see power_regulation.py).
+#
+# The file is compiled into a Configuration holding the equipment objects and the lookup tables used by the regulation
+# loop. When a configuration is reloaded, equipments whose definition did not change are not rebuilt: the objects of the
+# previous configuration are reused, with their current power, forced state, energy counter and response delay.
+
+import json
+import os
+
+from equipment import ConstantPowerEquipment, UnknownPowerEquipment, VariablePowerEquipment
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+# equipment class and accepted parameters by type, the power of variable and constant equipments is mandatory
+EQUIPMENT_TYPES = {
+    'variable': (VariablePowerEquipment, ('max_power', 'topic')),
+    'constant': (ConstantPowerEquipment,
+                 ('nominal_power', 'min_on_time', 'min_off_time', 'hysteresis_energy', 'topic')),
+    'unknown': (UnknownPowerEquipment, ('min_on_time', 'min_off_time', 'hysteresis_energy')),
+}
+
+# numeric parameters of the equipments, powers must be strictly positive, the other ones positive or zero
+EQUIPMENT_POWERS = ('max_power', 'nominal_power')
+EQUIPMENT_NUMBERS = EQUIPMENT_POWERS + ('min_on_time', 'min_off_time', 'hysteresis_energy')
+
+DEFAULT_TOPICS = {
+    'consumption': 'pzem/0',
+    'production': 'pzem/1',
+    'control': 'regulation/control',
+    'status': 'regulation/status',
+}
+
+
+class Configuration(object):
+    def __init__(self, equipments, fallback, topics=None, margin=None, balance_threshold=None, broker=None,
+                 decision_cache=None, definitions=None, path=None, mtime=None):
+        self.equipments = tuple(equipments)
+        self.fallback = fallback
+        self.equipment_by_name = dict((e.name, e) for e in self.equipments)
+        self.topics = dict(DEFAULT_TOPICS, **(topics or {}))
+        self.margin = margin
+        self.balance_threshold = balance_threshold
+        self.broker = broker
+        self.decision_cache = decision_cache
+        self.definitions = definitions or {}
+        self.path = path
+        self.mtime = mtime
+
+
+def check_number(what, value, positive=False, integer=False):
+    """ Raise a ValueError unless value is a number, greater than or equal to 0 (strictly if positive) """
+    types = (int,) if integer else (int, float)
+    if isinstance(value, bool) or not isinstance(value, types) or value < 0 or (positive and value == 0):
+        raise ValueError('invalid {}: {!r}'.format(what, value))
+
+
+def build_equipment(definition, previous=None):
+    """ Return the equipment described by definition, reusing the one of the previous configuration if unchanged """
+    name = definition.get('name')
+    if not name:
+        raise ValueError('equipment without name: {}'.format(definition))
+    if definition.get('type') not in EQUIPMENT_TYPES:
+        raise ValueError('unknown type for equipment {}: {}'.format(name, definition.get('type')))
+
+    # the fallback mark is not a parameter of the equipment
+    key = dict((k, v) for k, v in definition.items() if k != 'fallback')
+    if previous is not None and previous.definitions.get(name) == key:
+        return previous.equipment_by_name[name]
+
+    cls, parameters = EQUIPMENT_TYPES[definition['type']]
+    unknown = set(definition) - set(parameters) - {'name', 'type', 'fallback'}
+    if unknown:
+        raise ValueError('unknown parameters for equipment {}: {}'.format(name, ', '.join(sorted(unknown))))
+    if parameters[0].endswith('power') and parameters[0] not in definition:
+        raise ValueError('missing {} for equipment {}'.format(parameters[0], name))
+    kwargs = dict((p, definition[p]) for p in parameters if p in definition)
+    for p in EQUIPMENT_NUMBERS:
+        if p in kwargs:
+            check_number('{} for equipment {}'.format(p, name), kwargs[p], positive=p in EQUIPMENT_POWERS)
+    return cls(name, **kwargs)
+
+
+def compile_configuration(data, previous=None, path=None, mtime=None):
+    equipments = []
+    definitions = {}
+    fallback = None
+    for definition in data.get('equipments', ()):
+        e = build_equipment(definition, previous)
+        if e.name in definitions:
+            raise ValueError('duplicate equipment name: {}'.format(e.name))
+        definitions[e.name] = dict((k, v) for k, v in definition.items() if k != 'fallback')
+        equipments.append(e)
+        if definition.get('fallback'):
+            if not isinstance(e, VariablePowerEquipment):
+                raise ValueError('the fallback equipment {} must be a variable power equipment'.format(e.name))
+            fallback = e
+    if fallback is None:
+        raise ValueError('no fallback equipment')
+
+    unknown = set(data.get('topics', {})) - set(DEFAULT_TOPICS)
+    if unknown:
+        raise ValueError('unknown topics: {}'.format(', '.join(sorted(unknown))))
+
+    broker = data.get('broker')
+    if broker is not None:
+        broker = (broker['host'], broker.get('port', 1883))
+
+    for setting in ('margin', 'balance_threshold'):
+        if data.get(setting) is not None:
+            check_number(setting, data[setting])
+
+    decision_cache = data.get('decision_cache')
+    if decision_cache is not None:
+        if set(decision_cache) - {'size', 'quantum'}:
+            raise ValueError('unknown decision cache settings: {}'.format(
+                ', '.join(sorted(set(decision_cache) - {'size', 'quantum'}))))
+        if 'size' in decision_cache:
+            check_number('decision cache size', decision_cache['size'], integer=True)
+        if 'quantum' in decision_cache:
+            check_number('decision cache quantum', decision_cache['quantum'], positive=True)
+
+    return Configuration(equipments, fallback, data.get('topics'), data.get('margin'), data.get('balance_threshold'),
+                         broker, decision_cache, definitions, path, mtime)
+
+
+def modification_date(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def load(path=CONFIG_FILE, previous=None):
+    """ Read and compile the configuration file, raise an exception if it is not valid """
+    mtime = modification_date(path)
+    with open(path) as f:
+        data = json.load(f)
+    return compile_configuration(data, previous, path, mtime)
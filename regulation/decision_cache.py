@@ -0,0 +1,56 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# A bounded LRU cache of the regulation decisions. In steady operation the regulation loop sees the same situations over
+# and over: the same power surplus (once quantized) with the same equipment states. The key is built by the regulation
+# loop from these inputs, the value is the resulting state of each equipment.
+
+import collections
+
+
+class DecisionCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the decision for this key, None if unknown """
+        decision = self.entries.get(key)
+        if decision is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return decision
+
+    def put(self, key, decision):
+        self.entries[key] = decision
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
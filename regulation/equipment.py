@@ -28,6 +28,16 @@ import time
 # - ConstantPowerEquipment: an equipment which load is fixed and known. It can be controlled like a switch.
 #       ConstantPowerEquipment is essentially an optimization of UnknownPowerEquipment as it will allow the regulation
 #       loop to match power consumption and production faster.
+#
+# Switched equipments (ConstantPowerEquipment and UnknownPowerEquipment) can be given a minimum on time, a minimum off
+# time and an hysteresis band expressed in Wh: the power imbalance requesting a switch has to be sustained until its
+# energy reaches the band before the switch happens. This avoids toggling relays on cloudy days. While a constant power
+# equipment waits for its minimum off time or its band, the regulation loop keeps its power away from lower priority
+# equipments, and the power they could give up counts toward the band (see power_regulation.claim_power()). A constant
+# power equipment without minimum off time nor band does not take power from lower priority equipments.
+#
+# Each equipment also keeps its measured response delay: the time between a command and the moment the consumption
+# measurement settles to its new value. The regulation loop uses it to decide when to evaluate again after a command.
 
 from debug import debug as debug
 
@@ -45,16 +55,27 @@ def now_ts():
     return time.time()
 
 
-class Equipment:
-    def __init__(self, name):
+class Equipment(object):
+    # weight of a new measurement in the response delay average
+    RESPONSE_DELAY_SMOOTHING = 0.3
+
+    def __init__(self, name, min_on_time=0, min_off_time=0, hysteresis_energy=0):
         self.name = name
         self.is_forced_ = False
         self.force_end_date = None
         self.energy = 0
         self.current_power = None
         self.last_power_change_date = None
-
-    def decrease_power_by(self, watt):
+        self.min_on_time = min_on_time
+        self.min_off_time = min_off_time
+        self.hysteresis_energy = hysteresis_energy
+        self.last_switch_date = None
+        self.pending_direction = None
+        self.pending_energy = 0
+        self.pending_date = None
+        self.response_delay = None
+
+    def decrease_power_by(self, watt, use_hysteresis=True):
         """ Return the amount of power that has been canceled, None if unknown """
         # implement in subclasses
         pass
@@ -76,6 +97,53 @@ class Equipment:
     def get_current_power(self):
         return self.current_power
 
+    def get_freeable_power(self):
+        """ Return the power that could be canceled right now, None if unknown """
+        return self.current_power
+
+    def get_state(self):
+        """ The state resulting from the regulation decisions, which can be restored with set_state() """
+        return self.current_power
+
+    def set_state(self, state):
+        self.set_current_power(state)
+
+    def can_switch_on(self):
+        return self.last_switch_date is None or now_ts() - self.last_switch_date >= self.min_off_time
+
+    def can_switch_off(self):
+        return self.last_switch_date is None or now_ts() - self.last_switch_date >= self.min_on_time
+
+    def switched(self):
+        self.last_switch_date = now_ts()
+        self.pending_direction = None
+
+    def hysteresis_reached(self, direction, watt):
+        """ Accumulate the energy of the imbalance requesting a switch in the given direction ('on' or 'off') and
+        return True once it reaches the hysteresis band """
+        if self.hysteresis_energy <= 0:
+            return True
+        t = now_ts()
+        if self.pending_direction != direction:
+            self.pending_direction = direction
+            self.pending_energy = 0
+        else:
+            self.pending_energy += watt * (t - self.pending_date) / 3600.0
+        self.pending_date = t
+        return self.pending_energy >= self.hysteresis_energy
+
+    def update_response_delay(self, delay):
+        if self.response_delay is None:
+            self.response_delay = delay
+        else:
+            k = Equipment.RESPONSE_DELAY_SMOOTHING
+            self.response_delay = (1 - k) * self.response_delay + k * delay
+
+    def discard_stale_hysteresis(self, since):
+        """ Forget the accumulated imbalance if it has not been confirmed since the given date """
+        if self.pending_direction is not None and self.pending_date < since:
+            self.pending_direction = None
+
     def force(self, watt, duration=None):
         """ Force this equipment to the specified power in watt, for a given duration in seconds (None=forever)"""
         # implement in subclasses, watt may be ignored
@@ -108,17 +176,26 @@ class Equipment:
         return previous_energy
 
 
-class VariablePowerEquipment(object, Equipment):
+class VariablePowerEquipment(Equipment):
     MINIMUM_POWER = 150
     MINIMUM_PERCENT = 4
 
-    def __init__(self, name, max_power):
+    def __init__(self, name, max_power, topic='scr/0/in'):
         Equipment.__init__(self, name)
         self.max_power = max_power
+        self.topic = topic
 
     def set_current_power(self, power):
         super(VariablePowerEquipment, self).set_current_power(power)
 
+        percent = VariablePowerEquipment.power_to_percent(self.current_power, self.max_power)
+
+        if _send_commands:
+            _mqtt_client.publish(self.topic, str(percent))
+        debug(4, "sending power command {}W ({}%) for {}".format(self.current_power, percent, self.name))
+
+    @staticmethod
+    def power_to_percent(power, max_power):
         # regression factors computed from the response measurement of the SCR regulator
         a=1156.7360635374
         b=-2733.09296216279
@@ -128,10 +205,10 @@ class VariablePowerEquipment(object, Equipment):
         f=-0.010002294517421
         g=11.3205979917473
 
-        if self.current_power == 0:
+        if power == 0:
             percent = 0
         else:
-            z = self.current_power / float(self.max_power)
+            z = power / float(max_power)
             percent = g + f/z + e*z + d*z*z + c*z*z*z + b*z*z*z*z + a*z*z*z*z*z
 
         # issue with the regulator, don't go below 4
@@ -140,11 +217,9 @@ class VariablePowerEquipment(object, Equipment):
         if percent > 100:
             percent = 100
 
-        if _send_commands:
-            _mqtt_client.publish('scr/0/in', str(percent))
-        debug(4, "sending power command {}W ({}%) for {}".format(self.current_power, percent, self.name))
+        return percent
 
-    def decrease_power_by(self, watt):
+    def decrease_power_by(self, watt, use_hysteresis=True):
         if watt >= self.current_power:
             decrease = self.current_power
         else:
@@ -194,22 +269,37 @@ class VariablePowerEquipment(object, Equipment):
         self.set_current_power(0 if watt is None else watt)
 
 
-class ConstantPowerEquipment(object, Equipment):
-    def __init__(self, name, nominal_power):
-        Equipment.__init__(self, name)
+class ConstantPowerEquipment(Equipment):
+    def __init__(self, name, nominal_power, min_on_time=0, min_off_time=0, hysteresis_energy=0,
+                 topic='wifi_plug/0/in'):
+        Equipment.__init__(self, name, min_on_time, min_off_time, hysteresis_energy)
         self.nominal_power = nominal_power
+        self.topic = topic
         self.is_on = False
 
     def set_current_power(self, power):
         super(ConstantPowerEquipment, self).set_current_power(power)
+        if self.is_on != (power != 0):
+            self.switched()
         self.is_on = power != 0
         msg = '1' if self.is_on else '0'
         if _send_commands:
-            _mqtt_client.publish('wifi_plug/0/in', msg, retain=True)
+            _mqtt_client.publish(self.topic, msg, retain=True)
         debug(4, "sending power command {} for {}".format(self.is_on, self.name))
 
-    def decrease_power_by(self, watt):
+    def get_freeable_power(self):
+        if self.is_on and not self.can_switch_off():
+            return 0
+        return self.current_power
+
+    def decrease_power_by(self, watt, use_hysteresis=True):
         if self.is_on:
+            if not self.can_switch_off():
+                debug(4, "keeping {} on because its minimum on time of {}s is not reached".format(self.name, self.min_on_time))
+                return 0
+            if use_hysteresis and not self.hysteresis_reached('off', watt):
+                debug(4, "keeping {} on until the hysteresis band of {}Wh is reached".format(self.name, self.hysteresis_energy))
+                return 0
             debug(4, "shutting down {} with a consumption of {}W to recover {}W".format(self.name, self.nominal_power, watt))
             self.set_current_power(0)
             return self.nominal_power
@@ -223,6 +313,12 @@ class ConstantPowerEquipment(object, Equipment):
             return watt
         else:
             if watt >= self.nominal_power:
+                if not self.can_switch_on():
+                    debug(4, "keeping {} off because its minimum off time of {}s is not reached".format(self.name, self.min_off_time))
+                    return watt
+                if not self.hysteresis_reached('on', watt):
+                    debug(4, "keeping {} off until the hysteresis band of {}Wh is reached".format(self.name, self.hysteresis_energy))
+                    return watt
                 debug(4, "turning on {} with a consumption of {}W to use {}W".format(self.name, self.nominal_power, watt))
                 self.set_current_power(self.nominal_power)
                 return watt - self.nominal_power
@@ -239,17 +335,31 @@ class ConstantPowerEquipment(object, Equipment):
 
 
 class UnknownPowerEquipment(Equipment):
-    def __init__(self, name):
-        Equipment.__init__(self, name)
+    def __init__(self, name, min_on_time=0, min_off_time=0, hysteresis_energy=0):
+        Equipment.__init__(self, name, min_on_time, min_off_time, hysteresis_energy)
         self.is_on = False
 
     def send_power_command(self):
         debug(4, "sending power command {} for {}".format(self.is_on, self.name))
         pass
 
-    def decrease_power_by(self, watt):
+    def get_state(self):
+        return self.is_on
+
+    def set_state(self, state):
+        self.is_on = state
+        self.switched()
+
+    def decrease_power_by(self, watt, use_hysteresis=True):
         if self.is_on:
+            if not self.can_switch_off():
+                debug(4, "keeping {} on because its minimum on time of {}s is not reached".format(self.name, self.min_on_time))
+                return 0
+            if use_hysteresis and not self.hysteresis_reached('off', watt):
+                debug(4, "keeping {} on until the hysteresis band of {}Wh is reached".format(self.name, self.hysteresis_energy))
+                return 0
             self.is_on = False
+            self.switched()
             debug(4, "shutting down {} with an unknown consumption to recover {}W".format(self.name, watt))
             return None
         else:
@@ -261,12 +371,21 @@ class UnknownPowerEquipment(Equipment):
             debug(4, "{} with an unknown power is already on".format(self.name))
             return watt
         else:
+            if not self.can_switch_on():
+                debug(4, "keeping {} off because its minimum off time of {}s is not reached".format(self.name, self.min_off_time))
+                return watt
+            if not self.hysteresis_reached('on', watt):
+                debug(4, "keeping {} off until the hysteresis band of {}Wh is reached".format(self.name, self.hysteresis_energy))
+                return watt
             self.is_on = True
+            self.switched()
             debug(4, "turning on {} with an unknown consumption use {}W".format(self.name, watt))
             return None
 
     def force(self, watt, duration=None):
         super(UnknownPowerEquipment, self).force(watt, duration)
+        if self.is_on != (watt is not None):
+            self.switched()
         if watt is None:
             self.is_on = False
             self.set_current_power(0)
@@ -0,0 +1,886 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Sharded regulation of many sites: a coordinator assigns the sites to worker processes, possibly on several machines,
+# each worker evaluating its sites with a batch engine (see batch.py).
+#
+# Sites are assigned by consistent hashing of their identifier on a ring of VIRTUAL_NODES points per worker, so that a
+# worker joining or leaving only moves the sites it takes or gives. A moved site keeps its live state: equipment powers,
+# forced states and their deadlines, dwell times, hysteresis, energy counters and energy_yesterday. No command is sent
+# during the move, the loads keep running. Rebalancing happens between two ticks.
+#
+# The coordinator talks to the workers with multiprocessing.connection, a tick is sent to all workers before collecting
+# the results so that they evaluate their sites in parallel. In MQTT mode, the coordinator receives the PZEM messages of
+# every site on site/<id>/pzem/0 and site/<id>/pzem/1, force commands on site/<id>/regulation/control, and publishes the
+# commands on site/<id>/<equipment topic>. Workers join a running coordinator with {"command": "join", "worker":
+# "host:port"} on fleet/control ({"command": "join"} starts a local worker) and leave it with {"command": "leave",
+# "worker": name}, the name of a remote worker being its host:port. These are applied between two ticks.
+#
+# Workers compute local hours with time.localtime(), all machines must use the same time zone. A worker which stops
+# without leaving the fleet loses the state of its sites: the coordinator drops it when its link breaks and gives its
+# sites to the other workers with their initial state (all equipments at 0W). A worker drops its sites when its
+# coordinator disconnects, a restarted coordinator adds them again with their initial state.
+#
+# Usage:
+#   fleet.py worker --listen 0.0.0.0:7000 --authkey secret   a worker for a remote coordinator
+#   fleet.py verify [--sites 300]        check that decisions and states match a single batch engine through rebalancing
+#   fleet.py bench [--workers 4]         throughput with 1 to N local workers
+#   fleet.py coordinator --broker 192.168.1.7:1883 --sites fleet_sites.json [--worker host1:7000 --authkey secret]
+#                                        regulate the sites of the definitions file on real time
+#   fleet.py mqtt [--sites 200]          run against the local broker stand-in with simulated sites, on virtual time
+#   fleet.py mqtt --worker host1:7000 --worker host2:7000 --authkey secret   the same with remote workers
+
+import argparse
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+from multiprocessing.connection import Client, Listener
+import os
+import random
+import signal
+import threading
+import time
+
+import numpy as np
+
+import batch
+from batch import BatchEngine
+import config
+from debug import debug as debug
+from debug import logger
+import equipment
+from equipment import VariablePowerEquipment
+from power_regulation import EVALUATION_PERIOD
+
+# Points of each worker on the hash ring, more points give a more even distribution
+VIRTUAL_NODES = 64
+
+# MQTT topics of the sites, relative to site/<id>/
+TOPIC_SITE_PREFIX = 'site/'
+TOPIC_SENSOR_CONSUMPTION = 'pzem/0'
+TOPIC_SENSOR_PRODUCTION = 'pzem/1'
+TOPIC_REGULATION_CONTROL = 'regulation/control'
+# workers joining and leaving the fleet of a running coordinator
+TOPIC_FLEET_CONTROL = 'fleet/control'
+
+# The coordinator ticks every N seconds, each site being evaluated at most every EVALUATION_PERIOD
+COORDINATOR_TICK_PERIOD = 1
+
+# Errors of a broken link with a worker, the worker is considered lost
+LINK_ERRORS = (EOFError, OSError)
+
+
+class HashRing(object):
+    def __init__(self, replicas=VIRTUAL_NODES):
+        self.replicas = replicas
+        self.points = []
+        self.nodes = {}
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def add(self, node):
+        for r in range(self.replicas):
+            h = HashRing.hash('{}#{}'.format(node, r))
+            self.nodes[h] = node
+            bisect.insort(self.points, h)
+
+    def remove(self, node):
+        self.points = [h for h in self.points if self.nodes[h] != node]
+        self.nodes = dict((h, n) for h, n in self.nodes.items() if n != node)
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.points, HashRing.hash(key)) % len(self.points)
+        return self.nodes[self.points[i]]
+
+
+class Worker(object):
+    """ The sites of a worker process, in the order of the rows of its batch engine """
+
+    def __init__(self):
+        self.engine = BatchEngine()
+        self.site_ids = []
+        self.rows = {}
+
+    def handle(self, message):
+        command = message[0]
+        if command == 'tick':
+            _, consumption, production, now = message
+            start = time.process_time()
+            rows, slots = self.engine.tick(consumption, production, now)
+            changes = [(self.site_ids[i], j, self.engine.topics[i][j], self.engine.command_payload(i, j))
+                       for i, j in zip(rows.tolist(), slots.tolist())]
+            return changes, time.process_time() - start
+        elif command == 'add':
+            # with send_commands, the commands setting every equipment to the power of its state are returned
+            _, site_ids, states, send_commands = message
+            duplicates = sorted(set(s for s in site_ids if s in self.rows or site_ids.count(s) > 1))
+            if duplicates:
+                raise ValueError('sites already on this worker: {}'.format(', '.join(duplicates)))
+            rows = self.engine.add_sites(states)
+            self.site_ids += site_ids
+            self.rows = dict((s, i) for i, s in enumerate(self.site_ids))
+            if send_commands:
+                return [(self.site_ids[i], j, self.engine.topics[i][j], self.engine.command_payload(i, j))
+                        for i in rows for j in range(len(self.engine.names[i]))]
+        elif command == 'remove':
+            _, site_ids = message
+            states = self.engine.remove_sites([self.rows[s] for s in site_ids])
+            removed = set(site_ids)
+            self.site_ids = [s for s in self.site_ids if s not in removed]
+            self.rows = dict((s, i) for i, s in enumerate(self.site_ids))
+            return states
+        elif command == 'export':
+            _, site_ids = message
+            return self.engine.export_sites([self.rows[s] for s in site_ids])
+        elif command == 'force':
+            _, site_id, name, watt, duration, now = message
+            i = self.rows[site_id]
+            j = self.engine.names[i].index(name)
+            self.engine.force(i, j, watt, duration, now)
+            # like Equipment.force(), the command is sent right away
+            return site_id, j, self.engine.topics[i][j], self.engine.command_payload(i, j)
+        else:
+            raise ValueError('unknown command: {}'.format(command))
+
+
+def serve(address, authkey, ready=None):
+    """ Run a worker: accept a coordinator connection and handle its requests until it sends 'stop'. Each connection
+    starts with no site, a new coordinator adds its sites again. """
+    listener = Listener(address, authkey=authkey)
+    if ready is not None:
+        ready.send(listener.address)
+        ready.close()
+    debug(0, 'worker listening on {}:{}'.format(*listener.address))
+    while True:
+        conn = listener.accept()
+        worker = Worker()
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'stop':
+                    conn.send(None)
+                    conn.close()
+                    listener.close()
+                    return
+                try:
+                    result = worker.handle(message)
+                except Exception as e:
+                    # the coordinator raises it again
+                    debug(0, e)
+                    result = e
+                conn.send(result)
+        except (EOFError, OSError):
+            debug(0, 'coordinator disconnected, {} sites dropped'.format(len(worker.site_ids)))
+            conn.close()
+
+
+def serve_local(address, authkey, ready):
+    # a local worker is stopped by its coordinator, which also receives the interruptions of the terminal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve(address, authkey, ready)
+
+
+def start_local_worker(authkey):
+    """ Start a worker process listening on a local port, return the process and its address """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve_local, args=(('127.0.0.1', 0), authkey, child))
+    process.daemon = True
+    process.start()
+    address = parent.recv()
+    parent.close()
+    return process, address
+
+
+class WorkerLink(object):
+    def __init__(self, name, conn, process=None):
+        self.name = name
+        self.conn = conn
+        self.process = process
+        # the sites of the worker in the order of its rows, and their indexes in the fleet measurement arrays
+        self.site_ids = []
+        self.rows = np.zeros(0, int)
+
+    def request(self, *message):
+        self.conn.send(message)
+        return self.receive()
+
+    def receive(self):
+        result = self.conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class Fleet(object):
+    """ The coordinator: owns the hash ring, the site assignment and the last measurements of every site """
+
+    def __init__(self, replicas=VIRTUAL_NODES):
+        self.ring = HashRing(replicas)
+        self.workers = {}
+        self.owners = {}
+        self.index = {}
+        self.consumption = np.zeros(0)
+        self.production = np.zeros(0)
+        self.moved = 0
+        self.last_tick_times = {}
+        # the state of the sites when they have been added, and the sites waiting for a worker after a worker loss
+        self.initial_states = {}
+        self.unassigned = []
+        # the commands of the sites restarted from their initial state, returned by the next tick
+        self.restart_commands = []
+
+    def join(self, name, address, authkey, process=None):
+        """ Add a worker and move to it the sites it now owns """
+        if name in self.workers:
+            raise ValueError('worker {} already in the fleet'.format(name))
+        conn = Client(address, authkey=authkey)
+        self.workers[name] = WorkerLink(name, conn, process)
+        self.ring.add(name)
+        moves = collections.defaultdict(list)
+        for site_id, owner in self.owners.items():
+            if self.ring.owner(site_id) == name:
+                moves[owner].append(site_id)
+        for owner, site_ids in moves.items():
+            self._move(self.workers[owner], self.workers[name], site_ids)
+        debug(0, 'worker {} joined, {} sites moved to it'.format(name, sum(len(s) for s in moves.values())))
+        self._reassign()
+
+    def leave(self, name):
+        """ Move the sites of a worker to their new owners and stop it """
+        if name not in self.workers:
+            raise ValueError('unknown worker: {}'.format(name))
+        link = self.workers[name]
+        if link.site_ids and len(self.workers) == 1:
+            raise ValueError('the last worker can not leave while it has sites')
+        try:
+            states = link.request('remove', link.site_ids)
+        except LINK_ERRORS:
+            # already lost, its sites restart from their initial state
+            self._lose(name)
+            self._reassign()
+            return
+        del self.workers[name]
+        self.ring.remove(name)
+        self.last_tick_times.pop(name, None)
+        moves = collections.defaultdict(lambda: ([], []))
+        for site_id, state in zip(link.site_ids, states):
+            ids, owner_states = moves[self.ring.owner(site_id)]
+            ids.append(site_id)
+            owner_states.append(state)
+        lost = []
+        for owner, (ids, owner_states) in moves.items():
+            try:
+                self._assign(self.workers[owner], ids, owner_states)
+                self.moved += len(ids)
+            except LINK_ERRORS:
+                # these sites restart from their initial state with the ones of the lost owner
+                for site_id in ids:
+                    del self.owners[site_id]
+                self.unassigned += ids
+                lost.append(owner)
+        for owner in lost:
+            self._lose(owner)
+        self._reassign()
+        try:
+            link.request('stop')
+        except LINK_ERRORS:
+            pass
+        link.conn.close()
+        if link.process is not None:
+            link.process.join()
+        debug(0, 'worker {} left, {} sites moved'.format(name, len(link.site_ids)))
+
+    def _lose(self, name):
+        """ Drop a worker which link is broken, its sites wait for a new owner """
+        link = self.workers.pop(name)
+        self.ring.remove(name)
+        self.last_tick_times.pop(name, None)
+        link.conn.close()
+        if link.process is not None:
+            link.process.terminate()
+            link.process.join()
+        for site_id in link.site_ids:
+            del self.owners[site_id]
+        self.unassigned += link.site_ids
+        debug(0, 'worker {} lost with {} sites'.format(name, len(link.site_ids)))
+
+    def _reassign(self):
+        """ Give the sites of the lost workers to their new owners, with their initial state """
+        while self.unassigned and self.workers:
+            by_owner = collections.defaultdict(list)
+            for site_id in self.unassigned:
+                by_owner[self.ring.owner(site_id)].append(site_id)
+            self.unassigned = []
+            for owner, site_ids in by_owner.items():
+                try:
+                    self.restart_commands += self._assign(self.workers[owner], site_ids,
+                                                          [self.initial_states[s] for s in site_ids], True)
+                except LINK_ERRORS:
+                    self.unassigned += site_ids
+                    self._lose(owner)
+                else:
+                    debug(0, '{} sites restarted on worker {}'.format(len(site_ids), owner))
+        if self.unassigned:
+            debug(0, 'no worker left, {} sites not regulated'.format(len(self.unassigned)))
+
+    def _move(self, source, destination, site_ids):
+        states = source.request('remove', site_ids)
+        self._forget(source, site_ids)
+        try:
+            self._assign(destination, site_ids, states)
+        except LINK_ERRORS:
+            # the sites restart from their initial state once the destination is found lost
+            for site_id in site_ids:
+                del self.owners[site_id]
+            self.unassigned += site_ids
+            raise
+        self.moved += len(site_ids)
+
+    def _forget(self, link, site_ids):
+        removed = set(site_ids)
+        keep = [i for i, s in enumerate(link.site_ids) if s not in removed]
+        link.site_ids = [link.site_ids[i] for i in keep]
+        link.rows = link.rows[keep]
+
+    def _assign(self, link, site_ids, states, send_commands=False):
+        commands = link.request('add', site_ids, states, send_commands)
+        link.site_ids += site_ids
+        link.rows = np.concatenate((link.rows, [self.index[s] for s in site_ids])).astype(int)
+        for site_id in site_ids:
+            self.owners[site_id] = link.name
+        return commands
+
+    def add_sites(self, site_ids, states):
+        """ Add new sites given by their state (see batch.site_state()). Return the commands setting their equipments
+        to the power of this state as (site id, slot, topic, payload): the actual loads keep their last command until
+        then. """
+        for site_id in site_ids:
+            if site_id in self.index:
+                raise ValueError('site {} already in the fleet'.format(site_id))
+            self.index[site_id] = len(self.index)
+        self.initial_states.update(zip(site_ids, states))
+        self.consumption = np.concatenate((self.consumption, np.full(len(site_ids), np.nan)))
+        self.production = np.concatenate((self.production, np.full(len(site_ids), np.nan)))
+        by_owner = collections.defaultdict(lambda: ([], []))
+        for site_id, state in zip(site_ids, states):
+            ids, owner_states = by_owner[self.ring.owner(site_id)]
+            ids.append(site_id)
+            owner_states.append(state)
+        commands = []
+        for owner, (ids, owner_states) in by_owner.items():
+            commands += self._assign(self.workers[owner], ids, owner_states, True)
+        return commands
+
+    def set_measurements(self, consumption, production):
+        """ Measurements of all sites, in the order they have been added (NaN when unknown) """
+        self.consumption[:] = consumption
+        self.production[:] = production
+
+    def measure(self, site_id, consumption=None, production=None):
+        i = self.index[site_id]
+        if consumption is not None:
+            self.consumption[i] = consumption
+        if production is not None:
+            self.production[i] = production
+
+    def force(self, site_id, name, watt, duration, now):
+        """ Force an equipment of a site, return its command as (site id, slot, topic, payload) """
+        if site_id not in self.owners:
+            raise ValueError('site {} has no worker'.format(site_id))
+        owner = self.owners[site_id]
+        try:
+            return self.workers[owner].request('force', site_id, name, watt, duration, now)
+        except LINK_ERRORS:
+            self._lose(owner)
+            self._reassign()
+            raise ValueError('the worker of site {} has been lost'.format(site_id))
+
+    def export(self, site_ids):
+        states = {}
+        by_owner = collections.defaultdict(list)
+        for site_id in site_ids:
+            by_owner[self.owners[site_id]].append(site_id)
+        for owner, ids in by_owner.items():
+            states.update(zip(ids, self.workers[owner].request('export', ids)))
+        return states
+
+    def tick(self, now):
+        """ Evaluate all sites, return the commands as (site id, slot, topic, payload), including the ones of the sites
+        restarted from their initial state since the last tick """
+        links = []
+        lost = []
+        for link in self.workers.values():
+            try:
+                link.conn.send(('tick', self.consumption[link.rows], self.production[link.rows], now))
+                links.append(link)
+            except LINK_ERRORS:
+                lost.append(link.name)
+        changes = []
+        for link in links:
+            try:
+                worker_changes, elapsed = link.receive()
+            except LINK_ERRORS:
+                lost.append(link.name)
+                continue
+            changes += worker_changes
+            self.last_tick_times[link.name] = elapsed
+        # the sites of the lost workers are evaluated again from the next tick
+        for name in lost:
+            self._lose(name)
+        self._reassign()
+        restart_commands, self.restart_commands = self.restart_commands, []
+        return restart_commands + changes
+
+    def stop(self):
+        for name in list(self.workers):
+            link = self.workers.pop(name)
+            try:
+                link.request('stop')
+            except LINK_ERRORS:
+                debug(0, 'worker {} lost before stopping'.format(name))
+                if link.process is not None:
+                    link.process.terminate()
+            link.conn.close()
+            if link.process is not None:
+                link.process.join()
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def start_local_fleet(n_workers, authkey):
+    fleet = Fleet()
+    for k in range(n_workers):
+        process, address = start_local_worker(authkey)
+        fleet.join('w{}'.format(k), address, authkey, process)
+    return fleet
+
+
+def connect_fleet(addresses, authkey):
+    """ A fleet of remote workers given by their host:port, started with fleet.py worker """
+    fleet = Fleet()
+    for address in addresses:
+        fleet.join(address, parse_address(address), authkey)
+    return fleet
+
+
+def initial_states(sites, fallbacks, now):
+    """ The states of the given sites (lists of equipments) with all their equipments set to 0W at the given date """
+    from replay import VirtualClock
+
+    saved = equipment.now_ts
+    equipment.now_ts = VirtualClock(now)
+    equipment.setup(None, False)
+    try:
+        for site in sites:
+            for e in site:
+                e.set_current_power(0)
+        return [batch.site_state(site, fallback) for site, fallback in zip(sites, fallbacks)]
+    finally:
+        equipment.now_ts = saved
+
+
+def random_states(rnd, n_sites, now):
+    """ Random sites (see batch.random_site()) with all their equipments set to 0W at the given date """
+    sites = [batch.random_site(rnd, i) for i in range(n_sites)]
+    fallbacks = [[e for e in site if isinstance(e, VariablePowerEquipment)][0] for site in sites]
+    return ['site{}'.format(i) for i in range(n_sites)], initial_states(sites, fallbacks, now)
+
+
+def load_sites(path, now):
+    """ Read the site definitions file, see fleet_sites.json, and return the site identifiers and their states with
+    all equipments at 0W. Raise an exception if it is not valid. """
+    with open(path) as f:
+        data = json.load(f)
+    site_ids = []
+    sites = []
+    fallbacks = []
+    for definition in data.get('sites', ()):
+        site_id = definition.get('id')
+        if not site_id or '/' in site_id:
+            raise ValueError('invalid site identifier: {}'.format(site_id))
+        if site_id in site_ids:
+            raise ValueError('duplicate site identifier: {}'.format(site_id))
+        unknown = set(definition) - {'id', 'equipments'}
+        if unknown:
+            raise ValueError('unknown settings for site {}: {}'.format(site_id, ', '.join(sorted(unknown))))
+        try:
+            configuration = config.compile_configuration({'equipments': definition.get('equipments', ())})
+        except ValueError as e:
+            raise ValueError('site {}: {}'.format(site_id, e))
+        site_ids.append(site_id)
+        sites.append(configuration.equipments)
+        fallbacks.append(configuration.fallback)
+    return site_ids, initial_states(sites, fallbacks, now)
+
+
+def same_state(a, b):
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
+
+def verify(n_sites, seed):
+    """ Run the corpus of batch.verify() through a fleet which workers join and leave, and through a single batch
+    engine, comparing the commands and the site states """
+    rnd = random.Random(seed)
+    start = time.mktime((2019, 5, 1, 0, 0, 0, 0, 0, -1))
+    site_ids, states = random_states(rnd, n_sites, start)
+    authkey = os.urandom(16)
+
+    reference = BatchEngine()
+    reference.add_sites(states)
+    fleet = start_local_fleet(2, authkey)
+    fleet.add_sites(site_ids, states)
+
+    dates = batch.corpus_dates(rnd, start)
+    joins = {len(dates) // 4: ('join', 'w2'), len(dates) // 2: ('leave', 'w0'), 3 * len(dates) // 4: ('join', 'w3')}
+    mismatches = 0
+    commands = 0
+    for k, t in enumerate(dates):
+        if k in joins:
+            before = fleet.export(site_ids)
+            action, name = joins[k]
+            if action == 'join':
+                process, address = start_local_worker(authkey)
+                fleet.join(name, address, authkey, process)
+            else:
+                fleet.leave(name)
+            after = fleet.export(site_ids)
+            moved = [s for s in site_ids if not same_state(before[s], after[s])]
+            print('{} {}: {} sites moved in total, {} states changed by the move'.format(
+                action, name, fleet.moved, len(moved)))
+            mismatches += len(moved)
+
+        consumption = np.array([rnd.randint(100, 4000) for _ in site_ids], float)
+        production = np.array([rnd.randint(0, 5000) for _ in site_ids], float)
+        if rnd.random() < 0.1:
+            i = rnd.randrange(n_sites)
+            j = rnd.randrange(len(states[i]['names']))
+            watt = rnd.choice((None, 0, 100, 2000))
+            duration = rnd.choice((None, 5, 30))
+            reference.force(i, j, watt, duration, t)
+            fleet.force(site_ids[i], states[i]['names'][j], watt, duration, t)
+
+        rows, slots = reference.tick(consumption, production, t)
+        expected = set((site_ids[i], j, reference.command_payload(i, j)) for i, j in zip(rows.tolist(), slots.tolist()))
+        fleet.set_measurements(consumption, production)
+        changes = set((site_id, j, payload) for site_id, j, _, payload in fleet.tick(t))
+        commands += len(expected)
+        if changes != expected:
+            mismatches += len(changes ^ expected)
+
+    final = fleet.export(site_ids)
+    for i, state in enumerate(reference.export_sites(range(n_sites))):
+        if not same_state(state, final[site_ids[i]]):
+            mismatches += 1
+    fleet.stop()
+    print('{} sites, {} commands compared, {} mismatches'.format(n_sites, commands, mismatches))
+    return mismatches
+
+
+def bench(n_sites, max_workers, ticks, seed):
+    rnd = random.Random(seed)
+    start = time.mktime((2019, 5, 1, 12, 0, 0, 0, 0, -1))
+    site_ids, states = random_states(rnd, n_sites, start)
+    authkey = os.urandom(16)
+    np_rnd = np.random.RandomState(seed)
+    reference = None
+    for n_workers in range(1, max_workers + 1):
+        fleet = start_local_fleet(n_workers, authkey)
+        fleet.add_sites(site_ids, states)
+        elapsed = 0
+        critical = 0
+        for k in range(ticks):
+            fleet.set_measurements(np_rnd.randint(100, 4000, n_sites), np_rnd.randint(0, 5000, n_sites))
+            t0 = time.perf_counter()
+            fleet.tick(start + k * EVALUATION_PERIOD)
+            tick_time = time.perf_counter() - t0
+            elapsed += tick_time
+            # with one core per worker, a tick lasts as long as the slowest worker (CPU time) plus the coordinator and
+            # transfer overhead
+            compute = fleet.last_tick_times.values()
+            critical += tick_time - sum(compute) + max(compute)
+        fleet.stop()
+        throughput = n_sites * ticks / elapsed
+        projected = n_sites * ticks / critical
+        if reference is None:
+            reference = projected
+        print('{} workers: {:.0f} sites/s measured, {:.0f} sites/s with one core per worker (x{:.2f})'.format(
+            n_workers, throughput, projected, projected / reference))
+    print('{} cores available'.format(multiprocessing.cpu_count()))
+
+
+class MqttFrontend(object):
+    """ Feed the fleet with the PZEM and control messages of the sites, publish the resulting commands. Workers join
+    and leave with the messages of TOPIC_FLEET_CONTROL, authenticated with authkey. """
+
+    def __init__(self, fleet, host, port, authkey=None):
+        import paho.mqtt.client as mqtt
+
+        self.fleet = fleet
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.forces = []
+        self.fleet_commands = []
+        self.published = 0
+        self.connected = threading.Event()
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+        # commands published before the connection would be lost
+        if not self.connected.wait(10):
+            raise RuntimeError('no connection to the MQTT broker {}:{}'.format(host, port))
+
+    def on_connect(self, client, userdata, flags, rc):
+        for topic in (TOPIC_SENSOR_CONSUMPTION, TOPIC_SENSOR_PRODUCTION, TOPIC_REGULATION_CONTROL):
+            client.subscribe(TOPIC_SITE_PREFIX + '+/' + topic)
+        client.subscribe(TOPIC_FLEET_CONTROL)
+        self.connected.set()
+
+    def on_message(self, client, userdata, msg):
+        # a malformed message of a site is ignored, an exception would stop the network thread for all sites
+        try:
+            j = json.loads(msg.payload.decode())
+            if msg.topic == TOPIC_FLEET_CONTROL:
+                if j['command'] not in ('join', 'leave') or (j['command'] == 'leave' and not j.get('worker')):
+                    raise ValueError('invalid fleet command')
+                with self.lock:
+                    # applied by the next tick, in the coordinator thread
+                    self.fleet_commands.append((j['command'], j.get('worker')))
+                return
+            site_id, topic = msg.topic[len(TOPIC_SITE_PREFIX):].split('/', 1)
+            with self.lock:
+                if site_id not in self.fleet.index:
+                    return
+                if topic == TOPIC_SENSOR_CONSUMPTION:
+                    self.fleet.measure(site_id, consumption=int(j['p']))
+                elif topic == TOPIC_SENSOR_PRODUCTION:
+                    self.fleet.measure(site_id, production=int(j['p']))
+                elif topic == TOPIC_REGULATION_CONTROL and j['command'] in ('force', 'unforce'):
+                    # applied by the next tick, in the coordinator thread
+                    self.forces.append((site_id, j['name'], j.get('power') if j['command'] == 'force' else None,
+                                        j.get('duration')))
+        except Exception as e:
+            debug(0, 'ignoring message on {}: {!r}'.format(msg.topic, e))
+
+    def join(self, worker=None):
+        """ Add the remote worker given by its host:port, or a new local worker """
+        if self.authkey is None:
+            raise ValueError('no authentication key for the workers')
+        if worker is None:
+            process, address = start_local_worker(self.authkey)
+            k = 0
+            while 'w{}'.format(k) in self.fleet.workers:
+                k += 1
+            self.fleet.join('w{}'.format(k), address, self.authkey, process)
+        else:
+            self.fleet.join(worker, parse_address(worker), self.authkey)
+
+    def tick(self, now):
+        with self.lock:
+            fleet_commands, self.fleet_commands = self.fleet_commands, []
+            for command, worker in fleet_commands:
+                try:
+                    if command == 'join':
+                        self.join(worker)
+                    else:
+                        self.fleet.leave(worker)
+                except Exception as e:
+                    debug(0, 'ignoring fleet command {} {}: {!r}'.format(command, worker, e))
+            forces, self.forces = self.forces, []
+            changes = []
+            for site_id, name, watt, duration in forces:
+                try:
+                    changes.append(self.fleet.force(site_id, name, watt, duration, now))
+                except ValueError as e:
+                    debug(0, 'ignoring force command for site {}: {}'.format(site_id, e))
+            changes += self.fleet.tick(now)
+        self.publish(changes)
+        return changes
+
+    def publish(self, changes):
+        """ Publish commands given as (site id, slot, topic, payload) """
+        for site_id, _, topic, payload in changes:
+            if topic is not None:
+                self.client.publish(TOPIC_SITE_PREFIX + site_id + '/' + topic, payload)
+                self.published += 1
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def run_coordinator(broker, sites_path, n_workers, remote_workers=(), authkey=None, duration=None):
+    """ Regulate the sites of the definitions file with the messages of the broker, on real time, until interrupted or
+    for the given duration (seconds). The workers are stopped at the end. """
+    site_ids, states = load_sites(sites_path, time.time())
+    if authkey is None:
+        authkey = os.urandom(16)
+    if remote_workers:
+        fleet = connect_fleet(remote_workers, authkey)
+    else:
+        fleet = start_local_fleet(n_workers, authkey)
+    frontend = None
+    try:
+        commands = fleet.add_sites(site_ids, states)
+        frontend = MqttFrontend(fleet, broker[0], broker[1], authkey)
+        # the loads still run with the commands of the previous coordinator
+        frontend.publish(commands)
+        debug(0, 'regulating {} sites on {} workers'.format(len(site_ids), len(fleet.workers)))
+        start = time.time()
+        while duration is None or time.time() - start < duration:
+            t = time.time()
+            frontend.tick(t)
+            time.sleep(max(0, t + COORDINATOR_TICK_PERIOD - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if frontend is not None:
+            frontend.stop()
+        fleet.stop()
+    return frontend
+
+
+def run_mqtt(n_sites, n_workers, duration, seed, remote_workers=(), authkey=None):
+    """ Simulated sites publishing their measurements through the broker stand-in, a local worker joins half way. Ticks
+    are spread by EVALUATION_PERIOD virtual seconds every 0.2s, force durations are in virtual seconds too. The remote
+    workers are used instead of n_workers local ones when given, they are stopped at the end. """
+    import paho.mqtt.client as mqtt
+    import mqtt_broker
+
+    rnd = random.Random(seed)
+    site_ids, states = random_states(rnd, n_sites, time.time())
+    if authkey is None:
+        authkey = os.urandom(16)
+    broker = mqtt_broker.Broker().start()
+    if remote_workers:
+        fleet = connect_fleet(remote_workers, authkey)
+    else:
+        fleet = start_local_fleet(n_workers, authkey)
+    commands = fleet.add_sites(site_ids, states)
+    frontend = MqttFrontend(fleet, broker.host, broker.port)
+    frontend.publish(commands)
+    broker.wait_for_subscriber(TOPIC_SITE_PREFIX + site_ids[0] + '/' + TOPIC_SENSOR_PRODUCTION)
+
+    sensors = mqtt.Client()
+    sensors.connect(broker.host, broker.port, 60)
+    sensors.loop_start()
+
+    start = time.time()
+    ticks = 0
+    joined = False
+    while time.time() - start < duration:
+        for site_id in site_ids:
+            sensors.publish(TOPIC_SITE_PREFIX + site_id + '/' + TOPIC_SENSOR_CONSUMPTION,
+                            json.dumps({'p': rnd.randint(100, 4000)}))
+            sensors.publish(TOPIC_SITE_PREFIX + site_id + '/' + TOPIC_SENSOR_PRODUCTION,
+                            json.dumps({'p': rnd.randint(0, 5000)}))
+        if rnd.random() < 0.3:
+            i = rnd.randrange(n_sites)
+            sensors.publish(TOPIC_SITE_PREFIX + site_ids[i] + '/' + TOPIC_REGULATION_CONTROL,
+                            json.dumps({'command': 'force', 'name': rnd.choice(states[i]['names']), 'power': 1000,
+                                        'duration': 30}))
+        time.sleep(0.2)
+        if not joined and time.time() - start > duration / 2:
+            with frontend.lock:
+                process, address = start_local_worker(authkey)
+                fleet.join('w{}'.format(len(fleet.workers)), address, authkey, process)
+            joined = True
+        # evaluation dates are spread by EVALUATION_PERIOD so that every tick evaluates every site
+        frontend.tick(start + ticks * EVALUATION_PERIOD)
+        ticks += 1
+
+    sensors.loop_stop()
+    frontend.stop()
+    print('{} sites, {} ticks, {} commands published, {} sites moved by the join'.format(
+        n_sites, ticks, frontend.published, fleet.moved))
+    print('sites per worker: ' + ', '.join('{} {}'.format(name, len(link.site_ids))
+                                         for name, link in sorted(fleet.workers.items())))
+    fleet.stop()
+    broker.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded regulation of many sites')
+    sub = parser.add_subparsers(dest='command')
+    p_worker = sub.add_parser('worker')
+    p_worker.add_argument('--listen', default='127.0.0.1:7000', help='host:port')
+    p_worker.add_argument('--authkey', required=True)
+    p_verify = sub.add_parser('verify')
+    p_verify.add_argument('--sites', type=int, default=300)
+    p_verify.add_argument('--seed', type=int, default=1)
+    p_bench = sub.add_parser('bench')
+    p_bench.add_argument('--sites', type=int, default=50000)
+    p_bench.add_argument('--workers', type=int, default=4)
+    p_bench.add_argument('--ticks', type=int, default=10)
+    p_bench.add_argument('--seed', type=int, default=1)
+    p_coordinator = sub.add_parser('coordinator')
+    p_coordinator.add_argument('--broker', default='127.0.0.1:1883', help='host:port')
+    p_coordinator.add_argument('--sites', required=True, help='site definitions file, see fleet_sites.json')
+    p_coordinator.add_argument('--workers', type=int, default=2, help='number of local workers')
+    p_coordinator.add_argument('--worker', action='append', default=[], dest='remote_workers',
+                               help='host:port of a remote worker, instead of local ones (repeatable)')
+    p_coordinator.add_argument('--authkey', help='authentication key of the remote workers')
+    p_mqtt = sub.add_parser('mqtt')
+    p_mqtt.add_argument('--sites', type=int, default=200)
+    p_mqtt.add_argument('--workers', type=int, default=2)
+    p_mqtt.add_argument('--duration', type=float, default=10)
+    p_mqtt.add_argument('--seed', type=int, default=1)
+    p_mqtt.add_argument('--worker', action='append', default=[], dest='remote_workers',
+                        help='host:port of a remote worker, instead of local ones (repeatable)')
+    p_mqtt.add_argument('--authkey', help='authentication key of the remote workers')
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        serve(parse_address(args.listen), args.authkey.encode())
+        return
+    if args.command == 'mqtt' and args.remote_workers and args.authkey is None:
+        p_mqtt.error('--worker requires --authkey')
+    if args.command == 'coordinator' and args.remote_workers and args.authkey is None:
+        p_coordinator.error('--worker requires --authkey')
+
+    if args.command == 'coordinator':
+        run_coordinator(parse_address(args.broker), args.sites, args.workers, args.remote_workers,
+                        None if args.authkey is None else args.authkey.encode())
+        return
+
+    logger.setLevel(logging.WARNING)
+
+    if args.command == 'verify':
+        if verify(args.sites, args.seed):
+            raise SystemExit(1)
+    elif args.command == 'bench':
+        bench(args.sites, args.workers, args.ticks, args.seed)
+    elif args.command == 'mqtt':
+        run_mqtt(args.sites, args.workers, args.duration, args.seed, args.remote_workers,
+                 None if args.authkey is None else args.authkey.encode())
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
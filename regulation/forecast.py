@@ -0,0 +1,58 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Short term forecast of the photovoltaic production. A linear trend is fitted over a rolling window of the last
+# production samples and extrapolated a few seconds ahead. The residuals of the fit give the width of the prediction
+# interval, so that the regulation loop only anticipates a change when the trend is clear enough compared to the
+# measurement noise.
+
+import collections
+import math
+
+
+class ProductionForecaster(object):
+    def __init__(self, window=4, max_age=None):
+        self.samples = collections.deque(maxlen=window)
+        self.max_age = max_age
+
+    def add(self, t, power):
+        self.samples.append((t, power))
+
+    def reset(self):
+        self.samples.clear()
+
+    def is_ready(self, t=None):
+        """ Return True when the window is full, ignoring the samples older than max_age at date t """
+        if t is not None and self.max_age is not None:
+            while self.samples and t - self.samples[0][0] > self.max_age:
+                self.samples.popleft()
+        return len(self.samples) == self.samples.maxlen
+
+    def predict(self, t):
+        """ Return the predicted production at date t and the standard deviation of this prediction """
+        n = len(self.samples)
+        t_mean = sum(s[0] for s in self.samples) / float(n)
+        p_mean = sum(s[1] for s in self.samples) / float(n)
+        sxx = sum((s[0] - t_mean) ** 2 for s in self.samples)
+        if sxx == 0:
+            return p_mean, 0
+        slope = sum((s[0] - t_mean) * (s[1] - p_mean) for s in self.samples) / sxx
+        predicted = p_mean + slope * (t - t_mean)
+
+        if n <= 2:
+            return predicted, 0
+        residuals = sum((s[1] - p_mean - slope * (s[0] - t_mean)) ** 2 for s in self.samples)
+        s = math.sqrt(residuals / (n - 2))
+        return predicted, s * math.sqrt(1 + 1.0 / n + (t - t_mean) ** 2 / sxx)
@@ -14,18 +14,25 @@
 # cohérence des autres mesures de puissance du système, en particulier la mesure de la puissance consommée par la maison
 # réalisée par le module PZEM-004t.
 
+import functools
 import json
+import threading
 import time
 import paho.mqtt.client as mqtt
 
-prev_hc = None
-prev_hp = None
-prev_hc_date = None
-prev_hp_date = None
+# MQTT broker address
+MQTT_BROKER = "192.168.1.7"
+MQTT_PORT = 1883
 
 THRESHOLD_LOW = 100
 THRESHOLD_ZERO = 50
 
+# Do not report a data faster than this delay to increase accuracy with high power
+MIN_DELAY = 8
+
+# When the indexes do not move anymore, publish a decreasing power estimate every N seconds
+DECAY_PERIOD = 5
+
 
 def debug(indent, msg):
     print((' '*indent)+str(msg))
@@ -35,6 +42,86 @@ def now_ts():
     return time.time()
 
 
+class InstantPowerEstimator(object):
+    """ Compute the instant power from the HC/HP indexes.
+
+    Index changes are processed as they come. When the indexes stop moving, a single deadline timer is armed to
+    publish a decaying estimate instead of polling. The clock and the timer factory can be replaced, which allows
+    to drive the estimator with a virtual clock. The timer factory has the threading.Timer signature.
+    """
+
+    def __init__(self, publish, clock=now_ts, timer_factory=threading.Timer):
+        self.publish = publish
+        self.clock = clock
+        self.timer_factory = timer_factory
+        self.prev_hc = None
+        self.prev_hp = None
+        self.prev_hc_date = None
+        self.prev_hp_date = None
+        self.timer = None
+        # incremented each time the timer is replaced: a timer which already fired can't be cancelled anymore, its
+        # callback must then do nothing
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def on_indexes(self, hc, hp):
+        with self.lock:
+            t = self.clock()
+            if self.prev_hc is None:
+                self.prev_hc = hc
+                self.prev_hp = hp
+                self.prev_hc_date = t
+                self.prev_hp_date = t
+                self._schedule_decay(t)
+                return
+
+            pe = 0
+            if hc > self.prev_hc and (t - self.prev_hc_date) > MIN_DELAY:
+                pe += (hc - self.prev_hc) * 3600.0 / (t - self.prev_hc_date)
+                self.prev_hc = hc
+                self.prev_hc_date = t
+            if hp > self.prev_hp and (t - self.prev_hp_date) > MIN_DELAY:
+                pe += (hp - self.prev_hp) * 3600.0 / (t - self.prev_hp_date)
+                self.prev_hp = hp
+                self.prev_hp_date = t
+
+            if pe > 0:
+                self.publish(pe)
+                self._schedule_decay(t)
+
+    def _schedule_decay(self, t):
+        # the decay estimate is only published once no index moved for the time needed to reach THRESHOLD_LOW
+        last_tick_date = max(self.prev_hc_date, self.prev_hp_date)
+        self._arm(last_tick_date + 3600.0 / THRESHOLD_LOW - t)
+
+    def _arm(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.generation += 1
+        self.timer = self.timer_factory(max(0, delay), functools.partial(self._on_decay_deadline, self.generation))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _on_decay_deadline(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            t = self.clock()
+            delta_t = t - max(self.prev_hc_date, self.prev_hp_date)
+            pe = 3600.0 / delta_t
+            if pe < THRESHOLD_ZERO:
+                pe = 0
+            self.publish(pe)
+            self._arm(DECAY_PERIOD)
+
+    def stop(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.generation += 1
+
+
 def on_connect(client, userdata, flags, rc):
     debug(0, 'ready')
 
@@ -47,55 +134,23 @@ def send_instant_power(client, pe):
     client.publish('power/edf', str(pe))
 
 
-def on_message(client, userdata, msg):
-    global prev_hc, prev_hc_date, prev_hp, prev_hp_date, current_ps
+def on_message(client, estimator, msg):
     if msg.topic == 'tic/data':
-        t = now_ts()
         j = json.loads(msg.payload.decode())
-        hc = j['hchc']
-        hp = j['hchp']
-        if prev_hc is None:
-            prev_hc = hc
-            prev_hp = hp
-            prev_hc_date = t
-            prev_hp_date = t
-        else:
-            pe = 0
-            min_delay = 8 # do not report a data faster than this delay to increase accuracy with high power
-            if hc > prev_hc and (t - prev_hc_date) > min_delay:
-                pe += (hc - prev_hc) * 3600.0 / (t - prev_hc_date)
-                prev_hc = hc
-                prev_hc_date = t
-            if hp > prev_hp and (t - prev_hp_date) > min_delay:
-                pe += (hp - prev_hp) * 3600.0 / (t - prev_hp_date)
-                prev_hp = hp
-                prev_hp_date = t
-
-            if pe > 0:
-                send_instant_power(client, pe)
+        estimator.on_indexes(j['hchc'], j['hchp'])
 
 
 def main():
     client = mqtt.Client()
+    estimator = InstantPowerEstimator(lambda pe: send_instant_power(client, pe))
+    client.user_data_set(estimator)
     client.on_connect = on_connect
     client.on_message = on_message
 
-    client.connect("192.168.1.7", 1883, 120)
-
-    prev_msg_date = now_ts()
-    threshold_time = 3600 / THRESHOLD_LOW
-    while True:
-        client.loop(1)
-        if prev_hc_date is not None and prev_hp_date is not None:
-            t = now_ts()
-            if t - prev_msg_date > 5:
-                delta_t = t - max(prev_hc_date, prev_hp_date)
-                if delta_t > threshold_time:
-                    pe = 3600/delta_t
-                    if pe < THRESHOLD_ZERO:
-                        pe = 0
-                    send_instant_power(client, pe)
-                    prev_msg_date = t
+    client.connect(MQTT_BROKER, MQTT_PORT, 120)
+
+    # network I/O runs in the paho loop, decay publications are triggered by the estimator timer
+    client.loop_forever()
 
 
 if __name__ == '__main__':
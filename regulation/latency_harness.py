@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# End to end latency measurement: the real regulation loop (power_regulation.main) runs against the local broker
+# stand-in, PZEM messages are injected at a given rate and the delay between a sensor publication and the arrival of the
+# resulting command on scr/0/in or wifi_plug/0/in is measured.
+#
+# A command is attributed to the sensor message the regulation loop was processing when it has been sent: the injected
+# messages carry their publication date, which is recorded by a wrapper around power_regulation.on_message.
+#
+# Usage:
+#   latency_harness.py                           run the default scenarios
+#   latency_harness.py --rate 50 --duration 10   a single steady scenario
+#   latency_harness.py --burst 200               send messages by bursts of 200 every second
+#   latency_harness.py --slow-subscribers 3      add subscribers reading their messages slowly
+
+import argparse
+import bisect
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import config
+from debug import logger
+import mqtt_broker
+import power_regulation
+
+COMMAND_TOPICS = ('scr/0/in', 'wifi_plug/0/in')
+
+CONSUMPTION = 500
+# the production alternates between these values so that almost every evaluation sends commands
+PRODUCTIONS = (3000, 200)
+
+# receive buffer of the slow subscribers, in bytes (the kernel may round it up)
+SLOW_RECEIVE_BUFFER = 1024
+
+# outgoing queue length and socket send buffer (bytes) of the broker clients in the slow subscribers scenarios
+SLOW_SCENARIO_MAX_QUEUE = 100
+SLOW_SCENARIO_SEND_BUFFER = 4096
+
+# sensor messages being processed by the regulation loop: processing start dates and the matching publication dates
+processing_dates = []
+publication_dates = []
+
+
+def traced_on_message(client, userdata, msg, on_message=power_regulation.on_message):
+    if msg.topic in (power_regulation.TOPIC_SENSOR_CONSUMPTION, power_regulation.TOPIC_SENSOR_PRODUCTION):
+        processing_dates.append(time.time())
+        publication_dates.append(json.loads(msg.payload.decode())['t'])
+    on_message(client, userdata, msg)
+
+
+def start_regulation(broker, evaluation_period):
+    """ Run the regulation loop in a thread, return the path of its temporary configuration file """
+    # the regular configuration, connected to the local broker
+    with open(config.CONFIG_FILE) as f:
+        data = json.load(f)
+    data['broker'] = {'host': broker.host, 'port': broker.port}
+    fd, config_file = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+
+    power_regulation.EVALUATION_PERIOD = evaluation_period
+    power_regulation.ADAPTIVE_EVALUATION_PERIOD = False
+    power_regulation.on_message = traced_on_message
+    t = threading.Thread(target=power_regulation.main, args=(config_file,))
+    t.daemon = True
+    t.start()
+    broker.wait_for_subscriber(power_regulation.TOPIC_SENSOR_PRODUCTION)
+    return config_file
+
+
+class CommandRecorder(object):
+    def __init__(self, broker):
+        self.arrivals = []
+        self.client = mqtt.Client()
+        self.client.on_message = self.on_message
+        self.client.connect(broker.host, broker.port, 60)
+        for topic in COMMAND_TOPICS:
+            self.client.subscribe(topic)
+        self.client.loop_start()
+        broker.wait_for_subscriber(COMMAND_TOPICS[0])
+
+    def on_message(self, client, userdata, msg):
+        if not msg.retain:
+            self.arrivals.append(time.time())
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class SlowSubscriber(object):
+    """ A raw MQTT client subscribed to everything and reading its socket slowly, 640 bytes/s by default. Its receive
+    buffer is kept small so that the messages wait in its broker queue rather than in the kernel buffers. """
+
+    def __init__(self, broker, name, read_size=64, read_delay=0.1):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_RECEIVE_BUFFER)
+        self.sock.connect((broker.host, broker.port))
+        body = mqtt_broker.encode_string('MQTT') + b'\x04\x02\x00\x3c' + mqtt_broker.encode_string(name)
+        self.sock.sendall(mqtt_broker.packet(mqtt_broker.CONNECT, 0, body))
+        body = b'\x00\x01' + mqtt_broker.encode_string('#') + b'\x00'
+        self.sock.sendall(mqtt_broker.packet(mqtt_broker.SUBSCRIBE, 2, body))
+        self.read_size = read_size
+        self.read_delay = read_delay
+        self.running = True
+        t = threading.Thread(target=self.read_loop)
+        t.daemon = True
+        t.start()
+
+    def read_loop(self):
+        while self.running:
+            try:
+                if not self.sock.recv(self.read_size):
+                    break
+            except socket.error:
+                break
+            time.sleep(self.read_delay)
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+
+def inject(broker, rate, duration, burst):
+    """ Publish PZEM messages alternating between consumption and production, at rate messages per second, or by
+    bursts of the given size once per second """
+    client = mqtt.Client()
+    client.connect(broker.host, broker.port, 60)
+    client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client.loop_start()
+    interval = 1.0 if burst else 1.0 / rate
+    count = burst if burst else 1
+    n = 0
+    start = time.time()
+    next_date = start
+    while time.time() - start < duration:
+        for _ in range(count):
+            if n % 2 == 0:
+                topic, power = power_regulation.TOPIC_SENSOR_CONSUMPTION, CONSUMPTION
+            else:
+                topic, power = power_regulation.TOPIC_SENSOR_PRODUCTION, PRODUCTIONS[(n // 2) % 2]
+            client.publish(topic, json.dumps({'p': power, 't': time.time()}))
+            n += 1
+        next_date += interval
+        time.sleep(max(0, next_date - time.time()))
+    # let the last commands arrive
+    time.sleep(0.5)
+    client.loop_stop()
+    client.disconnect()
+    return n
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_scenario(broker, label, rate=10, duration=5, burst=0, slow_subscribers=0, max_queue=None):
+    """ max_queue bounds the broker client queues during this scenario, instead of the broker setting """
+    del processing_dates[:]
+    del publication_dates[:]
+    broker_max_queue = broker.max_queue
+    if max_queue is not None:
+        broker.max_queue = max_queue
+    if slow_subscribers:
+        # without a small send buffer, the kernel holds the messages of the slow subscribers and their queues stay empty
+        broker.send_buffer = SLOW_SCENARIO_SEND_BUFFER
+    slow = [SlowSubscriber(broker, 'slow_{}'.format(i)) for i in range(slow_subscribers)]
+    recorder = CommandRecorder(broker)
+
+    sent = inject(broker, rate, duration, burst)
+
+    recorder.stop()
+    stats = broker.stats()
+    for s in slow:
+        s.stop()
+    broker.max_queue = broker_max_queue
+    broker.send_buffer = None
+
+    latencies = []
+    for arrival in recorder.arrivals:
+        i = bisect.bisect_right(processing_dates, arrival) - 1
+        if i >= 0:
+            latencies.append((arrival - publication_dates[i]) * 1000)
+    latencies.sort()
+
+    print('{}: {} sensor messages, {} processed, {} commands'.format(label, sent, len(processing_dates),
+                                                                    len(latencies)))
+    if latencies:
+        print('  latency ms: min {:.2f}  median {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}'.format(
+            latencies[0], percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99),
+            latencies[-1]))
+    slow_clients = [c for c in stats['clients'] if c['client_id'] and c['client_id'].startswith('slow_')]
+    if slow_clients:
+        print('  slow subscribers: max queue length {}, dropped {}'.format(
+            max(c['max_queue_length'] for c in slow_clients), sum(c['dropped'] for c in slow_clients)))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end latency of the regulation loop')
+    parser.add_argument('--rate', type=float, help='sensor messages per second')
+    parser.add_argument('--duration', type=float, default=5, help='seconds')
+    parser.add_argument('--burst', type=int, default=0, help='send messages by bursts of this size every second')
+    parser.add_argument('--slow-subscribers', type=int, default=0)
+    parser.add_argument('--max-queue', type=int, help='maximum number of queued messages per broker client')
+    parser.add_argument('--evaluation-period', type=float, default=0,
+                        help='minimum delay between evaluations, 0 evaluates on every message')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+
+    broker = mqtt_broker.Broker(max_queue=args.max_queue).start()
+    config_file = start_regulation(broker, args.evaluation_period)
+    try:
+        if args.rate or args.burst or args.slow_subscribers:
+            run_scenario(broker, 'custom', args.rate or 10, args.duration, args.burst, args.slow_subscribers,
+                         SLOW_SCENARIO_MAX_QUEUE if args.slow_subscribers and args.max_queue is None else None)
+        else:
+            # the PZEM rate, 0.5 msg/s, would give too few messages for a median: 10 msg/s measures the idle loop
+            run_scenario(broker, 'steady 10 msg/s', 10, args.duration)
+            run_scenario(broker, 'steady 200 msg/s', 200, args.duration)
+            run_scenario(broker, 'bursts of 500 msg', burst=500, duration=args.duration)
+            run_scenario(broker, 'steady 50 msg/s, 3 slow subscribers', 50, args.duration, slow_subscribers=3,
+                         max_queue=SLOW_SCENARIO_MAX_QUEUE if args.max_queue is None else None)
+    finally:
+        broker.stop()
+        os.remove(config_file)
+
+
+if __name__ == '__main__':
+    main()
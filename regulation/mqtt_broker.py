@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# A lightweight MQTT 3.1.1 broker stand-in, used to run the regulation software and its tools without the real broker.
+# It supports what the project uses: connect, subscribe/unsubscribe with wildcards, publish with QoS 0, 1 and 2
+# (always delivered with QoS 0), retained messages and keep alive: a client which sends nothing for 1.5 times its keep
+# alive period is disconnected. There is no authentication, no persistence and no will message.
+#
+# Each client has its own outgoing queue and writer thread, so that a slow subscriber does not delay the others. The
+# queue length can be bounded, in which case messages for the slow client are dropped and counted.
+#
+# Usage: mqtt_broker.py [--host 127.0.0.1] [--port 1883]
+
+import argparse
+import socket
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter, topic):
+    f = topic_filter.split('/')
+    t = topic.split('/')
+    for i, level in enumerate(f):
+        if level == '#':
+            return True
+        if i >= len(t):
+            return False
+        if level != '+' and level != t[i]:
+            return False
+    return len(f) == len(t)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        if length > 0:
+            digit |= 0x80
+        encoded.append(digit)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_string(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
+
+def packet(packet_type, flags, body):
+    return bytes(bytearray([(packet_type << 4) | flags])) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, retain=False):
+    return packet(PUBLISH, 1 if retain else 0, encode_string(topic) + payload)
+
+
+class ClientConnection(object):
+    def __init__(self, broker, sock, address):
+        self.broker = broker
+        self.sock = sock
+        self.address = address
+        self.client_id = None
+        self.subscriptions = set()
+        self.outgoing = queue.Queue()
+        self.dropped = 0
+        self.max_queue_length = 0
+        self.connected = True
+
+    def start(self):
+        for target in (self.read_loop, self.write_loop):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def send(self, data):
+        if self.broker.max_queue is not None and self.outgoing.qsize() >= self.broker.max_queue:
+            self.dropped += 1
+            return
+        self.outgoing.put(data)
+        self.max_queue_length = max(self.max_queue_length, self.outgoing.qsize())
+
+    def write_loop(self):
+        while True:
+            data = self.outgoing.get()
+            if data is None:
+                break
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                break
+        self.close()
+
+    def recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def read_packet(self):
+        header = bytearray(self.recv_exactly(1))[0]
+        length = 0
+        multiplier = 1
+        while True:
+            digit = bytearray(self.recv_exactly(1))[0]
+            length += (digit & 0x7f) * multiplier
+            multiplier *= 128
+            if not digit & 0x80:
+                break
+        body = self.recv_exactly(length) if length else b''
+        return header >> 4, header & 0x0f, body
+
+    def read_loop(self):
+        try:
+            while self.connected:
+                packet_type, flags, body = self.read_packet()
+                if not self.handle(packet_type, flags, body):
+                    break
+        except (EOFError, socket.error):
+            pass
+        self.close()
+
+    def handle(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            name_length = struct.unpack('!H', body[:2])[0]
+            offset = 2 + name_length + 4
+            keep_alive = struct.unpack('!H', body[offset - 2:offset])[0]
+            if keep_alive:
+                # read_loop() gets a socket.timeout when the client is silent for too long. It also bounds the time a
+                # write to the client may block.
+                self.sock.settimeout(1.5 * keep_alive)
+            id_length = struct.unpack('!H', body[offset:offset + 2])[0]
+            self.client_id = body[offset + 2:offset + 2 + id_length].decode('utf-8')
+            self.send(packet(CONNACK, 0, b'\x00\x00'))
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 3
+            retain = bool(flags & 1)
+            topic_length = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2 + topic_length].decode('utf-8')
+            offset = 2 + topic_length
+            if qos > 0:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self.send(packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+            self.broker.publish(topic, body[offset:], retain)
+        elif packet_type == PUBREL:
+            self.send(packet(PUBCOMP, 0, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            packet_id = body[:2]
+            offset = 2
+            granted = bytearray()
+            topic_filters = []
+            while offset < len(body):
+                length = struct.unpack('!H', body[offset:offset + 2])[0]
+                topic_filters.append(body[offset + 2:offset + 2 + length].decode('utf-8'))
+                offset += 2 + length + 1
+                granted.append(0)
+            self.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+            self.broker.subscribe(self, topic_filters)
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = body[:2]
+            offset = 2
+            topic_filters = []
+            while offset < len(body):
+                length = struct.unpack('!H', body[offset:offset + 2])[0]
+                topic_filters.append(body[offset + 2:offset + 2 + length].decode('utf-8'))
+                offset += 2 + length
+            self.broker.unsubscribe(self, topic_filters)
+            self.send(packet(UNSUBACK, 0, packet_id))
+        elif packet_type == PINGREQ:
+            self.send(packet(PINGRESP, 0, b''))
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def close(self):
+        if not self.connected:
+            return
+        self.connected = False
+        self.outgoing.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.broker.remove(self)
+
+
+class Broker(object):
+    def __init__(self, host='127.0.0.1', port=0, max_queue=None, send_buffer=None):
+        """ port 0 selects a free port, see self.port once started. max_queue bounds the outgoing queue of each
+        client (None=unbounded). send_buffer sets the socket send buffer of the clients connecting afterwards, in bytes
+        (None=system default, which lets the kernel hold megabytes for a slow client before its queue grows) """
+        self.host = host
+        self.port = port
+        self.max_queue = max_queue
+        self.send_buffer = send_buffer
+        self.clients = []
+        self.retained = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.received = 0
+        self.delivered = 0
+
+    def start(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(64)
+        self.port = self.server.getsockname()[1]
+        t = threading.Thread(target=self.accept_loop)
+        t.daemon = True
+        t.start()
+        return self
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, address = self.server.accept()
+            except socket.error:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.send_buffer is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+            client = ClientConnection(self, sock, address)
+            with self.lock:
+                self.clients.append(client)
+            client.start()
+
+    def stop(self):
+        self.server.close()
+        for client in list(self.clients):
+            client.close()
+
+    def remove(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def subscribe(self, client, topic_filters):
+        with self.lock:
+            client.subscriptions.update(topic_filters)
+            retained = [(topic, payload) for topic, payload in self.retained.items()
+                        if any(topic_matches(f, topic) for f in topic_filters)]
+        for topic, payload in retained:
+            client.send(publish_packet(topic, payload, retain=True))
+
+    def unsubscribe(self, client, topic_filters):
+        # publish() iterates the subscriptions of every client under the lock
+        with self.lock:
+            client.subscriptions.difference_update(topic_filters)
+
+    def publish(self, topic, payload, retain=False):
+        data = publish_packet(topic, payload)
+        with self.lock:
+            self.received += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            clients = [c for c in self.clients if any(topic_matches(f, topic) for f in c.subscriptions)]
+            self.delivered += len(clients)
+        for client in clients:
+            client.send(data)
+
+    def has_subscriber(self, topic):
+        with self.lock:
+            return any(topic_matches(f, topic) for c in self.clients for f in c.subscriptions)
+
+    def wait_for_subscriber(self, topic, timeout=10):
+        deadline = time.time() + timeout
+        while not self.has_subscriber(topic):
+            if time.time() > deadline:
+                raise RuntimeError('no subscriber for ' + topic)
+            time.sleep(0.01)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'received': self.received,
+                'delivered': self.delivered,
+                'clients': [{'client_id': c.client_id, 'max_queue_length': c.max_queue_length, 'dropped': c.dropped}
+                            for c in self.clients],
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT broker stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--max-queue', type=int, help='maximum number of queued messages per client')
+    parser.add_argument('--send-buffer', type=int, help='socket send buffer of each client, in bytes')
+    args = parser.parse_args()
+
+    broker = Broker(args.host, args.port, args.max_queue, args.send_buffer).start()
+    print('listening on {}:{}'.format(broker.host, broker.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,10 @@
 # - manual control ("force"), in order to be able to manually turn on/off a given equipment with a specified power and
 #   duration.
 # - monitoring: sends a JSON status message on a MQTT topic for reporting on the current regulation state
+# - feed-forward: the production trend is extrapolated a few seconds ahead and the power is allocated according to the
+#   expected production before the change shows up in the measurements, see the "forecast" module.
+# - configuration: equipments, topics and thresholds are read from config.json (see the "config" module). The file is
+#   reloaded when it changes or with a "reload" command, without restarting the loop nor resetting unchanged equipments.
 # - fallback: a very specific feature which aim is to make sure that the water heater receives enough water (either
 #   from the PV panels or the grid to keep the water warm enough.
 
@@ -35,18 +39,37 @@
 
 import datetime
 import json
+import socket
 import time
 
 import paho.mqtt.client as mqtt
 
+import config
 from debug import debug as debug
+from decision_cache import DecisionCache
 import equipment
-from equipment import ConstantPowerEquipment, UnknownPowerEquipment, VariablePowerEquipment
+from equipment import ConstantPowerEquipment, UnknownPowerEquipment
+from forecast import ProductionForecaster
 
 # The comparison between power consumption and production is done every N seconds, it must be above the measurement
 # rate, which is currently 4s with the PZEM-004t module.
 EVALUATION_PERIOD = 5
 
+# After a command, wait for the response delay measured on the commanded equipments (EVALUATION_PERIOD until measured)
+# instead of EVALUATION_PERIOD, and for a consumption measurement taken after this delay. When a single equipment is
+# commanded, its response is measured until it settles or another command is sent. When the consumption is above the
+# production, the evaluation only waits for the response of the equipments if the last commands were shedding load,
+# otherwise it takes place after EVALUATION_PERIOD as when this is disabled. So does it when the consumption sensor has
+# been silent for RESPONSE_TIMEOUT seconds, so that the daily fallback still runs.
+ADAPTIVE_EVALUATION_PERIOD = True
+
+# A response is considered settled when the consumption is within this tolerance (watts, or 10% of the expected
+# change) of its expected value. Changes smaller than twice the tolerance are not measured, and a response which does
+# not settle within RESPONSE_TIMEOUT seconds, or which is further than the expected change plus twice the tolerance from
+# its expected value, is discarded.
+RESPONSE_TOLERANCE = 30
+RESPONSE_TIMEOUT = 30
+
 # Consider powers are balanced when the difference is below this value (watts). This helps prevent fluctuations.
 BALANCE_THRESHOLD = 20
 
@@ -54,18 +77,66 @@ BALANCE_THRESHOLD = 20
 # knowing that there may be measurement inaccuracy.
 MARGIN = 20
 
+# Anticipate production changes: the trend over the last FORECAST_WINDOW production samples is extrapolated
+# FORECAST_HORIZON seconds ahead. Only changes larger than FORECAST_CONFIDENCE times the standard deviation of the
+# prediction are anticipated. Replays of cloudy days (see replay.py --compare forecast) show that trimming before a
+# drop reduces the grid import but costs more self consumed energy than it saves, and that boosting before a rise
+# increases the grid import, hence both are disabled by default.
+FORECAST = False
+FORECAST_BOOST = False
+FORECAST_WINDOW = 4
+FORECAST_HORIZON = 2 * EVALUATION_PERIOD
+FORECAST_CONFIDENCE = 1.0
+# Samples older than this (seconds) are not used, so that the trend is not extrapolated over a gap in the measurements
+FORECAST_MAX_AGE = 20
+
+# Reuse the decisions taken in the same situation: same power surplus once rounded to DECISION_CACHE_QUANTUM watts, same
+# equipment states and forced equipments. Up to DECISION_CACHE_SIZE decisions are kept, 0 disables the cache. On a miss
+# the power is allocated on the actual surplus, so a hit may differ by up to the quantum from what the allocation would
+# have decided. Decisions which went through an hysteresis band are not cached since they also depend on the past
+# imbalance. Building the key costs about as much as allocating on a site with a few equipments, see benchmark.py.
+DECISION_CACHE_SIZE = 0
+DECISION_CACHE_QUANTUM = 10
+
+# The values of the above settings when they are not given in the configuration file
+DEFAULT_MARGIN = MARGIN
+DEFAULT_BALANCE_THRESHOLD = BALANCE_THRESHOLD
+DEFAULT_DECISION_CACHE = {'size': DECISION_CACHE_SIZE, 'quantum': DECISION_CACHE_QUANTUM}
+
+# Check whether the configuration file has been modified every N seconds
+CONFIG_CHECK_PERIOD = 5
+
+# MQTT broker address, when not given in the configuration file
+MQTT_BROKER = "192.168.1.7"
+MQTT_PORT = 1883
+
 # A debug switch to toggle simulation (uses distinct MQTT topics for instance)
 SIMULATION = False
 
 last_evaluation_date = None
+next_evaluation_date = None
 
 power_production = None
 power_consumption = None
+power_consumption_date = None
+
+# True when the last commands only decreased the power of the equipments
+shedding = False
+
+# The pending response delay measurement: (equipment, command date, consumption at that date, expected change)
+response_measurement = None
+production_forecaster = ProductionForecaster(FORECAST_WINDOW, FORECAST_MAX_AGE)
+decision_cache = DecisionCache(DECISION_CACHE_SIZE) if DECISION_CACHE_SIZE else None
 
 mqtt_client = None
 
 equipments = None
 equipment_water_heater = None
+equipment_by_name = {}
+
+# The configuration in use, see apply_configuration()
+configuration = None
+last_configuration_check_date = None
 
 # MQTT topics on which to subscribe and send messages
 prefix = 's/' if SIMULATION else ''
@@ -81,15 +152,104 @@ def now_ts():
 
 
 def get_equipment_by_name(name):
-    for e in equipments:
-        if e.name == name:
-            return e
-    return None
+    return equipment_by_name.get(name)
+
+
+def apply_configuration(new_configuration):
+    """ Switch to a new configuration. This happens between two evaluations since both run in the MQTT client thread.
+    Equipments which are not part of the new configuration are turned off, new ones start at 0W. """
+    global configuration, equipments, equipment_water_heater, equipment_by_name, MARGIN, BALANCE_THRESHOLD
+    global DECISION_CACHE_SIZE, DECISION_CACHE_QUANTUM, decision_cache
+    global TOPIC_SENSOR_CONSUMPTION, TOPIC_SENSOR_PRODUCTION, TOPIC_REGULATION_CONTROL, TOPIC_STATUS
+    global response_measurement
+
+    for e in equipments or ():
+        if new_configuration.equipment_by_name.get(e.name) is not e:
+            debug(0, 'removing equipment {}'.format(e.name))
+            e.set_current_power(0)
+            if response_measurement is not None and response_measurement[0] is e:
+                response_measurement = None
+    for e in new_configuration.equipments:
+        if e.get_current_power() is None:
+            debug(0, 'adding equipment {}'.format(e.name))
+            e.set_current_power(0)
+
+    if configuration is not None and new_configuration.broker != configuration.broker:
+        debug(0, 'the MQTT broker address change will be taken into account after a restart')
+
+    topics = dict((name, prefix + topic) for name, topic in new_configuration.topics.items())
+    subscribed = (TOPIC_SENSOR_CONSUMPTION, TOPIC_SENSOR_PRODUCTION, TOPIC_REGULATION_CONTROL)
+
+    configuration = new_configuration
+    equipments = new_configuration.equipments
+    equipment_water_heater = new_configuration.fallback
+    equipment_by_name = new_configuration.equipment_by_name
+    # a setting removed from the file goes back to its default value
+    MARGIN = DEFAULT_MARGIN if new_configuration.margin is None else new_configuration.margin
+    BALANCE_THRESHOLD = DEFAULT_BALANCE_THRESHOLD if new_configuration.balance_threshold is None \
+        else new_configuration.balance_threshold
+    decision_cache_settings = dict(DEFAULT_DECISION_CACHE, **(new_configuration.decision_cache or {}))
+    DECISION_CACHE_SIZE = decision_cache_settings['size']
+    DECISION_CACHE_QUANTUM = decision_cache_settings['quantum']
+    if decision_cache is None or decision_cache.size != DECISION_CACHE_SIZE:
+        decision_cache = DecisionCache(DECISION_CACHE_SIZE) if DECISION_CACHE_SIZE else None
+    else:
+        # the decisions depend on the equipments and thresholds
+        decision_cache.clear()
+    TOPIC_SENSOR_CONSUMPTION = topics['consumption']
+    TOPIC_SENSOR_PRODUCTION = topics['production']
+    TOPIC_REGULATION_CONTROL = topics['control']
+    TOPIC_STATUS = topics['status']
+
+    if mqtt_client is not None:
+        for topic in set(subscribed) - {TOPIC_SENSOR_CONSUMPTION, TOPIC_SENSOR_PRODUCTION, TOPIC_REGULATION_CONTROL}:
+            mqtt_client.unsubscribe(topic)
+        for topic in {TOPIC_SENSOR_CONSUMPTION, TOPIC_SENSOR_PRODUCTION, TOPIC_REGULATION_CONTROL} - set(subscribed):
+            mqtt_client.subscribe(topic)
+
+
+def reload_configuration():
+    """ Load the configuration file again, keep the current configuration if the file is not valid """
+    global last_configuration_check_date
+
+    last_configuration_check_date = now_ts()
+    start = time.time()
+    try:
+        new_configuration = config.load(configuration.path, configuration)
+    except Exception as e:
+        debug(0, 'invalid configuration, keeping the current one: {}'.format(e))
+        # don't try again until the file is modified
+        configuration.mtime = config.modification_date(configuration.path)
+        return
+    apply_configuration(new_configuration)
+    debug(0, 'configuration reloaded in {:.2f}ms'.format((time.time() - start) * 1000))
+
+
+def check_configuration():
+    """ Reload the configuration file if it has been modified """
+    global last_configuration_check_date
+
+    t = now_ts()
+    if last_configuration_check_date is not None and t - last_configuration_check_date < CONFIG_CHECK_PERIOD:
+        return
+    last_configuration_check_date = t
+    if config.modification_date(configuration.path) != configuration.mtime:
+        debug(0, '')
+        debug(0, 'configuration file modified')
+        reload_configuration()
+
+
+def invalidate_decisions():
+    if decision_cache is not None:
+        decision_cache.clear()
 
 
 def on_connect(client, userdata, flags, rc):
     debug(0, 'ready')
 
+    # commands are small messages sent in a row, don't let Nagle's algorithm hold them until the broker acknowledges
+    client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     client.subscribe(TOPIC_SENSOR_CONSUMPTION)
     client.subscribe(TOPIC_SENSOR_PRODUCTION)
     client.subscribe(TOPIC_REGULATION_CONTROL)
@@ -98,20 +258,30 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     # Receive power consumption and production values and triggers the evaluation. We also take into account manual
     # control messages in case we want to turn on/off a given equipment.
-    global power_production, power_consumption
+    global power_production, power_consumption, power_consumption_date
+    if configuration is not None and configuration.path is not None:
+        check_configuration()
+
     if msg.topic == TOPIC_SENSOR_CONSUMPTION:
         j = json.loads(msg.payload.decode())
         power_consumption = int(j['p'])
+        power_consumption_date = now_ts()
+        measure_response(power_consumption_date)
         evaluate()
     elif msg.topic == TOPIC_SENSOR_PRODUCTION:
         j = json.loads(msg.payload.decode())
         power_production = int(j['p'])
+        production_forecaster.add(now_ts(), power_production)
         evaluate()
     elif msg.topic == TOPIC_REGULATION_CONTROL:
         j = json.loads(msg.payload.decode())
         command = j['command']
-        name = j['name']
-        if command == 'force':
+        name = j.get('name')
+        if command == 'reload':
+            debug(0, '')
+            debug(0, 'reloading the configuration')
+            reload_configuration()
+        elif command == 'force':
             e = get_equipment_by_name(name)
             if e:
                 power = j['power']
@@ -124,6 +294,7 @@ def on_message(client, userdata, msg):
                 debug(0, '')
                 debug(0, msg)
                 e.force(power, duration)
+                invalidate_decisions()
                 evaluate()
         elif command == 'unforce':
             e = get_equipment_by_name(name)
@@ -131,12 +302,17 @@ def on_message(client, userdata, msg):
                 debug(0, '')
                 debug(0, 'not forcing equipment {} anymore'.format(name))
                 e.force(None)
+                invalidate_decisions()
                 evaluate()
 
 
 # Specific fallback: the energy put in the water heater yesterday (see below)
 energy_yesterday = 0
 
+LOW_ENERGY_TWO_DAYS = 4000  # minimal power on two days
+LOW_ENERGY_TODAY = 2000  # minimal power for today
+LOW_ENERGY_CHECK_AT = 16  # hour
+
 def low_energy_fallback():
     """ Fallback, when the amount of energy today went below a minimum"""
 
@@ -146,10 +322,6 @@ def low_energy_fallback():
 
     global energy_yesterday
 
-    LOW_ENERGY_TWO_DAYS = 4000  # minimal power on two days
-    LOW_ENERGY_TODAY = 2000  # minimal power for today
-    CHECK_AT = 16  # hour
-
     t = now_ts()
     if last_evaluation_date is not None:
 
@@ -162,7 +334,7 @@ def low_energy_fallback():
         if d1.hour == 22 and d2.hour == 23:
             energy_yesterday = energy_today
 
-        if d1.hour == CHECK_AT - 1 and d2.hour == CHECK_AT:
+        if d1.hour == LOW_ENERGY_CHECK_AT - 1 and d2.hour == LOW_ENERGY_CHECK_AT:
             max_power = equipment_water_heater.max_power
             if (energy_yesterday + energy_today) < LOW_ENERGY_TWO_DAYS and energy_today < LOW_ENERGY_TODAY:
                 duration = 3600 * (LOW_ENERGY_TODAY - energy_today) / max_power
@@ -170,6 +342,229 @@ def low_energy_fallback():
                 debug(0, 'daily energy fallback: forcing equipment {} to {}W for {} seconds'.format(
                     equipment_water_heater.name, max_power, duration))
                 equipment_water_heater.force(max_power, duration)
+                invalidate_decisions()
+
+
+def anticipated_production(t):
+    """ The production to allocate: the measured production, lowered before a drop (raised before a rise with
+    FORECAST_BOOST) according to the production forecast """
+    predicted, sigma = production_forecaster.predict(t + FORECAST_HORIZON)
+
+    if predicted + FORECAST_CONFIDENCE * sigma < power_production:
+        production = int(predicted + FORECAST_CONFIDENCE * sigma)
+        debug(0, "production is expected to drop by at least {}W, trimming".format(power_production - production))
+        return production
+    elif FORECAST_BOOST and predicted - FORECAST_CONFIDENCE * sigma > power_production:
+        production = int(predicted - FORECAST_CONFIDENCE * sigma)
+        debug(0, "production is expected to rise by at least {}W, boosting".format(production - power_production))
+        return production
+    return power_production
+
+
+def in_deficit():
+    """ Return True when the consumption is above the production, in which case the load is shed without waiting for
+    the response of the equipments, unless they are being shed already """
+    return power_consumption is not None and power_production is not None and \
+        power_consumption > power_production - MARGIN
+
+
+def consumption_is_fresh(t):
+    """ Return False when no consumption measurement has been received for RESPONSE_TIMEOUT seconds, in which case the
+    evaluation does not wait for one """
+    return power_consumption_date is not None and t - power_consumption_date <= RESPONSE_TIMEOUT
+
+
+def start_response_measurement(t, previous_states):
+    """ Start measuring the response delay when a single equipment has been commanded, a pending measurement goes on
+    when no equipment has been commanded """
+    global response_measurement
+
+    commanded = [(e, s) for e, s in zip(equipments, previous_states)
+                 if (e.get_current_power(), getattr(e, 'is_on', None)) != s]
+    if not commanded:
+        return
+    if len(commanded) != 1:
+        # the response of several equipments can't be told apart
+        response_measurement = None
+        return
+    e, (previous_power, _) = commanded[0]
+    if isinstance(e, UnknownPowerEquipment):
+        delta = None
+    else:
+        delta = e.get_current_power() - previous_power
+        if abs(delta) < 2 * RESPONSE_TOLERANCE:
+            response_measurement = None
+            return
+    response_measurement = (e, t, power_consumption, delta)
+
+
+def measure_response(t):
+    global response_measurement
+
+    if response_measurement is None:
+        return
+    e, command_date, start_consumption, delta = response_measurement
+    if t - command_date > RESPONSE_TIMEOUT:
+        response_measurement = None
+        return
+    change = power_consumption - start_consumption
+    if delta is not None and abs(change - delta) > abs(delta) + 2 * RESPONSE_TOLERANCE:
+        # another load changed meanwhile, this is not the response of the equipment
+        debug(0, 'consumption changed by {}W while expecting {}W from {}, not measuring its response'.format(
+            change, delta, e.name))
+        response_measurement = None
+        return
+    if delta is None:
+        settled = abs(change) > 2 * RESPONSE_TOLERANCE
+    else:
+        settled = abs(change - delta) <= max(RESPONSE_TOLERANCE, 0.1 * abs(delta))
+    if settled:
+        e.update_response_delay(t - command_date)
+        debug(0, 'response of {} settled after {}s, response delay is now {:.1f}s'.format(
+            e.name, t - command_date, e.response_delay))
+        response_measurement = None
+
+
+def decision_key(surplus):
+    """ Return the decision cache key of the current situation """
+    states = []
+    forced = []
+    for e in equipments:
+        is_forced = e.is_forced()
+        forced.append(is_forced)
+        if not is_forced:
+            states.append((e.get_state(), e.can_switch_on(), e.can_switch_off()))
+    quantized = int(round(surplus / float(DECISION_CACHE_QUANTUM))) * DECISION_CACHE_QUANTUM
+    return quantized, tuple(states), tuple(forced)
+
+
+def lower_priority_freeable_powers():
+    """ For each equipment, the power that the equipments of lower priority could give up right now """
+    powers = []
+    total = 0
+    for e in reversed(equipments):
+        powers.append(total)
+        if not e.is_forced() and not isinstance(e, UnknownPowerEquipment):
+            total += e.get_freeable_power() or 0
+    powers.reverse()
+    return powers
+
+
+def claim_power(i, available_power, reclaimable_power):
+    """ The i-th equipment is a switched one which is off, with enough power once the lower priority equipments give
+    up theirs. Turn it on, taking the missing power from them, when its dwell time and hysteresis band allow it,
+    otherwise keep its power away from them. Return the power left for the next equipments. """
+    e = equipments[i]
+    if not e.can_switch_on() or not e.hysteresis_reached('on', available_power + reclaimable_power):
+        debug(4, "keeping {}W for {} until it can be turned on".format(e.nominal_power, e.name))
+        return max(0, available_power - e.nominal_power)
+    needed_power = e.nominal_power - available_power
+    for o in reversed(equipments[i + 1:]):
+        if needed_power <= 0:
+            break
+        if o.is_forced() or isinstance(o, UnknownPowerEquipment) or not o.get_freeable_power():
+            continue
+        # priority preemption is not a fluctuation, the hysteresis band does not apply here
+        freed_power = o.decrease_power_by(needed_power, use_hysteresis=False)
+        available_power += freed_power
+        needed_power -= freed_power
+    return e.increase_power_by(available_power)
+
+
+def allocate(surplus):
+    """ Distribute the power surplus (negative when consuming too much) on the equipments by priority order """
+    if surplus < 0:
+        # Too much power consumption, we need to decrease the load
+        excess_power = -surplus
+        debug(0, "decreasing global power consumption by {}W".format(excess_power))
+        for e in reversed(equipments):
+            debug(2, "examining " + e.name)
+            if e.is_forced():
+                debug(4, "skipping this equipment because it's in forced state")
+                continue
+            result = e.decrease_power_by(excess_power)
+            if result is None:
+                debug(2, "stopping here and waiting for the next measurement to see the effect")
+                break
+            excess_power -= result
+            if excess_power <= 0:
+                debug(2, "no more excess power consumption, stopping here")
+                break
+            else:
+                debug(2, "there is {}W left to cancel, continuing".format(excess_power))
+        debug(2, "no more equipment to check")
+    else:
+        if surplus < BALANCE_THRESHOLD:
+            # Nice, this is the goal: consumption is equal to production. Only a switched equipment waiting for the
+            # power used by lower priority equipments may still be turned on.
+            debug(0, "power consumption and production are balanced")
+            available_power = 0
+        else:
+            # There's power in excess, try to increase the load to consume this available power
+            available_power = surplus
+            debug(0, "increasing global power consumption by {}W".format(available_power))
+        # the equipments of lower priority only change when power is recovered on them
+        reclaimable_powers = None
+        for i, e in enumerate(equipments):
+            debug(2, "examining " + e.name)
+            if e.is_forced():
+                debug(4, "skipping this equipment because it's in forced state")
+                continue
+            if isinstance(e, ConstantPowerEquipment) and not e.is_on and (e.min_off_time or e.hysteresis_energy):
+                # lower priority equipments must not keep the power of a higher priority one while it waits for its
+                # minimum off time or hysteresis band, equipments without them are not preempted
+                if reclaimable_powers is None:
+                    reclaimable_powers = lower_priority_freeable_powers()
+                if available_power + reclaimable_powers[i] >= e.nominal_power:
+                    available_power = claim_power(i, available_power, reclaimable_powers[i])
+                    reclaimable_powers = None
+                    continue
+            if available_power <= 0:
+                debug(2, "no more available power")
+                break
+            result = e.increase_power_by(available_power)
+            if result is None:
+                debug(2, "stopping here and waiting for the next measurement to see the effect")
+                break
+            elif result == 0:
+                debug(2, "no more available power to use, stopping here")
+                break
+            elif result < 0:
+                debug(2, "not enough available power to turn on this equipment, trying to recover power on lower priority equipments")
+                freeable_power = 0
+                needed_power = -result
+                for j in range(i + 1, len(equipments)):
+                    o = equipments[j]
+                    if o.is_forced():
+                        continue
+                    p = o.get_freeable_power()
+                    if p is not None:
+                        freeable_power += p
+                debug(2, "power used by other equipments: {}W, needed: {}W".format(freeable_power, needed_power))
+                if freeable_power >= needed_power:
+                    debug(2, "recovering power")
+                    reclaimable_powers = None
+                    freed_power = 0
+                    for j in reversed(range(i + 1, len(equipments))):
+                        o = equipments[j]
+                        if o.is_forced():
+                            continue
+                        # priority preemption is not a fluctuation, the hysteresis band does not apply here
+                        result = o.decrease_power_by(needed_power, use_hysteresis=False)
+                        freed_power += result
+                        needed_power -= result
+                        if needed_power <= 0:
+                            debug(2, "enough power has been recovered, stopping here")
+                            break
+                    new_available_power = available_power + freed_power
+                    debug(2, "now trying again to increase power of {} with {}W".format(e.name, new_available_power))
+                    available_power = e.increase_power_by(new_available_power)
+                else:
+                    debug(2, "this is not possible to recover enough power on lower priority equipments")
+            else:
+                available_power = result
+                debug(2, "there is {}W left to use, continuing".format(available_power))
+        debug(2, "no more equipment to check")
 
 
 def evaluate():
@@ -177,7 +572,7 @@ def evaluate():
     # It examines the list of equipments by priority order, their current state and computes which one should be
     # turned on/off.
 
-    global last_evaluation_date
+    global last_evaluation_date, next_evaluation_date, shedding
 
     try:
         t = now_ts()
@@ -189,14 +584,19 @@ def evaluate():
                 for e in equipments:
                     e.reset_energy()
 
+            if ADAPTIVE_EVALUATION_PERIOD and (shedding or not in_deficit()) and consumption_is_fresh(t):
+                # wait until the effect of the last commands shows in the consumption measurement
+                if power_consumption_date < next_evaluation_date:
+                    return
             # ensure there's a minimum duration between two evaluations
-            if t - last_evaluation_date < EVALUATION_PERIOD:
+            elif t - last_evaluation_date < EVALUATION_PERIOD:
                 return
 
         # ensure that water stays warm enough
         low_energy_fallback()
 
         last_evaluation_date = t
+        next_evaluation_date = t + EVALUATION_PERIOD
 
         if power_production is None or power_consumption is None:
             return
@@ -204,83 +604,44 @@ def evaluate():
         debug(0, '')
         debug(0, 'evaluating power consumption={}, power production={}'.format(power_consumption, power_production))
 
+        previous_states = [(e.get_current_power(), getattr(e, 'is_on', None)) for e in equipments]
+
         # Here starts the real work, compare powers
-        if power_consumption > (power_production - MARGIN):
-            # Too much power consumption, we need to decrease the load
-            excess_power = power_consumption - (power_production - MARGIN)
-            debug(0, "decreasing global power consumption by {}W".format(excess_power))
-            for e in reversed(equipments):
-                debug(2, "examining " + e.name)
-                if e.is_forced():
-                    debug(4, "skipping this equipment because it's in forced state")
-                    continue
-                result = e.decrease_power_by(excess_power)
-                if result is None:
-                    debug(2, "stopping here and waiting for the next measurement to see the effect")
-                    break
-                excess_power -= result
-                if excess_power <= 0:
-                    debug(2, "no more excess power consumption, stopping here")
-                    break
-                else:
-                    debug(2, "there is {}W left to cancel, continuing".format(excess_power))
-            debug(2, "no more equipment to check")
-        elif (power_production - MARGIN - power_consumption) < BALANCE_THRESHOLD:
-            # Nice, this is the goal: consumption is equal to production
-            debug(0, "power consumption and production are balanced")
+        production = power_production
+        if FORECAST and production_forecaster.is_ready(t):
+            production = anticipated_production(t)
+        surplus = production - MARGIN - power_consumption
+        if decision_cache is None:
+            allocate(surplus)
         else:
-            # There's power in excess, try to increase the load to consume this available power
-            available_power = power_production - MARGIN - power_consumption
-            debug(0, "increasing global power consumption by {}W".format(available_power))
-            for i, e in enumerate(equipments):
-                if available_power <= 0:
-                    debug(2, "no more available power")
-                    break
-                debug(2, "examining " + e.name)
-                if e.is_forced():
-                    debug(4, "skipping this equipment because it's in forced state")
-                    continue
-                result = e.increase_power_by(available_power)
-                if result is None:
-                    debug(2, "stopping here and waiting for the next measurement to see the effect")
-                    break
-                elif result == 0:
-                    debug(2, "no more available power to use, stopping here")
-                    break
-                elif result < 0:
-                    debug(2, "not enough available power to turn on this equipment, trying to recover power on lower priority equipments")
-                    freeable_power = 0
-                    needed_power = -result
-                    for j in range(i + 1, len(equipments)):
-                        o = equipments[j]
-                        if o.is_forced():
-                            continue
-                        p = o.get_current_power()
-                        if p is not None:
-                            freeable_power += p
-                    debug(2, "power used by other equipments: {}W, needed: {}W".format(freeable_power, needed_power))
-                    if freeable_power >= needed_power:
-                        debug(2, "recovering power")
-                        freed_power = 0
-                        for j in reversed(range(i + 1, len(equipments))):
-                            o = equipments[j]
-                            if o.is_forced():
-                                continue
-                            result = o.decrease_power_by(needed_power)
-                            freed_power += result
-                            needed_power -= result
-                            if needed_power <= 0:
-                                debug(2, "enough power has been recovered, stopping here")
-                                break
-                        new_available_power = available_power + freed_power
-                        debug(2, "now trying again to increase power of {} with {}W".format(e.name, new_available_power))
-                        available_power = e.increase_power_by(new_available_power)
-                    else:
-                        debug(2, "this is not possible to recover enough power on lower priority equipments")
-                else:
-                    available_power = result
-                    debug(2, "there is {}W left to use, continuing".format(available_power))
-            debug(2, "no more equipment to check")
+            key = decision_key(surplus)
+            decision = decision_cache.get(key)
+            if decision is None:
+                pending_dates = [e.pending_date for e in equipments]
+                allocate(surplus)
+                # the decision also depends on the past imbalance when an hysteresis band has been checked
+                if all(e.pending_date == d for e, d in zip(equipments, pending_dates)):
+                    decision_cache.put(key, tuple(None if e.is_forced() else e.get_state() for e in equipments))
+            else:
+                debug(0, "same situation as before, applying the same decision")
+                for e, state in zip(equipments, decision):
+                    if not e.is_forced() and e.get_state() != state:
+                        e.set_state(state)
+
+        # an imbalance only accumulates towards the hysteresis band while it is continuously observed
+        for e in equipments:
+            e.discard_stale_hysteresis(t)
+
+        if ADAPTIVE_EVALUATION_PERIOD:
+            commanded = [(e, s) for e, s in zip(equipments, previous_states)
+                         if (e.get_current_power(), getattr(e, 'is_on', None)) != s]
+            delays = [EVALUATION_PERIOD if e.response_delay is None else e.response_delay for e, _ in commanded]
+            shedding = bool(commanded) and all(
+                (e.get_current_power() or 0) < (s[0] or 0) or s[1] and not e.is_on for e, s in commanded)
+            if delays:
+                next_evaluation_date = t + max(delays)
+                debug(2, "waiting {:.1f}s for the commands to take effect".format(max(delays)))
+            start_response_measurement(t, previous_states)
 
         # Build a status message
         status = {
@@ -296,39 +657,35 @@ def evaluate():
                 'name': e.name,
                 'current_power': 'unknown' if p is None else p,
                 'energy': e.get_energy(),
-                'forced': e.is_forced()
+                'forced': e.is_forced(),
+                'response_delay': e.response_delay
             })
         status['equipments'] = es
+        if decision_cache is not None:
+            status['decision_cache'] = decision_cache.stats()
         mqtt_client.publish(TOPIC_STATUS, json.dumps(status))
 
     except Exception as e:
         debug(0, e)
 
 
-def main():
-    global mqtt_client, equipments, equipment_water_heater
+def main(config_file=config.CONFIG_FILE):
+    global mqtt_client
+
+    # The equipments by priority order, topics and thresholds are listed in the configuration file
+    initial_configuration = config.load(config_file)
+    broker = initial_configuration.broker or (MQTT_BROKER, MQTT_PORT)
 
     mqtt_client = mqtt.Client()
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
 
-    mqtt_client.connect("192.168.1.7", 1883, 120)
+    mqtt_client.connect(broker[0], broker[1], 120)
 
     equipment.setup(mqtt_client, not SIMULATION)
 
-    # This is a list of equipments by priority order (first one has the higher priority). As many equipments as needed
-    # can be listed here.
-    equipment_water_heater = VariablePowerEquipment('water_heater', 2400)
-    equipments = (
-        ConstantPowerEquipment('e_bike_charger', 120),
-        equipment_water_heater,
-        # ConstantPowerEquipment('heater', 1800, mqtt_client),
-        # UnknownPowerEquipment('plug_1')
-    )
-
-    # At startup, reset everything
-    for e in equipments:
-        e.set_current_power(0)
+    # At startup, reset everything (all equipments are new)
+    apply_configuration(initial_configuration)
 
     mqtt_client.loop_forever()
 
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Replay recorded (or synthetic) days through the real regulation loop, using a virtual clock and a fake MQTT client.
+# This is used to compare regulation strategies offline: number of relay toggles, energy imported from the grid, etc.
+#
+# A trace is a CSV file with one line per PZEM sample: "timestamp;production;consumption" where the consumption is the
+# house consumption *without* the regulated equipments (lines starting with '#' are ignored). The regulated
+# equipments consumption is added by the replay according to the commands sent by the regulation loop.
+#
+# Usage:
+#   replay.py [trace.csv ...]       replay the given traces
+#   replay.py --cloudy N            replay N synthetic cloudy days
+#   --compare dwell|forecast|response|cache   the setting to compare, with and without
+#
+# The regulated equipments take some time to respond to a command (see ACTUATION_DELAYS), the consumption seen by the
+# regulation loop only includes their new power after this delay.
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import math
+import random
+import time
+
+from debug import logger
+import equipment
+from equipment import ConstantPowerEquipment, VariablePowerEquipment
+from decision_cache import DecisionCache
+from forecast import ProductionForecaster
+import power_regulation
+
+# Sampling period of the PZEM-004t module
+SAMPLE_PERIOD = 4
+
+# A production change larger than this between two samples starts a settling time measurement, which ends when the
+# balance is back within SETTLE_TOLERANCE watts of the target
+STEP_THRESHOLD = 300
+SETTLE_TOLERANCE = 100
+
+# Delay between a command and the actual power change of the replayed equipments (seconds)
+ACTUATION_DELAYS = {
+    'e_bike_charger': 2,
+    'water_heater': 10,
+}
+
+
+class VirtualClock(object):
+    def __init__(self, t=0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+class Message(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeMqttClient(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.messages = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages.append((self.clock(), topic, payload))
+
+
+def load_trace(path):
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            t, production, consumption = line.split(';')
+            samples.append((float(t), int(float(production)), int(float(consumption))))
+    return samples
+
+
+def synthetic_cloudy_day(day, seed=None, peak=3000):
+    """ A clear sky bell curve shaded by passing clouds, with a base consumption and a few appliance spikes """
+    rnd = random.Random(seed)
+    start = time.mktime(datetime.date(2019, 5, 1).timetuple()) + day * 86400
+    samples = []
+    cloudy = False
+    shade = 1.0
+    spike_end = 0
+    for i in range(0, 86400, SAMPLE_PERIOD):
+        h = i / 3600.0
+        clear = peak * math.sin(math.pi * (h - 7) / 13) ** 1.5 if 7 < h < 20 else 0
+        # two states cloud model, clouds last about 90s, clear sky intervals about 60s
+        if rnd.random() < SAMPLE_PERIOD / (90.0 if cloudy else 60.0):
+            cloudy = not cloudy
+        target = rnd.uniform(0.2, 0.4) if cloudy else 1.0
+        shade += (target - shade) * 0.5
+        production = int(clear * shade * rnd.uniform(0.98, 1.02))
+
+        if i >= spike_end and rnd.random() < 0.0005:
+            spike_end = i + rnd.randint(60, 900)
+        consumption = 250 + rnd.randint(-20, 20) + (1800 if i < spike_end else 0)
+        samples.append((start + i, production, consumption))
+    return samples
+
+
+# power_regulation settings restored before each replay
+DEFAULT_SETTINGS = dict((name, getattr(power_regulation, name)) for name in (
+    'FORECAST', 'FORECAST_BOOST', 'ADAPTIVE_EVALUATION_PERIOD', 'DECISION_CACHE_SIZE'))
+
+
+def make_equipments(dwell=True):
+    if dwell:
+        charger = ConstantPowerEquipment('e_bike_charger', 120, min_on_time=180, min_off_time=180,
+                                         hysteresis_energy=0.5)
+    else:
+        charger = ConstantPowerEquipment('e_bike_charger', 120)
+    water_heater = VariablePowerEquipment('water_heater', 2400)
+    return (charger, water_heater), water_heater
+
+
+class Replay(object):
+    """ Feed samples to power_regulation.evaluate() and account for the resulting powers. settings overrides
+    power_regulation module settings, such as FORECAST """
+
+    def __init__(self, equipments, water_heater, settings=None):
+        self.settings = settings or {}
+        self.commands = dict((e.name, collections.deque()) for e in equipments)
+        self.clock = VirtualClock()
+        self.client = FakeMqttClient(self.clock)
+        self.equipments = equipments
+        self.water_heater = water_heater
+
+    def setup(self, t):
+        self.clock.t = t
+        equipment.now_ts = self.clock
+        power_regulation.now_ts = self.clock
+        equipment.setup(self.client, True)
+        power_regulation.mqtt_client = self.client
+        power_regulation.equipments = self.equipments
+        power_regulation.equipment_water_heater = self.water_heater
+        power_regulation.last_evaluation_date = None
+        power_regulation.next_evaluation_date = None
+        power_regulation.power_consumption_date = None
+        power_regulation.response_measurement = None
+        power_regulation.shedding = False
+        power_regulation.energy_yesterday = 0
+        for name, value in DEFAULT_SETTINGS.items():
+            setattr(power_regulation, name, self.settings.get(name, value))
+        power_regulation.production_forecaster = ProductionForecaster(power_regulation.FORECAST_WINDOW,
+                                                                    power_regulation.FORECAST_MAX_AGE)
+        size = power_regulation.DECISION_CACHE_SIZE
+        power_regulation.decision_cache = DecisionCache(size) if size else None
+        for e in self.equipments:
+            e.set_current_power(0)
+            self.commands[e.name].append((t, 0))
+
+    def record_commands(self, t):
+        for e in self.equipments:
+            power = e.get_current_power() or 0
+            if self.commands[e.name][-1][1] != power:
+                self.commands[e.name].append((t + ACTUATION_DELAYS.get(e.name, 0), power))
+
+    def regulated_power(self, t):
+        power = 0
+        for commands in self.commands.values():
+            while len(commands) > 1 and commands[1][0] <= t:
+                commands.popleft()
+            power += commands[0][1]
+        return power
+
+    def run(self, samples):
+        stats = {
+            'days': len(samples) * SAMPLE_PERIOD / 86400.0,
+            'grid_import': 0.0,
+            'grid_export': 0.0,
+            'regulated_energy': 0.0,
+            'toggles': 0,
+            'steps': 0,
+            'settling_time': 0.0,
+        }
+        self.setup(samples[0][0])
+        states = dict((e.name, getattr(e, 'is_on', None)) for e in self.equipments)
+        prev_t = None
+        prev_production = None
+        step_date = None
+        for t, production, consumption in samples:
+            self.clock.t = t
+            regulated = self.regulated_power(t)
+            total = consumption + regulated
+            if prev_t is not None:
+                dt = (t - prev_t) / 3600.0
+                stats['grid_import'] += max(0, total - production) * dt
+                stats['grid_export'] += max(0, production - total) * dt
+                stats['regulated_energy'] += regulated * dt
+            prev_t = t
+
+            if prev_production is not None and abs(production - prev_production) > STEP_THRESHOLD:
+                if step_date is not None:
+                    stats['settling_time'] += t - step_date
+                stats['steps'] += 1
+                step_date = t
+            elif step_date is not None and \
+                    abs(production - power_regulation.MARGIN - total) <= SETTLE_TOLERANCE:
+                stats['settling_time'] += t - step_date
+                step_date = None
+            prev_production = production
+
+            # the same messages as the PZEM modules, consumption first
+            power_regulation.on_message(self.client, None, Message(
+                power_regulation.TOPIC_SENSOR_CONSUMPTION, json.dumps({'p': total}).encode()))
+            power_regulation.on_message(self.client, None, Message(
+                power_regulation.TOPIC_SENSOR_PRODUCTION, json.dumps({'p': production}).encode()))
+            self.record_commands(t)
+
+            for e in self.equipments:
+                is_on = getattr(e, 'is_on', None)
+                if is_on != states[e.name]:
+                    stats['toggles'] += 1
+                    states[e.name] = is_on
+        return stats
+
+
+def replay(traces, dwell=True, **settings):
+    total = None
+    for samples in traces:
+        equipments, water_heater = make_equipments(dwell)
+        stats = Replay(equipments, water_heater, settings).run(samples)
+        stats['response_delays'] = dict((e.name, e.response_delay) for e in equipments)
+        cache = power_regulation.decision_cache
+        stats['cache_hits'] = cache.hits if cache else 0
+        stats['cache_misses'] = cache.misses if cache else 0
+        if total is None:
+            total = stats
+        else:
+            for k, v in stats.items():
+                if k != 'response_delays':
+                    total[k] += v
+    return total
+
+
+def report(label, stats):
+    days = stats['days']
+    print('{}: {:.1f} toggles/day, grid import {:.0f}Wh/day, grid export {:.0f}Wh/day, regulated {:.0f}Wh/day'.format(
+        label, stats['toggles'] / days, stats['grid_import'] / days, stats['grid_export'] / days,
+        stats['regulated_energy'] / days))
+    if stats['steps']:
+        print('  {} production steps, mean settling time {:.1f}s'.format(
+            stats['steps'], stats['settling_time'] / stats['steps']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay days through the regulation loop')
+    parser.add_argument('traces', nargs='*', help='CSV traces: timestamp;production;consumption')
+    parser.add_argument('--cloudy', type=int, default=0, help='number of synthetic cloudy days to replay')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compare', choices=('dwell', 'forecast', 'response', 'cache'), default='dwell')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+
+    traces = [load_trace(path) for path in args.traces]
+    traces += [synthetic_cloudy_day(d, args.seed + d) for d in range(args.cloudy)]
+    if not traces:
+        parser.error('no trace to replay')
+
+    if args.compare == 'dwell':
+        without_dwell = replay(traces, dwell=False)
+        with_dwell = replay(traces, dwell=True)
+        report('without dwell', without_dwell)
+        report('with dwell', with_dwell)
+        days = with_dwell['days']
+        print('energy cost of the dwell constraints: {:+.0f}Wh/day imported, {:+.0f}Wh/day regulated'.format(
+            (with_dwell['grid_import'] - without_dwell['grid_import']) / days,
+            (with_dwell['regulated_energy'] - without_dwell['regulated_energy']) / days))
+    elif args.compare == 'forecast':
+        reactive = replay(traces, FORECAST=False)
+        report('reactive', reactive)
+        for label, boost in (('feed-forward trim', False), ('feed-forward trim and boost', True)):
+            forecast = replay(traces, FORECAST=True, FORECAST_BOOST=boost)
+            report(label, forecast)
+            days = forecast['days']
+            print('  {:+.0f}Wh/day imported, {:+.0f}Wh/day regulated'.format(
+                (forecast['grid_import'] - reactive['grid_import']) / days,
+                (forecast['regulated_energy'] - reactive['regulated_energy']) / days))
+    elif args.compare == 'response':
+        fixed = replay(traces, ADAPTIVE_EVALUATION_PERIOD=False)
+        adaptive = replay(traces, ADAPTIVE_EVALUATION_PERIOD=True)
+        report('fixed evaluation period', fixed)
+        report('measured response delays', adaptive)
+        print('  response delays: ' + ', '.join('{} {:.1f}s'.format(name, delay)
+                                                 for name, delay in sorted(adaptive['response_delays'].items())
+                                                 if delay is not None))
+        days = adaptive['days']
+        print('  {:+.0f}Wh/day imported, {:+.0f}Wh/day regulated'.format(
+            (adaptive['grid_import'] - fixed['grid_import']) / days,
+            (adaptive['regulated_energy'] - fixed['regulated_energy']) / days))
+    elif args.compare == 'cache':
+        uncached = replay(traces, DECISION_CACHE_SIZE=0)
+        cached = replay(traces, DECISION_CACHE_SIZE=256)
+        report('without decision cache', uncached)
+        report('with decision cache', cached)
+        print('  {} hits, {} misses ({:.0%} hit rate)'.format(
+            cached['cache_hits'], cached['cache_misses'],
+            cached['cache_hits'] / float(max(1, cached['cache_hits'] + cached['cache_misses']))))
+        days = cached['days']
+        print('  {:+.0f}Wh/day imported, {:+.0f}Wh/day regulated'.format(
+            (cached['grid_import'] - uncached['grid_import']) / days,
+            (cached['regulated_energy'] - uncached['regulated_energy']) / days))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# The batch engine must take the same decisions as evaluate() on the corpus of batch.py verify.
+# Run with: python -m pytest
+
+import pytest
+
+import batch
+import equipment
+import power_regulation
+
+
+@pytest.fixture
+def scalar_globals(monkeypatch):
+    """ Restore the module globals swapped by the scalar sites of the corpus """
+    for name in ('now_ts', 'mqtt_client', 'FORECAST', 'ADAPTIVE_EVALUATION_PERIOD', 'equipments',
+                 'equipment_water_heater', 'last_evaluation_date', 'energy_yesterday', 'power_consumption',
+                 'power_production'):
+        monkeypatch.setattr(power_regulation, name, getattr(power_regulation, name))
+    for name in ('now_ts', '_mqtt_client', '_send_commands'):
+        monkeypatch.setattr(equipment, name, getattr(equipment, name))
+
+
+def test_same_decisions_as_evaluate(scalar_globals):
+    assert batch.verify(20, 1) == 0
@@ -0,0 +1,40 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# LRU order and counters of DecisionCache. Run with: python -m pytest
+
+from decision_cache import DecisionCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = DecisionCache(2)
+    cache.put('a', (1,))
+    cache.put('b', (2,))
+    assert cache.get('a') == (1,)
+    # 'b' has not been used since 'a' was read
+    cache.put('c', (3,))
+    assert cache.get('b') is None
+    assert cache.get('a') == (1,)
+    assert cache.get('c') == (3,)
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+
+def test_clear_keeps_counters():
+    cache = DecisionCache(2)
+    cache.put('a', (1,))
+    cache.get('a')
+    cache.clear()
+    assert cache.get('a') is None
+    assert cache.stats() == {'size': 0, 'hits': 1, 'misses': 1, 'evictions': 0}
@@ -0,0 +1,100 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Dwell times and hysteresis band of the switched equipments, with a virtual clock. Run with: python -m pytest
+
+import pytest
+
+import equipment
+from equipment import ConstantPowerEquipment
+from replay import FakeMqttClient, VirtualClock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = VirtualClock(1000)
+    monkeypatch.setattr(equipment, 'now_ts', clock)
+    monkeypatch.setattr(equipment, '_mqtt_client', FakeMqttClient(clock))
+    monkeypatch.setattr(equipment, '_send_commands', True)
+    return clock
+
+
+def charger(**kwargs):
+    e = ConstantPowerEquipment('e_bike_charger', 120, **kwargs)
+    e.set_current_power(0)
+    return e
+
+
+def test_min_off_time(clock):
+    e = charger(min_off_time=180)
+    e.set_current_power(120)
+    e.set_current_power(0)
+    clock.t += 179
+    assert e.increase_power_by(500) == 500
+    assert not e.is_on
+    clock.t += 1
+    assert e.increase_power_by(500) == 380
+    assert e.is_on
+
+
+def test_min_on_time(clock):
+    e = charger(min_on_time=180)
+    e.set_current_power(120)
+    clock.t += 179
+    assert e.get_freeable_power() == 0
+    assert e.decrease_power_by(500) == 0
+    assert e.is_on
+    clock.t += 1
+    assert e.get_freeable_power() == 120
+    assert e.decrease_power_by(500) == 120
+    assert not e.is_on
+
+
+def test_hysteresis_band(clock):
+    e = charger(hysteresis_energy=0.5)
+    # the band starts when the imbalance is first seen, 0.5Wh at 1800W take 1s
+    assert e.increase_power_by(1800) == 1800
+    clock.t += 0.5
+    assert e.increase_power_by(1800) == 1800
+    clock.t += 0.5
+    assert e.increase_power_by(1800) == 1680
+    assert e.is_on
+
+
+def test_hysteresis_band_restarts(clock):
+    e = charger(hysteresis_energy=0.5)
+    e.increase_power_by(1800)
+    clock.t += 4
+    # the imbalance has not been seen at the last evaluation
+    e.discard_stale_hysteresis(clock.t - 1)
+    assert e.increase_power_by(1800) == 1800
+    assert not e.is_on
+
+
+def test_hysteresis_band_opposite_direction(clock):
+    e = charger(hysteresis_energy=0.5)
+    e.set_current_power(120)
+    e.decrease_power_by(100)
+    clock.t += 60
+    assert e.decrease_power_by(100) == 120
+    # the band restarts after a switch
+    assert e.pending_direction is None
+
+
+def test_preemption_ignores_the_band(clock):
+    e = charger(hysteresis_energy=0.5)
+    e.set_current_power(120)
+    assert e.decrease_power_by(100, use_hysteresis=False) == 120
+    assert not e.is_on
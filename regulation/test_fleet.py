@@ -0,0 +1,209 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# The sharded regulation: parity with a single batch engine, site definitions and the coordinator against the broker
+# stand-in. Run with: python -m pytest
+
+import json
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import equipment
+import fleet
+import mqtt_broker
+
+SITES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fleet_sites.json')
+
+
+@pytest.fixture(autouse=True)
+def equipment_globals(monkeypatch):
+    for name in ('now_ts', '_mqtt_client', '_send_commands'):
+        monkeypatch.setattr(equipment, name, getattr(equipment, name))
+
+
+def test_same_decisions_through_rebalancing():
+    assert fleet.verify(20, 1) == 0
+
+
+def test_load_sites():
+    site_ids, states = fleet.load_sites(SITES_FILE, 1000)
+    assert site_ids == ['home', 'barn']
+    assert states[0]['names'] == ['e_bike_charger', 'water_heater']
+    assert states[0]['fallback'] == 1
+    assert states[0]['hysteresis'] == [0.5, 0]
+    assert states[1]['power'] == [0, 0]
+
+
+@pytest.mark.parametrize('sites, message', (
+    ([{'id': 'a', 'equipments': []}], 'site a: no fallback equipment'),
+    ([{'equipments': []}], 'invalid site identifier'),
+    ([{'id': 'a', 'margin': 10}], 'unknown settings for site a: margin'),
+))
+def test_invalid_sites(tmp_path, sites, message):
+    path = tmp_path / 'sites.json'
+    path.write_text(json.dumps({'sites': sites}))
+    with pytest.raises(ValueError, match=message):
+        fleet.load_sites(str(path), 1000)
+
+
+def test_worker_rejects_known_sites():
+    site_ids, states = fleet.load_sites(SITES_FILE, 1000)
+    worker = fleet.Worker()
+    worker.handle(('add', site_ids, states, False))
+    with pytest.raises(ValueError, match='sites already on this worker: home'):
+        worker.handle(('add', ['home'], states[:1], False))
+    assert worker.site_ids == site_ids
+
+
+def test_coordinator_restart():
+    site_ids, states = fleet.load_sites(SITES_FILE, 1000)
+    authkey = os.urandom(16)
+    process, address = fleet.start_local_worker(authkey)
+    first = fleet.Fleet()
+    first.join('w0', address, authkey, process)
+    first.add_sites(site_ids, states)
+    first.tick(1000)
+    # the coordinator stops without stopping its worker
+    first.workers['w0'].conn.close()
+
+    second = fleet.Fleet()
+    second.join('w0', address, authkey, process)
+    second.add_sites(site_ids, states)
+    second.set_measurements([300, 300], [2050, 2050])
+    second.tick(1000 + fleet.EVALUATION_PERIOD)
+    assert sorted(second.export(site_ids)) == sorted(site_ids)
+    second.stop()
+
+
+def test_worker_loss():
+    rnd = random.Random(1)
+    site_ids, states = fleet.random_states(rnd, 20, 1000)
+    authkey = os.urandom(16)
+    regulation = fleet.start_local_fleet(2, authkey)
+    commands = regulation.add_sites(site_ids, states)
+    # a command for every equipment of the new sites
+    assert sorted((c[0], c[1]) for c in commands) == sorted(
+        (site_id, j) for site_id, state in zip(site_ids, states) for j in range(len(state['names'])))
+    regulation.set_measurements(np.full(20, 300.), np.full(20, 2050.))
+    regulation.tick(1000)
+    lost = regulation.workers['w0']
+    assert lost.site_ids
+    lost_sites = set(lost.site_ids)
+    lost.process.kill()
+    lost.process.join()
+    # the tick during which the worker is lost evaluates the other sites, the next one all of them. The sites of the
+    # lost worker restart from their initial state, which is sent to their equipments.
+    restart = [c for c in regulation.tick(1000 + fleet.EVALUATION_PERIOD) if c[0] in lost_sites]
+    assert sorted((c[0], c[1], c[3]) for c in restart) == sorted((c[0], c[1], c[3]) for c in commands
+                                                                   if c[0] in lost_sites)
+    assert list(regulation.workers) == ['w1']
+    assert sorted(regulation.workers['w1'].site_ids) == sorted(site_ids)
+    regulation.tick(1000 + 2 * fleet.EVALUATION_PERIOD)
+    # without any worker left, the sites wait for one to join
+    regulation.workers['w1'].process.kill()
+    regulation.workers['w1'].process.join()
+    assert regulation.tick(1000 + 3 * fleet.EVALUATION_PERIOD) == []
+    assert sorted(regulation.unassigned) == sorted(site_ids)
+    with pytest.raises(ValueError, match='site site0 has no worker'):
+        regulation.force('site0', states[0]['names'][0], None, None, 1000 + 3 * fleet.EVALUATION_PERIOD)
+    process, address = fleet.start_local_worker(authkey)
+    regulation.join('w2', address, authkey, process)
+    assert sorted(regulation.workers['w2'].site_ids) == sorted(site_ids)
+    regulation.stop()
+
+
+def test_join_and_leave_at_runtime():
+    import paho.mqtt.client as mqtt
+
+    site_ids, states = fleet.load_sites(SITES_FILE, 1000)
+    authkey = os.urandom(16)
+    broker = mqtt_broker.Broker().start()
+    regulation = fleet.start_local_fleet(1, authkey)
+    regulation.add_sites(site_ids, states)
+    frontend = fleet.MqttFrontend(regulation, broker.host, broker.port, authkey)
+    client = mqtt.Client()
+    client.connect(broker.host, broker.port, 60)
+    client.loop_start()
+    try:
+        broker.wait_for_subscriber(fleet.TOPIC_FLEET_CONTROL)
+        regulation.force('home', 'water_heater', 1000, None, 1000)
+        frontend.tick(1000)
+        before = regulation.export(site_ids)
+
+        def control(message):
+            client.publish(fleet.TOPIC_FLEET_CONTROL, json.dumps(message)).wait_for_publish()
+            deadline = time.time() + 5
+            while not frontend.fleet_commands and time.time() < deadline:
+                time.sleep(0.01)
+            frontend.tick(1000)
+
+        control({'command': 'join'})
+        assert sorted(regulation.workers) == ['w0', 'w1']
+        control({'command': 'leave', 'worker': 'w0'})
+        assert list(regulation.workers) == ['w1']
+        assert sorted(regulation.workers['w1'].site_ids) == sorted(site_ids)
+        # the sites moved with their state
+        after = regulation.export(site_ids)
+        assert all(fleet.same_state(before[s], after[s]) for s in site_ids)
+        # the last worker does not leave
+        control({'command': 'leave', 'worker': 'w1'})
+        assert list(regulation.workers) == ['w1']
+    finally:
+        client.loop_stop()
+        frontend.stop()
+        regulation.stop()
+        broker.stop()
+
+
+def test_coordinator():
+    import paho.mqtt.client as mqtt
+
+    broker = mqtt_broker.Broker().start()
+    received = []
+    client = mqtt.Client()
+    client.on_message = lambda c, userdata, msg: received.append((msg.topic, msg.payload.decode()))
+    client.connect(broker.host, broker.port, 60)
+    client.subscribe('site/+/+/0/in')
+    client.loop_start()
+    broker.wait_for_subscriber('site/home/scr/0/in')
+    try:
+        coordinator = threading.Thread(target=fleet.run_coordinator,
+                                       args=((broker.host, broker.port), SITES_FILE, 1),
+                                       kwargs={'duration': fleet.EVALUATION_PERIOD + 2})
+        coordinator.start()
+        broker.wait_for_subscriber('site/home/pzem/1')
+        # malformed messages are ignored, the following ones are still received
+        client.publish('site/barn/pzem/0', 'not json')
+        client.publish('site/barn/pzem/1', json.dumps({'power': 2000}))
+        client.publish('site/barn/regulation/control', json.dumps({'command': 'force'}))
+        client.publish('site/barn/pzem/0', json.dumps([300]))
+        client.publish('site/home/pzem/0', json.dumps({'p': 300}))
+        client.publish('site/home/pzem/1', json.dumps({'p': 2050}))
+        coordinator.join()
+    finally:
+        client.loop_stop()
+        broker.stop()
+    # every equipment is first set to 0W, the loads may still run with the commands of a previous coordinator
+    off = str(equipment.VariablePowerEquipment.power_to_percent(0, 2400))
+    assert received[:4] == [('site/home/wifi_plug/0/in', '0'), ('site/home/scr/0/in', off),
+                            ('site/barn/wifi_plug/0/in', '0'), ('site/barn/scr/0/in', off)]
+    # 1730W of surplus, the power of the charger is kept while it waits for its hysteresis band
+    assert received[4:] == [('site/home/scr/0/in',
+                             str(equipment.VariablePowerEquipment.power_to_percent(1610, 2400)))]
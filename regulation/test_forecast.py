@@ -0,0 +1,103 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Fit ProductionForecaster on synthetic samples and check when the regulation loop trims or boosts the production.
+# Run with: python -m pytest
+
+import pytest
+
+import power_regulation
+from forecast import ProductionForecaster
+
+
+def forecaster(powers, period=4, max_age=None):
+    """ A forecaster which window is filled with these powers, one sample every period seconds from date 0 """
+    f = ProductionForecaster(len(powers), max_age)
+    for k, power in enumerate(powers):
+        f.add(k * period, power)
+    return f
+
+
+def test_linear_ramp():
+    f = forecaster([1000, 1100, 1200, 1300])
+    assert f.is_ready()
+    predicted, sigma = f.predict(20)
+    assert predicted == pytest.approx(1500)
+    assert sigma == pytest.approx(0)
+
+
+def test_noisy_samples():
+    f = forecaster([1000, 1140, 1160, 1300])
+    predicted, sigma = f.predict(16)
+    assert predicted == pytest.approx(1380)
+    assert sigma > 0
+    # the further from the samples, the wider the prediction interval
+    assert f.predict(24)[1] > sigma
+    assert f.predict(6)[1] < sigma
+
+
+def test_max_age_drops_stale_samples():
+    f = forecaster([1000, 1100, 1200, 1300], max_age=20)
+    assert f.is_ready(20)
+    # the first sample, 24s old, is dropped
+    assert not f.is_ready(24)
+    assert len(f.samples) == 3
+    assert f.predict(24) == (pytest.approx(1600), pytest.approx(0))
+    # after a gap in the measurements, only the new sample is left
+    f.add(36, 1400)
+    assert not f.is_ready(50)
+    assert list(f.samples) == [(36, 1400)]
+
+
+@pytest.fixture
+def regulation(monkeypatch):
+    """ Set the production forecast settings of the regulation loop, return a function filling its forecaster """
+    for name in ('production_forecaster', 'power_production', 'FORECAST_BOOST'):
+        monkeypatch.setattr(power_regulation, name, getattr(power_regulation, name))
+    monkeypatch.setattr(power_regulation, 'FORECAST_HORIZON', 8)
+    monkeypatch.setattr(power_regulation, 'FORECAST_CONFIDENCE', 1.0)
+
+    def measure(powers, boost=False):
+        power_regulation.FORECAST_BOOST = boost
+        power_regulation.production_forecaster = forecaster(powers)
+        power_regulation.power_production = powers[-1]
+        return power_regulation.anticipated_production(4 * (len(powers) - 1))
+
+    return measure
+
+
+def test_production_trimmed_on_drop(regulation):
+    # 100W less every 4s, 200W less at the horizon
+    assert regulation([1300, 1200, 1100, 1000]) == 800
+
+
+def test_production_kept_within_noise(regulation):
+    # the drop expected at the horizon is about the width of the prediction interval
+    powers = [1300, 1100, 1250, 1050]
+    predicted, sigma = forecaster(powers).predict(20)
+    assert predicted < powers[-1] < predicted + sigma
+    assert regulation(powers) == powers[-1]
+
+
+def test_production_trimmed_with_noise(regulation):
+    powers = [1600, 1340, 1260, 1000]
+    predicted, sigma = forecaster(powers).predict(20)
+    assert regulation(powers) == int(predicted + sigma) < powers[-1]
+
+
+def test_production_boosted_on_rise(regulation):
+    powers = [1000, 1100, 1200, 1300]
+    assert regulation(powers) == 1300
+    assert regulation(powers, boost=True) == 1500
@@ -0,0 +1,146 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Drive InstantPowerEstimator with a virtual clock and timers fired by hand. Run with: python -m pytest
+
+import pytest
+
+import instant_power
+from instant_power import DECAY_PERIOD, InstantPowerEstimator, MIN_DELAY, THRESHOLD_LOW
+
+
+class VirtualClock(object):
+    def __init__(self, t=0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+class ManualTimer(object):
+    """ threading.Timer stand-in, the callback only runs when fire() is called """
+
+    def __init__(self, delay, callback):
+        self.delay = delay
+        self.callback = callback
+        self.started = False
+        self.cancelled = False
+
+    def start(self):
+        self.started = True
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        # like threading.Timer, a timer which is already running its callback is not stopped by cancel()
+        self.callback()
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock(1000)
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def estimator(clock, published):
+    return InstantPowerEstimator(published.append, clock=clock, timer_factory=ManualTimer)
+
+
+def test_first_decay_deadline(estimator, published):
+    estimator.on_indexes(100, 200)
+    assert published == []
+    assert estimator.timer.started
+    assert estimator.timer.delay == pytest.approx(3600.0 / THRESHOLD_LOW)
+    assert estimator.timer.delay == pytest.approx(36)
+
+
+def test_decay_rearms_every_period(estimator, clock, published):
+    estimator.on_indexes(100, 200)
+    clock.t += 36
+    estimator.timer.fire()
+    assert published == [pytest.approx(100)]
+    assert estimator.timer.delay == DECAY_PERIOD
+
+    clock.t += DECAY_PERIOD
+    estimator.timer.fire()
+    assert published[-1] == pytest.approx(3600.0 / (36 + DECAY_PERIOD))
+    assert estimator.timer.delay == DECAY_PERIOD
+
+    # below THRESHOLD_ZERO the estimate is 0
+    clock.t += 40
+    estimator.timer.fire()
+    assert published[-1] == 0
+
+
+def test_index_tick_rearms(estimator, clock, published):
+    estimator.on_indexes(100, 200)
+    first = estimator.timer
+    clock.t += 10
+    estimator.on_indexes(101, 200)
+    assert published == [pytest.approx(360)]
+    assert first.cancelled
+    assert estimator.timer is not first
+    assert estimator.timer.delay == pytest.approx(36)
+
+
+def test_min_delay_filtering(estimator, clock, published):
+    estimator.on_indexes(100, 200)
+    first = estimator.timer
+    clock.t += MIN_DELAY - 1
+    estimator.on_indexes(102, 200)
+    assert published == []
+    assert estimator.timer is first and not first.cancelled
+
+    # the index change is taken into account once MIN_DELAY is elapsed, over the whole duration
+    clock.t += 2
+    estimator.on_indexes(102, 200)
+    assert published == [pytest.approx(2 * 3600.0 / (MIN_DELAY + 1))]
+
+
+def test_stale_deadline_callback_is_ignored(estimator, clock, published):
+    estimator.on_indexes(100, 200)
+    stale = estimator.timer
+    # the deadline fires while an index tick is being processed at the same date: the tick re-arms the timer first
+    clock.t += 36
+    estimator.on_indexes(100, 201)
+    assert published == [pytest.approx(100)]
+    current = estimator.timer
+    stale.fire()
+    assert published == [pytest.approx(100)]
+    assert estimator.timer is current
+
+
+def test_stop(estimator, published):
+    estimator.on_indexes(100, 200)
+    timer = estimator.timer
+    estimator.stop()
+    assert timer.cancelled
+    timer.fire()
+    assert published == []
+
+
+def test_on_message(estimator, published, clock):
+    class Message(object):
+        topic = 'tic/data'
+        payload = b'{"hchc": 100, "hchp": 200}'
+
+    instant_power.on_message(None, estimator, Message())
+    assert estimator.prev_hc == 100 and estimator.prev_hp == 200
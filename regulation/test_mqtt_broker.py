@@ -0,0 +1,141 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Topic filters, retained messages and keep alive of the MQTT broker stand-in. Run with: python -m pytest
+
+import socket
+import struct
+import time
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import mqtt_broker
+from mqtt_broker import CONNACK, CONNECT, encode_string, packet, topic_matches
+
+
+@pytest.mark.parametrize('topic_filter, topic, expected', (
+    ('site/home/pzem/0', 'site/home/pzem/0', True),
+    ('site/home/pzem/0', 'site/home/pzem/1', False),
+    ('site/+/pzem/0', 'site/barn/pzem/0', True),
+    ('site/+/pzem/0', 'site/barn/scr/0', False),
+    ('site/+', 'site/home/pzem', False),
+    ('+/+', 'site/home', True),
+    ('site/#', 'site/home/pzem/0', True),
+    ('site/#', 'site', True),
+    ('site/home/#', 'site/barn/pzem', False),
+    ('#', 'regulation/status', True),
+    ('site/home/pzem/0/#', 'site/home/pzem', False),
+))
+def test_topic_matches(topic_filter, topic, expected):
+    assert topic_matches(topic_filter, topic) == expected
+
+
+@pytest.fixture
+def broker():
+    broker = mqtt_broker.Broker().start()
+    yield broker
+    broker.stop()
+
+
+class Subscriber(object):
+    """ A client recording the (topic, payload, retain flag) of the messages it receives on regulation/# """
+
+    def __init__(self, broker, keep_alive=60):
+        self.received = []
+        self.client = mqtt.Client(client_id='subscriber')
+        self.client.on_message = lambda c, userdata, msg: self.received.append(
+            (msg.topic, msg.payload.decode(), bool(msg.retain)))
+        self.client.connect(broker.host, broker.port, keep_alive)
+        self.client.subscribe('regulation/#')
+        self.client.loop_start()
+        broker.wait_for_subscriber('regulation/status')
+
+    def wait(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.received) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.received
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def test_retained_messages(broker):
+    broker.publish('regulation/status', b'{"date": 1}', retain=True)
+    broker.publish('regulation/status', b'{"date": 2}', retain=True)
+    broker.publish('regulation/other', b'not retained')
+    subscriber = Subscriber(broker)
+    try:
+        # only the last retained message is delivered on subscription, with the retain flag
+        assert subscriber.wait(1) == [('regulation/status', '{"date": 2}', True)]
+        broker.publish('regulation/status', b'{"date": 3}', retain=True)
+        assert subscriber.wait(2)[1] == ('regulation/status', '{"date": 3}', False)
+    finally:
+        subscriber.close()
+
+    # an empty retained message clears the retained one, and is delivered to the current subscribers
+    subscriber = Subscriber(broker)
+    try:
+        assert subscriber.wait(1) == [('regulation/status', '{"date": 3}', True)]
+        broker.publish('regulation/status', b'', retain=True)
+        assert subscriber.wait(2)[1] == ('regulation/status', '', False)
+    finally:
+        subscriber.close()
+    assert broker.retained == {}
+    subscriber = Subscriber(broker)
+    try:
+        time.sleep(0.2)
+        assert subscriber.received == []
+    finally:
+        subscriber.close()
+
+
+def connect(broker, keep_alive):
+    """ A raw connection which sends CONNECT and nothing else afterwards """
+    sock = socket.create_connection((broker.host, broker.port))
+    body = encode_string('MQTT') + b'\x04\x02' + struct.pack('!H', keep_alive) + encode_string('silent')
+    sock.sendall(packet(CONNECT, 0, body))
+    assert bytearray(sock.recv(4)) == bytearray(packet(CONNACK, 0, b'\x00\x00'))
+    return sock
+
+
+def test_keep_alive(broker):
+    sock = connect(broker, 1)
+    start = time.time()
+    subscriber = Subscriber(broker, keep_alive=1)
+    try:
+        sock.settimeout(5)
+        # the silent client is disconnected after 1.5s
+        assert sock.recv(1) == b''
+        assert 1.4 < time.time() - start < 3
+        # the client which sends PINGREQ stays connected
+        time.sleep(1)
+        assert [c['client_id'] for c in broker.stats()['clients']] == ['subscriber']
+    finally:
+        subscriber.close()
+        sock.close()
+
+
+def test_no_keep_alive(broker):
+    sock = connect(broker, 0)
+    try:
+        sock.settimeout(2)
+        with pytest.raises(socket.timeout):
+            sock.recv(1)
+        assert len(broker.stats()['clients']) == 1
+    finally:
+        sock.close()
@@ -0,0 +1,300 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Drive the regulation loop with a virtual clock and the sensor messages of the PZEM modules. Run with: python -m pytest
+
+import json
+import time
+
+import pytest
+
+import config
+from decision_cache import DecisionCache
+import equipment
+import power_regulation
+from power_regulation import EVALUATION_PERIOD
+from replay import ACTUATION_DELAYS, DEFAULT_SETTINGS, Message, Replay, SAMPLE_PERIOD, make_equipments
+
+# 2019-05-01 15:50 and 12:00, local time
+START = time.mktime((2019, 5, 1, 15, 50, 0, 0, 0, -1))
+NOON = time.mktime((2019, 5, 1, 12, 0, 0, 0, 0, -1))
+
+
+@pytest.fixture
+def replay(monkeypatch):
+    """ A replay with the equipments of config.json, the module globals it swaps are restored afterwards """
+    for name in ('now_ts', 'mqtt_client', 'equipments', 'equipment_water_heater', 'last_evaluation_date',
+                 'next_evaluation_date', 'power_consumption', 'power_production', 'power_consumption_date',
+                 'response_measurement', 'shedding', 'energy_yesterday', 'production_forecaster',
+                 'decision_cache') + tuple(DEFAULT_SETTINGS):
+        monkeypatch.setattr(power_regulation, name, getattr(power_regulation, name))
+    for name in ('now_ts', '_mqtt_client', '_send_commands'):
+        monkeypatch.setattr(equipment, name, getattr(equipment, name))
+    equipments, water_heater = make_equipments()
+    r = Replay(equipments, water_heater)
+    r.setup(START)
+    return r
+
+
+def send(replay, topic, power):
+    power_regulation.on_message(replay.client, None, Message(topic, json.dumps({'p': power}).encode()))
+
+
+def test_fallback_without_consumption_sensor(replay):
+    water_heater = replay.water_heater
+    send(replay, power_regulation.TOPIC_SENSOR_CONSUMPTION, 300)
+    # the consumption sensor stops, the production one goes on until after the 16:00 check
+    while replay.clock.t < START + 660:
+        replay.clock.t += 4
+        send(replay, power_regulation.TOPIC_SENSOR_PRODUCTION, 1000)
+    assert water_heater.is_forced()
+    assert water_heater.get_current_power() == water_heater.max_power
+
+
+def steady_samples(start, duration, production, consumption=300, cloud=None):
+    """ Samples every SAMPLE_PERIOD, production drops to 0 during cloud=(begin, end) seconds after start """
+    samples = []
+    for k in range(int(duration / SAMPLE_PERIOD)):
+        t = start + k * SAMPLE_PERIOD
+        covered = cloud is not None and cloud[0] <= t - start < cloud[1]
+        samples.append((t, 0 if covered else production, consumption))
+    return samples
+
+
+def test_hysteresis_band_keeps_priority(replay, monkeypatch):
+    monkeypatch.setitem(ACTUATION_DELAYS, 'water_heater', 3)
+    charger, water_heater = replay.equipments
+    # 1730W of surplus once the margin is kept, the charger has the higher priority
+    replay.run(steady_samples(NOON, 300, 2050))
+    assert charger.is_on
+    assert water_heater.get_current_power() == 1730 - charger.nominal_power
+
+
+def test_min_off_time_keeps_priority(replay, monkeypatch):
+    monkeypatch.setitem(ACTUATION_DELAYS, 'water_heater', 3)
+    charger, water_heater = replay.equipments
+    history = []
+    record_commands = replay.record_commands
+
+    def record(t):
+        record_commands(t)
+        history.append((t, charger.is_on, water_heater.get_current_power()))
+
+    replay.record_commands = record
+    # a one minute cloud turns the charger off
+    replay.run(steady_samples(NOON, 600, 2050, cloud=(120, 180)))
+    off_date = max(t for t, is_on, _ in history if t < NOON + 180 and not is_on)
+    on_date = min(t for t, is_on, _ in history if t > off_date and is_on)
+    assert on_date < off_date + charger.min_off_time + 2 * EVALUATION_PERIOD
+    # the water heater does not take the power of the charger while it waits for its minimum off time
+    for t, is_on, power in history:
+        if NOON + 240 < t < on_date:
+            assert power <= 1730 - charger.nominal_power
+    assert charger.is_on
+
+
+@pytest.fixture
+def reload(replay, monkeypatch, tmp_path):
+    """ Apply a copy of config.json written in a temporary file, return a function rewriting and reloading it """
+    for name in ('configuration', 'equipment_by_name', 'last_configuration_check_date', 'MARGIN', 'BALANCE_THRESHOLD',
+                 'DECISION_CACHE_QUANTUM', 'TOPIC_SENSOR_CONSUMPTION', 'TOPIC_SENSOR_PRODUCTION',
+                 'TOPIC_REGULATION_CONTROL', 'TOPIC_STATUS'):
+        monkeypatch.setattr(power_regulation, name, getattr(power_regulation, name))
+    with open(config.CONFIG_FILE) as f:
+        data = json.load(f)
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(data))
+    power_regulation.apply_configuration(config.load(str(path)))
+
+    def write_and_reload(change):
+        change(data)
+        path.write_text(json.dumps(data))
+        power_regulation.reload_configuration()
+
+    return write_and_reload
+
+
+def test_reload_keeps_unchanged_equipments(replay, reload):
+    charger = power_regulation.get_equipment_by_name('e_bike_charger')
+    water_heater = power_regulation.get_equipment_by_name('water_heater')
+    charger.set_current_power(120)
+    water_heater.set_current_power(1000)
+    replay.clock.t += 600
+    water_heater.force(1500, 3600)
+    energy = water_heater.get_energy()
+    reload(lambda data: data['equipments'][0].update(min_on_time=60))
+    # the charger is rebuilt at 0W, the water heater keeps its power, forced state and energy
+    assert charger.get_current_power() == 0
+    assert power_regulation.get_equipment_by_name('e_bike_charger') is not charger
+    assert power_regulation.get_equipment_by_name('e_bike_charger').min_on_time == 60
+    assert power_regulation.get_equipment_by_name('water_heater') is water_heater
+    assert water_heater.get_current_power() == 1500
+    assert water_heater.is_forced()
+    assert water_heater.get_energy() == energy > 0
+
+
+def test_reload_turns_removed_equipments_off(replay, reload):
+    charger = power_regulation.get_equipment_by_name('e_bike_charger')
+    charger.set_current_power(120)
+    reload(lambda data: data['equipments'].pop(0))
+    assert charger.get_current_power() == 0
+    assert power_regulation.get_equipment_by_name('e_bike_charger') is None
+    assert power_regulation.equipments == (power_regulation.get_equipment_by_name('water_heater'),)
+
+
+def test_reload_restores_default_settings(replay, reload):
+    reload(lambda data: data.update(margin=50))
+    assert power_regulation.MARGIN == 50
+    reload(lambda data: data.pop('margin'))
+    assert power_regulation.MARGIN == power_regulation.DEFAULT_MARGIN
+
+
+@pytest.mark.parametrize('change', (
+    lambda data: data.update(margin='20'),
+    lambda data: data.update(balance_threshold=-1),
+    lambda data: data['equipments'][1].update(max_power='2400'),
+    lambda data: data['equipments'][0].update(nominal_power=0),
+    lambda data: data['equipments'][0].update(min_off_time=None),
+    lambda data: data['equipments'][0].update(hysteresis_energy=True),
+    lambda data: data.update(decision_cache={'size': 2.5}),
+    lambda data: data.update(decision_cache={'quantum': 0}),
+))
+def test_reload_rejects_invalid_values(replay, reload, change):
+    configuration = power_regulation.configuration
+    water_heater = power_regulation.get_equipment_by_name('water_heater')
+    water_heater.set_current_power(1000)
+    reload(change)
+    assert power_regulation.configuration is configuration
+    assert power_regulation.MARGIN == configuration.margin
+    assert water_heater.get_current_power() == 1000
+
+
+def test_no_preemption_without_dwell(replay, monkeypatch):
+    equipments, water_heater = make_equipments(dwell=False)
+    charger = equipments[0]
+    monkeypatch.setattr(power_regulation, 'equipments', equipments)
+    water_heater.set_current_power(1000)
+    # balanced powers: the charger, without dwell times nor band, does not take the power of the water heater
+    power_regulation.allocate(0)
+    assert not charger.is_on
+    assert water_heater.get_current_power() == 1000
+
+
+@pytest.fixture
+def cache(replay, monkeypatch):
+    """ A decision cache of 2 entries, evaluations are triggered by evaluate_surplus() """
+    monkeypatch.setattr(power_regulation, 'ADAPTIVE_EVALUATION_PERIOD', False)
+    power_regulation.DECISION_CACHE_SIZE = 2
+    power_regulation.decision_cache = DecisionCache(2)
+    return power_regulation.decision_cache
+
+
+def evaluate_surplus(replay, surplus, consumption=300):
+    replay.clock.t += EVALUATION_PERIOD
+    power_regulation.power_consumption = consumption
+    power_regulation.power_production = consumption + power_regulation.MARGIN + surplus
+    power_regulation.evaluate()
+
+
+def without_dwell(monkeypatch):
+    equipments, water_heater = make_equipments(dwell=False)
+    for e in equipments:
+        e.set_current_power(0)
+    monkeypatch.setattr(power_regulation, 'equipments', equipments)
+    monkeypatch.setattr(power_regulation, 'equipment_water_heater', water_heater)
+    monkeypatch.setattr(power_regulation, 'equipment_by_name', dict((e.name, e) for e in equipments))
+    return equipments
+
+
+def test_cache_hit_applies_the_decision_of_the_miss(replay, cache, monkeypatch):
+    equipments = without_dwell(monkeypatch)
+    initial = [e.get_state() for e in equipments]
+    evaluate_surplus(replay, 1000)
+    decision = [e.get_state() for e in equipments]
+    assert decision == [equipments[0].nominal_power, 1000 - equipments[0].nominal_power]
+    assert cache.stats() == {'size': 1, 'hits': 0, 'misses': 1, 'evictions': 0}
+
+    # back in the same situation, with a surplus within the same quantum
+    for e, state in zip(equipments, initial):
+        e.set_state(state)
+    evaluate_surplus(replay, 1003)
+    assert [e.get_state() for e in equipments] == decision
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0}
+    assert json.loads(replay.client.messages[-1][2])['decision_cache'] == cache.stats()
+
+
+def test_cache_evicts_least_recently_used_decisions(replay, cache, monkeypatch):
+    equipments = without_dwell(monkeypatch)
+    initial = [e.get_state() for e in equipments]
+
+    def evaluate_from_initial_states(surplus):
+        for e, state in zip(equipments, initial):
+            e.set_state(state)
+        evaluate_surplus(replay, surplus)
+
+    evaluate_from_initial_states(1000)
+    evaluate_from_initial_states(500)
+    evaluate_from_initial_states(1000)
+    # the decision for 500W is now the least recently used one
+    evaluate_from_initial_states(200)
+    assert cache.stats() == {'size': 2, 'hits': 1, 'misses': 3, 'evictions': 1}
+    evaluate_from_initial_states(1000)
+    evaluate_from_initial_states(500)
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 4, 'evictions': 2}
+
+
+def test_cache_skips_decisions_through_hysteresis_band(replay, cache):
+    charger, water_heater = replay.equipments
+    # the charger accumulates the surplus towards its hysteresis band before switching on
+    evaluate_surplus(replay, 130)
+    assert charger.pending_direction == 'on'
+    assert cache.stats() == {'size': 0, 'hits': 0, 'misses': 1, 'evictions': 0}
+
+
+@pytest.mark.parametrize('command', ({'command': 'force', 'name': 'water_heater', 'power': 1000},
+                                     {'command': 'unforce', 'name': 'water_heater'}))
+def test_cache_cleared_by_control_messages(replay, cache, monkeypatch, command):
+    water_heater = without_dwell(monkeypatch)[1]
+    evaluate_surplus(replay, 1000)
+    assert cache.stats()['size'] == 1
+    # the control messages evaluate right away, the clock does not move so that this evaluation is skipped
+    power_regulation.on_message(replay.client, None, Message(power_regulation.TOPIC_REGULATION_CONTROL,
+                                                             json.dumps(command).encode()))
+    assert water_heater.is_forced() == (command['command'] == 'force')
+    assert cache.stats()['size'] == 0
+
+
+def test_cache_cleared_by_reload(replay, reload, monkeypatch):
+    monkeypatch.setattr(power_regulation, 'ADAPTIVE_EVALUATION_PERIOD', False)
+    reload(lambda data: data.update(decision_cache={'size': 4}))
+    cache = power_regulation.decision_cache
+    evaluate_surplus(replay, 0)
+    assert cache.stats()['size'] == 1
+    reload(lambda data: data.update(margin=50))
+    assert power_regulation.decision_cache is cache
+    assert cache.stats()['size'] == 0
+
+
+def test_cache_cleared_by_daily_energy_fallback(replay, cache, monkeypatch):
+    equipments = without_dwell(monkeypatch)
+    water_heater = equipments[1]
+    while replay.clock.t < START + 600 - EVALUATION_PERIOD:
+        evaluate_surplus(replay, 0)
+    assert cache.stats()['size'] == 1
+    # the 16:00 check forces the water heater, the decisions taken while it was not forced are dropped
+    evaluate_surplus(replay, 0)
+    assert water_heater.is_forced()
+    assert list(cache.entries) == [power_regulation.decision_key(0)]
+    assert power_regulation.decision_key(0)[2] == (False, True)
@@ -14,46 +14,171 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+# Calibrate one or several SCR regulators at once. Each channel is given as <scr index>:<serial port> and is driven by
+# its own thread, so that the total duration does not depend on the number of channels:
+#   calibration.py 0:/dev/ttyUSB0 1:/dev/ttyUSB1
+# The table of each channel is written to its own CSV file (see --output), progress and ETA are printed on stderr.
+#
+# With --simulate, the calibration runs against the local MQTT broker stand-in of the regulation directory and
+# simulated meters, --time-scale can then be used to speed things up:
+#   calibration.py --simulate --time-scale 100 0 1 2 3
 
-import paho.mqtt.client as mqtt
+import argparse
+import math
+import os
+import random
+import sys
+import threading
 import time
 
-import sys
+import paho.mqtt.client as mqtt
+
+# MQTT broker address
+MQTT_BROKER = "vpi3"
+MQTT_PORT = 1883
+
+# Delay between a command and the first measurement
+SETTLE_DELAY = 5
+# Number of measurements averaged for each command, and delay between them
+SAMPLE_COUNT = 12
+SAMPLE_PERIOD = 1
+
+PERCENTS = range(100, -1, -1)
+
+
+class Progress(object):
+    def __init__(self, channels):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.done = dict((c, 0) for c in channels)
+
+    def step(self, channel):
+        with self.lock:
+            self.done[channel] += 1
+            elapsed = time.time() - self.start
+            remaining = max((len(PERCENTS) - n) * elapsed / n for n in self.done.values() if n > 0)
+            total = len(PERCENTS) * len(self.done)
+            sys.stderr.write('# channel {}: {}/{}, overall {:.0%}, ETA {}\n'.format(
+                channel, self.done[channel], len(PERCENTS), sum(self.done.values()) / float(total),
+                time.strftime('%H:%M:%S', time.gmtime(remaining))))
+            sys.stderr.flush()
+
+
+def calibrate_channel(client, channel, meter, output, progress, time_scale=1.0):
+    with open(output, 'w') as f:
+        f.write('percent;power\n')
+        for percent in PERCENTS:
+            client.publish('scr/{}/in'.format(channel), str(percent))
+
+            time.sleep(SETTLE_DELAY / time_scale)
+
+            avg_power = 0
+            n = 0
+            while n < SAMPLE_COUNT:
+                read_power = meter.readPower()
+                if read_power > 1:
+                    avg_power += read_power
+                    n += 1
+                time.sleep(SAMPLE_PERIOD / time_scale)
+            avg_power /= float(SAMPLE_COUNT)
 
-from pzem import BTPOWER
+            f.write('{};{}\n'.format(percent, avg_power))
+            f.flush()
+            progress.step(channel)
+
+
+def run_channel(errors, client, channel, meter, output, progress, time_scale):
+    """ calibrate_channel() in a thread, exceptions are recorded in errors by channel """
+    try:
+        calibrate_channel(client, channel, meter, output, progress, time_scale)
+    except Exception as e:
+        errors[channel] = e
+        sys.stderr.write('# channel {} failed: {!r}\n'.format(channel, e))
+        sys.stderr.flush()
+
+
+class SimulatedMeter(object):
+    """ A meter measuring a resistive load behind a phase angle controlled SCR, listening to the SCR commands """
+
+    # the snubber of the SCR lets a few watts through even at 0%
+    LEAK = 3
+
+    def __init__(self, host, port, channel, max_power=2400):
+        self.max_power = max_power
+        self.percent = 0
+        self.client = mqtt.Client()
+        self.client.on_message = self.on_message
+        self.client.connect(host, port, 60)
+        self.client.subscribe('scr/{}/in'.format(channel))
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, msg):
+        self.percent = float(msg.payload.decode())
+
+    def readPower(self):
+        a = math.pi * (1 - self.percent / 100.0)
+        power = self.max_power * (1 - a / math.pi + math.sin(2 * a) / (2 * math.pi))
+        return int(power * random.uniform(0.99, 1.01)) + SimulatedMeter.LEAK
+
+    def close(self):
+        self.client.loop_stop()
 
 
 def main():
-    client = mqtt.Client()
-    client.connect("vpi3", 1883, 120)
+    parser = argparse.ArgumentParser(description='SCR calibration')
+    parser.add_argument('channels', nargs='*', default=['0:/dev/ttyUSB0'],
+                        help='<scr index>:<serial port>, the port is ignored with --simulate')
+    parser.add_argument('--output', default='calibration_{}.csv', help='CSV file name, {} is the SCR index')
+    parser.add_argument('--simulate', action='store_true', help='use a local broker and simulated meters')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='divide all delays by this factor')
+    args = parser.parse_args()
+
+    channels = [c.split(':', 1) if ':' in c else (c, None) for c in args.channels]
+    if not args.simulate:
+        for index, serial_port in channels:
+            if not serial_port:
+                parser.error('channel {} needs a serial port: <scr index>:<serial port>'.format(index))
+
+    host, port = MQTT_BROKER, MQTT_PORT
+    if args.simulate:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'regulation'))
+        import mqtt_broker
+        broker = mqtt_broker.Broker().start()
+        host, port = broker.host, broker.port
+        meters = [SimulatedMeter(host, port, index) for index, _ in channels]
+        # a command published before the subscription of its meter is active would be lost
+        for index, _ in channels:
+            broker.wait_for_subscriber('scr/{}/in'.format(index))
+    else:
+        from pzem import BTPOWER
+        meters = [BTPOWER(com=serial_port) for _, serial_port in channels]
 
+    client = mqtt.Client()
+    client.connect(host, port, 120)
     client.loop_start()
 
-    sensor = BTPOWER()
-
-    print('percent;power')
-    for percent in range(100, -1, -1):
-        print('# command to {}%'.format(percent))
-        client.publish('scr/0/in', str(percent))
-
-        time.sleep(5)
-
-        avg_power = 0
-        avg_count = 12
-        n = 0
-        while n < avg_count:
-            read_power = sensor.readPower()
-            if read_power > 1:
-                print('# read {}W'.format(read_power))
-                sys.stdout.flush()
-                avg_power += read_power
-                n += 1
-            time.sleep(1)
-        avg_power /= float(avg_count)
-
-        print('{};{}'.format(percent, avg_power))
-        sys.stdout.flush()
+    progress = Progress([index for index, _ in channels])
+    errors = {}
+    threads = []
+    for (index, _), meter in zip(channels, meters):
+        t = threading.Thread(target=run_channel,
+                             args=(errors, client, index, meter, args.output.format(index), progress, args.time_scale))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+
+    for meter in meters:
+        meter.close()
+    client.loop_stop()
+    if errors:
+        # the CSV files of these channels are incomplete
+        sys.stderr.write('# failed channels: {}\n'.format(', '.join(sorted(errors))))
+        sys.exit(1)
+    sys.stderr.write('# done in {:.0f}s\n'.format(time.time() - progress.start))
 
 
 if __name__ == "__main__":
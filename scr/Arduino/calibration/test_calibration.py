@@ -0,0 +1,76 @@
+# Copyright (C) 2018-2019 Pierre Hébert
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Calibrate simulated meters through the MQTT broker stand-in of the regulation directory. Run with: python -m pytest
+
+import math
+import os
+import sys
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import calibration
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'regulation'))
+import mqtt_broker  # noqa: E402
+
+TIME_SCALE = 100
+
+
+def expected_power(percent, max_power=2400):
+    a = math.pi * (1 - percent / 100.0)
+    return max_power * (1 - a / math.pi + math.sin(2 * a) / (2 * math.pi)) + calibration.SimulatedMeter.LEAK
+
+
+@pytest.fixture
+def broker():
+    broker = mqtt_broker.Broker().start()
+    yield broker
+    broker.stop()
+
+
+def read_csv(path):
+    with open(str(path)) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'percent;power'
+    return [(int(p), float(w)) for p, w in (line.split(';') for line in lines[1:])]
+
+
+def test_calibrate_channels(broker, monkeypatch, tmp_path):
+    monkeypatch.setattr(calibration, 'PERCENTS', [100, 75, 50, 25, 0])
+    channels = ['0', '1']
+    meters = [calibration.SimulatedMeter(broker.host, broker.port, channel) for channel in channels]
+    for channel in channels:
+        broker.wait_for_subscriber('scr/{}/in'.format(channel))
+    client = mqtt.Client()
+    client.connect(broker.host, broker.port, 60)
+    client.loop_start()
+    try:
+        progress = calibration.Progress(channels)
+        for channel, meter in zip(channels, meters):
+            calibration.calibrate_channel(client, channel, meter, str(tmp_path / '{}.csv'.format(channel)), progress,
+                                          TIME_SCALE)
+    finally:
+        client.loop_stop()
+        for meter in meters:
+            meter.close()
+
+    for channel in channels:
+        rows = read_csv(tmp_path / '{}.csv'.format(channel))
+        assert [percent for percent, _ in rows] == calibration.PERCENTS
+        for percent, power in rows:
+            # readPower() adds up to 1% of noise and truncates to an integer
+            assert power == pytest.approx(expected_power(percent), abs=0.01 * expected_power(percent) + 1)